@@ -1,4 +1,3 @@
-import locale
 import os
 import threading
 import time
@@ -8,6 +7,8 @@ import gittip.wireup
 import gittip.security.authentication
 import gittip.security.csrf
 import gittip.utils.cache_static
+import gittip.utils.site_globals
+from gittip.elsewhere import bitbucket, github, twitter, bountysource
 
 
 version_file = os.path.join(website.www_root, 'version.txt')
@@ -27,6 +28,8 @@ gittip.wireup.mixpanel(website)
 gittip.wireup.nanswers()
 gittip.wireup.nmembers(website)
 gittip.wireup.envvars(website)
+gittip.wireup.sessions(website)
+gittip.wireup.projection(website)
 
 
 # Up the threadpool size: https://github.com/gittip/www.gittip.com/issues/1098
@@ -83,20 +86,18 @@ website.hooks.outbound += [x_frame_options]
 
 
 def add_stuff(request):
-    from gittip.elsewhere import bitbucket, github, twitter, bountysource
     request.context['username'] = None
     request.context['bitbucket'] = bitbucket
     request.context['github'] = github
     request.context['twitter'] = twitter
     request.context['bountysource'] = bountysource
-    stats = gittip.db.one( "SELECT nactive, transfer_volume FROM paydays "
-                           "ORDER BY ts_end DESC LIMIT 1"
-                         , default=(0, 0.0)
-                          )
-    request.context['gnactive'] = locale.format("%d", round(stats[0], -2), grouping=True)
-    request.context['gtransfer_volume'] = locale.format("%d", round(stats[1], -2), grouping=True)
 
-website.hooks.inbound_early += [add_stuff]
+# The footer's stats are the same for everyone, so compute them at startup
+# and then along with the homepage queries, below.
+site_globals = gittip.utils.site_globals.SiteGlobals(website.db)
+site_globals.refresh()
+
+website.hooks.inbound_early += [add_stuff, site_globals.inbound]
 
 
 # The homepage wants expensive queries. Let's periodically select into an
@@ -107,6 +108,7 @@ def update_homepage_queries():
     from gittip import utils
     while 1:
         utils.update_homepage_queries_once(website.db)
+        site_globals.refresh()
         time.sleep(UPDATE_HOMEPAGE_EVERY)
 
 homepage_updater = threading.Thread(target=update_homepage_queries)
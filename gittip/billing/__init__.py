@@ -102,6 +102,7 @@ def associate(thing, username, balanced_account_uri, balanced_thing_uri):
     typecheck(error, unicode)
 
     gittip.db.run(SQL, (error, username))
+    update_projection(username)
     return error
 
 
@@ -141,6 +142,14 @@ def clear(thing, username, balanced_account_uri):
 
     """ % ("bill" if thing == "credit card" else "ach")
     gittip.db.run(CLEAR, (username,))
+    update_projection(username)
+
+
+def update_projection(username):
+    """Given a username, update their part of the projected next payday.
+    """
+    from gittip.billing import projection  # avoid circular import
+    projection.updater.add([username])
 
 
 def store_error(thing, username, msg):
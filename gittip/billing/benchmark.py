@@ -0,0 +1,279 @@
+"""Benchmark payday against synthetic data.
+
+This is installed as `payday_benchmark`. For each requested size we wipe the
+database, populate it with gittip.utils.fake_data.populate_db, and run payday
+with a stub processor (nothing goes to Balanced or Stripe). For each phase of
+payday we measure wall time, the number of SQL statements executed, and the
+number of rows written (as reported by INSERT, UPDATE, and DELETE). Results
+are appended as one JSON object per line to an output file, so that runs can
+be compared against each other as gittip.billing.payday changes.
+
+This deletes everything in the database it runs against! Point DATABASE_URL
+at a scratch database.
+
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import datetime
+import json
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from postgres import cursors
+from psycopg2 import IntegrityError, InternalError
+
+from gittip import wireup
+from gittip.billing.payday import Payday
+from gittip.utils.fake_data import populate_db
+
+
+SIZES = (1000, 10000, 100000)
+TIPS_PER_PARTICIPANT = 3
+TEAMS_PER_THOUSAND = 10
+TIPPEE_EXPONENT = 1.1
+OUTPUT = 'payday-benchmark.jsonl'
+
+CURSOR_CLASSES = ( cursors.SimpleTupleCursor
+                 , cursors.SimpleNamedTupleCursor
+                 , cursors.SimpleDictCursor
+                  )
+WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class StatementCounter(object):
+    """Count statements and rows written through postgres.py cursors.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = 0
+        self.rows_written = 0
+
+    def count(self, sql, rowcount):
+        verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        with self.lock:
+            self.statements += 1
+            if verb in WRITES and rowcount > 0:
+                self.rows_written += rowcount
+
+    def read(self):
+        with self.lock:
+            return self.statements, self.rows_written
+
+    @contextmanager
+    def installed(self):
+        """Wrap execute on the postgres.py cursor classes for the duration.
+        """
+        originals = [(c, c.__dict__.get('execute')) for c in CURSOR_CLASSES]
+        counter = self
+
+        def wrap(execute):
+            def counting_execute(cursor, sql, parameters=None):
+                out = execute(cursor, sql, parameters)
+                counter.count(sql, cursor.rowcount)
+                return out
+            return counting_execute
+
+        for cls, original in originals:
+            cls.execute = wrap(cls.execute)
+        try:
+            yield self
+        finally:
+            for cls, original in originals:
+                if original is None:
+                    del cls.execute
+                else:
+                    cls.execute = original
+
+
+class BenchmarkPayday(Payday):
+    """Run payday with a stub processor, recording per-phase measurements.
+
+    Every charge and credit succeeds after sleeping for latency seconds,
+    which stands in for the round trip to the processor.
+
+    """
+
+    def __init__(self, db, counter, latency=0.0, **kw):
+        super(BenchmarkPayday, self).__init__(db, **kw)
+        self.counter = counter
+        self.latency = latency
+        self.phases = []
+
+    def run_phase(self, name, func, *a):
+        statements, rows_written = self.counter.read()
+        _start = time.time()
+        out = super(BenchmarkPayday, self).run_phase(name, func, *a)
+        seconds = time.time() - _start
+        _statements, _rows_written = self.counter.read()
+        self.phases.append({ 'name': name
+                           , 'seconds': seconds
+                           , 'statements': _statements - statements
+                           , 'rows_written': _rows_written - rows_written
+                            })
+        return out
+
+    def prefetch_accounts(self, participants, wanted):
+        return participants     # we never go to Balanced
+
+    def charge_on_balanced(self, username, balanced_account_uri, amount,
+                           intent=None):
+        return self._stub_charge(amount)
+
+    def charge_on_stripe(self, username, stripe_customer_id, amount,
+                         intent=None):
+        return self._stub_charge(amount)
+
+    def _stub_charge(self, amount):
+        cents, msg, charge_amount, fee = self._prep_hit(amount)
+        time.sleep(self.latency)
+        return charge_amount, fee, ""
+
+    def credit_on_balanced(self, username, balanced_account_uri, cents, msg,
+                           intent=None):
+        time.sleep(self.latency)
+        return ""
+
+
+def clear_tables(db):
+    """Delete everything from every table in the public schema.
+    """
+    tablenames = db.all("SELECT tablename FROM pg_tables "
+                        "WHERE schemaname='public'")
+    while tablenames:
+        tablename = tablenames.pop()
+        try:
+            db.run("DELETE FROM %s CASCADE" % tablename)
+        except (IntegrityError, InternalError):
+            tablenames.insert(0, tablename)
+
+
+def get_revision():
+    """Return the git revision we're benchmarking, or None.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(db, size, tips_per_participant=TIPS_PER_PARTICIPANT,
+              teams_per_thousand=TEAMS_PER_THOUSAND,
+              tippee_exponent=TIPPEE_EXPONENT, latency=0.0, bulk=False,
+              nworkers=0):
+    """Populate db with size participants, run payday, and return a dict.
+    """
+    num_tips = size * tips_per_participant
+    num_teams = max(1, size * teams_per_thousand // 1000)
+
+    clear_tables(db)
+    _start = time.time()
+    populate_db(db, size, num_tips, num_teams, tippee_exponent)
+    populate_seconds = time.time() - _start
+
+    counter = StatementCounter()
+    payday = BenchmarkPayday( db
+                            , counter
+                            , latency=latency
+                            , bulk=bulk
+                            , nworkers=nworkers
+                             )
+    _start = time.time()
+    with counter.installed():
+        payday.run()
+    seconds = time.time() - _start
+    statements, rows_written = counter.read()
+
+    return { 'ts': datetime.datetime.utcnow().isoformat()
+           , 'revision': get_revision()
+           , 'nparticipants': size
+           , 'ntips': num_tips
+           , 'nteams': num_teams
+           , 'tippee_exponent': tippee_exponent
+           , 'latency': latency
+           , 'bulk': bulk
+           , 'nworkers': nworkers
+           , 'populate_seconds': populate_seconds
+           , 'seconds': seconds
+           , 'statements': statements
+           , 'rows_written': rows_written
+           , 'phases': payday.phases
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Gittip's payday.")
+    parser.add_argument( '--wipe'
+                       , action='store_true'
+                       , help="required: acknowledge that this deletes "
+                              "everything in the database"
+                        )
+    parser.add_argument( '--sizes'
+                       , default=','.join(str(size) for size in SIZES)
+                       , help="comma-separated numbers of participants "
+                              "(default: %(default)s)"
+                        )
+    parser.add_argument( '--tips-per-participant'
+                       , type=int
+                       , default=TIPS_PER_PARTICIPANT
+                        )
+    parser.add_argument( '--teams-per-thousand'
+                       , type=int
+                       , default=TEAMS_PER_THOUSAND
+                        )
+    parser.add_argument( '--tippee-exponent'
+                       , type=float
+                       , default=TIPPEE_EXPONENT
+                       , help="see gittip.utils.fake_data.fake_tip_pairs"
+                        )
+    parser.add_argument( '--latency'
+                       , type=float
+                       , default=0.0
+                       , help="seconds for each stub processor call"
+                        )
+    parser.add_argument('--bulk', action='store_true')
+    parser.add_argument('--nworkers', type=int, default=0)
+    parser.add_argument( '--output'
+                       , default=OUTPUT
+                       , help="file to append JSON lines to "
+                              "(default: %(default)s)"
+                        )
+    args = parser.parse_args()
+
+    if not args.wipe:
+        parser.error("This deletes everything in the database at "
+                     "DATABASE_URL. Pass --wipe if that's okay.")
+
+    db = wireup.db()
+    wireup.billing()
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        result = benchmark( db
+                          , size
+                          , tips_per_participant=args.tips_per_participant
+                          , teams_per_thousand=args.teams_per_thousand
+                          , tippee_exponent=args.tippee_exponent
+                          , latency=args.latency
+                          , bulk=args.bulk
+                          , nworkers=args.nworkers
+                           )
+        with open(args.output, 'a') as output:
+            output.write(json.dumps(result) + '\n')
+        for phase in result['phases']:
+            print( "%7d %-35s %8.3fs %8d statements %8d rows written"
+                 % ( size
+                   , phase['name']
+                   , phase['seconds']
+                   , phase['statements']
+                   , phase['rows_written']
+                    )
+                 , file=sys.stderr
+                  )
+
+
+if __name__ == '__main__':
+    main()
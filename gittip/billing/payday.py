@@ -18,6 +18,19 @@ single transaction.
 """
 from __future__ import unicode_literals
 
+import Queue
+import collections
+import csv
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from cStringIO import StringIO
+from contextlib import contextmanager
 from decimal import Decimal, ROUND_UP
 
 import balanced
@@ -26,7 +39,9 @@ import aspen.utils
 from aspen import log
 from aspen.utils import typecheck
 from gittip.models.participant import Participant
+from postgres import cursors
 from psycopg2 import IntegrityError
+from psycopg2.extensions import TransactionRollbackError
 
 
 # Set fees and minimums.
@@ -46,6 +61,79 @@ MINIMUM_CHARGE = Decimal("9.41")
 MINIMUM_CREDIT = Decimal("10.00")
 
 
+# Batch sizes.
+# ============
+# In genparticipants we fetch tips for this many participants at a time. In
+# bulk mode we work through participants this many at a time, writing all of
+# the transfers for a chunk in a single transaction.
+
+GENPARTICIPANTS_CHUNK_SIZE = 500
+BULK_CHUNK_SIZE = 500
+
+
+# Batches of at least this many transfers are loaded with COPY, through a
+# staging table, rather than with a multi-row INSERT (see apply_transfers).
+
+COPY_MIN_TRANSFERS = 100
+
+
+# Participants.
+# =============
+# We stream participants from a server-side cursor, this many rows per round
+# trip, and we only select the columns that payday actually uses. Participants
+# with a checkpoint for the phase at hand are skipped (with a NULL phase none
+# are), and in sharded mode we only select the participants in our shard.
+
+PARTICIPANTS_FETCH_SIZE = 1000
+PARTICIPANT_COLUMNS = ( 'id'
+                      , 'username'
+                      , 'claimed_time'
+                      , 'number'
+                      , 'is_suspicious'
+                      , 'balance'
+                      , 'balanced_account_uri'
+                      , 'stripe_customer_id'
+                       )
+PARTICIPANTS_FILTER = """\
+                   claimed_time IS NOT NULL
+               AND claimed_time < %(ts_start)s
+               AND is_suspicious IS NOT true
+               AND NOT EXISTS (
+                    SELECT 1
+                      FROM payday_checkpoints c
+                      JOIN paydays d ON d.id = c.payday
+                     WHERE d.ts_end='1970-01-01T00:00:00+00'::timestamptz
+                       AND c.phase = %(phase)s
+                       AND c.participant_id = participants.id
+                   )
+               AND ( %(number)s IS NULL
+                  OR participants.number = %(number)s
+                    )
+               AND ( %(nshards)s IS NULL
+                  OR participants.id %% %(nshards)s = %(shard)s
+                    )
+"""
+
+
+# Concurrent mode.
+# ================
+# In concurrent mode we talk to Balanced and Stripe from a pool of worker
+# threads, working through participants this many at a time. Results are
+# recorded in the db serially, in participant order, after each window.
+
+CONCURRENT_WINDOW = 100
+
+
+# Balanced accounts.
+# ==================
+# We look up each Balanced account at most once per payday, on this many
+# background threads, this many participants ahead of the payin and payout
+# loops (see BalancedAccounts and Payday.prefetch_accounts).
+
+ACCOUNT_PREFETCH_WORKERS = 4
+ACCOUNT_PREFETCH_AHEAD = 200
+
+
 def upcharge(amount):
     """Given an amount, return a higher amount and the difference.
     """
@@ -78,6 +166,182 @@ def is_whitelisted(participant):
     return True
 
 
+def intent_meta(intent):
+    """Given an exchange intent id or None, return a dict for the processor.
+
+    We tag each charge and credit with the id of the exchange_intents row we
+    wrote before making it, so that gittip.billing.reconciler can find it at
+    Balanced or Stripe if we crash before recording the result.
+
+    """
+    if intent is None:
+        return {}
+    return {'exchange_intent': unicode(intent)}
+
+
+def will_charge(participant, tips, total):
+    """Given a participant, their tips, and their total, return a boolean.
+
+    This is whether payin is going to charge the participant on Balanced.
+
+    """
+    return participant.balanced_account_uri is not None \
+       and participant.is_suspicious is False \
+       and total > participant.balance
+
+
+def will_credit(participant, tips, total):
+    """Given a participant, their tips, and their total, return a boolean.
+
+    This is whether payout is going to credit the participant on Balanced.
+
+    """
+    return participant.balanced_account_uri is not None \
+       and participant.is_suspicious is False \
+       and participant.balance - total >= MINIMUM_CREDIT
+
+
+def participant_from_record(rec):
+    """Given a dict of some participant columns, return a Participant.
+
+    This is what the postgres.py composite caster does for
+    participants.*::participants, but it lets us get away with only the
+    columns we need.
+
+    """
+    participant = Participant()
+    participant._set_read_only_attributes(rec.keys())
+    participant.set_attributes(**rec)
+    return participant
+
+
+def chunks(iterable, size):
+    """Given an iterable and an int, yield lists of up to size items.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def call_concurrently(func, args_list, nworkers):
+    """Given a callable, a list of argument tuples, and an int, return a list.
+
+    We call func once for each item in args_list, using at most nworkers
+    threads at once, and we return a list of (result, exc_info) tuples in the
+    same order as args_list. If a call raised then result is None and
+    exc_info is from sys.exc_info(), otherwise exc_info is None. With nworkers
+    less than 1 we call func serially in the current thread.
+
+    """
+    outcomes = [None] * len(args_list)
+
+    def call(i, args):
+        try:
+            outcomes[i] = (func(*args), None)
+        except:
+            outcomes[i] = (None, sys.exc_info())
+
+    if nworkers < 1:
+        for i, args in enumerate(args_list):
+            call(i, args)
+        return outcomes
+
+    queue = Queue.Queue()
+    for i, args in enumerate(args_list):
+        queue.put((i, args))
+
+    def work():
+        while True:
+            try:
+                i, args = queue.get_nowait()
+            except Queue.Empty:
+                break
+            call(i, args)
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(nworkers, len(args_list)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return outcomes
+
+
+def reraise_first(outcomes):
+    """Given a list of outcomes from call_concurrently, raise the first error.
+    """
+    for result, exc_info in outcomes:
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
+# Sharded mode.
+# =============
+# In sharded mode payin, pachinko, and payout run in a pool of worker
+# processes, each with its own database connections. These are the worker
+# side of ShardedPayday. A shard whose transaction is rolled back (say, in a
+# deadlock with another shard) is retried this many times in all, waiting
+# about this many seconds before the first retry and twice as long before each
+# one after that.
+
+SHARD_ATTEMPTS = 5
+SHARD_BACKOFF = 0.5
+
+_shard_db = None
+
+def connect_shard(connect):
+    """Given a callable that returns a postgres.Postgres instance, call it.
+
+    This runs once in each worker process.
+
+    """
+    global _shard_db
+    _shard_db = connect()
+
+
+def run_shard(args):
+    """Given (phase, shard, nshards, kw), run one shard of one phase.
+
+    Shards run concurrently, so transfers between participants in different
+    shards can deadlock. Postgres breaks deadlocks by rolling back one of the
+    transactions, in which case we start the shard's phase over, which is safe
+    for the same reasons that resuming a crashed payday is safe. We back off
+    with jitter between attempts, so that shards that deadlocked don't run
+    into each other again right away, and give up after SHARD_ATTEMPTS.
+
+    """
+    phase, shard, nshards, kw = args
+    payday = Payday(_shard_db, shard=(shard, nshards), **kw)
+    ts_start = payday.get_ts_start()
+    try:
+        for attempt in range(1, SHARD_ATTEMPTS + 1):
+            try:
+                payday.run_participant_phase(phase, ts_start)
+            except TransactionRollbackError:
+                payday.stats.flush()
+                payday.checkpoints.flush()
+                if attempt == SHARD_ATTEMPTS:
+                    log("Shard %d of %s rolled back %d times. Giving up."
+                        % (shard, phase, attempt))
+                    raise
+                delay = SHARD_BACKOFF * 2 ** (attempt - 1)
+                delay *= random.uniform(0.5, 1.5)
+                log("Shard %d of %s rolled back. Retrying in %.1f seconds."
+                    % (shard, phase, delay))
+                time.sleep(delay)
+            else:
+                return
+    finally:
+        payday.accounts.close()
+
+
 class NoPayday(Exception):
     def __str__(self):
         return "No payday found where one was expected."
@@ -93,13 +357,32 @@ class Payday(object):
 
     """
 
-    def __init__(self, db):
+    def __init__(self, db, bulk=False, nworkers=0, shard=None, log_path=None):
         """Takes a postgres.Postgres instance.
-        """
-        self.db = db
 
+        If bulk is True then the payin loop uses bulk_payin instead of payin.
+        If nworkers is greater than zero then we make calls to our payment
+        processors on up to that many threads at once (see
+        concurrent_payin and concurrent_payout). If shard is a tuple of
+        (shard, nshards) then we only work on the participants whose id
+        modulo nshards is shard (see ShardedPayday). If log_path is given then
+        per-participant log records are appended there as JSON lines instead
+        of going to stdout (see PaydayLog).
 
-    def genparticipants(self, ts_start, for_payday):
+        """
+        self.db = db
+        self.bulk = bulk
+        self.nworkers = nworkers
+        self.shard = shard
+        self.stats = PaydayStats(db)
+        self.activity = PaydayActivity(db)
+        self.progress = PaydayProgress(db)
+        self.checkpoints = PaydayCheckpoints(db)
+        self.accounts = BalancedAccounts()
+        self.records = PaydayLog(log_path)
+
+
+    def genparticipants(self, ts_start, for_payday, phase=None):
         """Generator to yield participants with tips and total.
 
         We re-fetch participants each time, because the second time through
@@ -112,11 +395,33 @@ class Payday(object):
         payout, then their new tips_and_total will be used on the re-run.
         That's okay.
 
+        We fetch tips for participants in chunks of GENPARTICIPANTS_CHUNK_SIZE
+        (see Participant.get_tips_and_totals), rather than one query per
+        participant.
+
+        We tell the progress of the current phase how many participants to
+        expect; the loops count them as they finish with each one. If phase is
+        given then we skip participants with a checkpoint for that phase (see
+        PaydayCheckpoints).
+
+        """
+        self.progress.expect(self.count_participants(ts_start, phase))
+        participants = self.get_participants(ts_start, phase=phase)
+        for chunk in chunks(participants, GENPARTICIPANTS_CHUNK_SIZE):
+            batch = Participant.get_tips_and_totals(chunk, for_payday)
+            for participant, tips, total in batch:
+                typecheck(total, Decimal)
+                yield(participant, tips, total)
+
+
+    def genteams(self, ts_start, phase=None):
+        """Generator to yield teams (plural participants) for pachinko.
         """
-        for participant in self.get_participants(ts_start):
-            tips, total = participant.get_tips_and_total(for_payday=for_payday)
-            typecheck(total, Decimal)
-            yield(participant, tips, total)
+        nteams = self.count_participants(ts_start, phase, 'plural')
+        self.progress.expect(nteams)
+        teams = self.get_participants(ts_start, phase=phase, number='plural')
+        for team in teams:
+            yield team
 
 
     def run(self):
@@ -130,14 +435,15 @@ class Payday(object):
         _start = aspen.utils.utcnow()
         log("Greetings, program! It's PAYDAY!!!!")
         ts_start = self.start()
-        self.zero_out_pending(ts_start)
-
-        self.payin(ts_start, self.genparticipants(ts_start, ts_start))
-        self.move_pending_to_balance_for_teams()
-        self.pachinko(ts_start, self.genparticipants(ts_start, ts_start))
-        self.clear_pending_to_balance()
-        self.payout(ts_start, self.genparticipants(ts_start, False))
-        self.set_nactive(ts_start)
+        self.run_phase('zero_out_pending', self.zero_out_pending, ts_start)
+        self.run_participant_phase('payin', ts_start)
+        self.run_phase( 'move_pending_to_balance_for_teams'
+                      , self.move_pending_to_balance_for_teams
+                       )
+        self.run_participant_phase('pachinko', ts_start)
+        self.run_phase('clear_pending_to_balance', self.clear_pending_to_balance)
+        self.run_participant_phase('payout', ts_start)
+        self.run_phase('set_nactive', self.set_nactive, ts_start)
 
         self.end()
 
@@ -152,6 +458,79 @@ class Payday(object):
         log(aspen.utils.to_age(_start, fmt_past=fmt_past))
 
 
+    def run_phase(self, name, func, *a):
+        """Given a phase name, a callable, and arguments, run one phase.
+
+        We flush stats and checkpoints at the end of every phase, and we track
+        the progress of each phase in payday_progress (see PaydayProgress),
+        timing the SQL statements it runs (see timing_statements). Log records
+        are flushed even if the phase crashes.
+
+        """
+        self.progress.start(name)
+        self.records.start(name)
+        try:
+            with timing_statements(self.progress):
+                out = func(*a)
+        finally:
+            self.records.finish()
+        self.stats.flush()
+        self.checkpoints.flush()
+        self.progress.finish()
+        return out
+
+
+    def run_participant_phase(self, phase, ts_start):
+        """Given 'payin', 'pachinko', or 'payout' and a datetime, run the phase.
+
+        These are the phases that loop over participants. In sharded mode the
+        phase is recorded in payday_progress with the shard number appended.
+
+        """
+        if phase == 'payin':
+            if self.bulk:
+                func = self.bulk_payin
+            elif self.nworkers:
+                func = self.concurrent_payin
+            else:
+                func = self.payin
+            participants = self.genparticipants(ts_start, ts_start, phase)
+            participants = self.prefetch_accounts(participants, will_charge)
+        elif phase == 'pachinko':
+            func = self.pachinko
+            participants = self.genteams(ts_start, phase)
+        elif phase == 'payout':
+            func = self.concurrent_payout if self.nworkers else self.payout
+            participants = self.genparticipants(ts_start, False, phase)
+            participants = self.prefetch_accounts(participants, will_credit)
+        else:
+            raise ValueError(phase)
+
+        name = phase if self.shard is None else '%s.%d' % (phase, self.shard[0])
+        return self.run_phase(name, func, ts_start, participants)
+
+
+    def prefetch_accounts(self, participants, wanted, \
+                                                ahead=ACCOUNT_PREFETCH_AHEAD):
+        """Given an iterator of (participant, tips, total) and a predicate,
+        yield the same.
+
+        We read up to ahead participants in advance, and for those that wanted
+        says we'll need to go to Balanced for we start looking up their account
+        in the background (see BalancedAccounts).
+
+        """
+        buffered = collections.deque()
+        for item in participants:
+            if wanted(*item):
+                self.accounts.prefetch(item[0].balanced_account_uri)
+            buffered.append(item)
+            if len(buffered) > ahead:
+                yield buffered.popleft()
+        while buffered:
+            yield buffered.popleft()
+
+
     def start(self):
         """Try to start a new Payday.
 
@@ -166,19 +545,30 @@ class Payday(object):
                                    "RETURNING ts_start")
             log("Starting a new payday.")
         except IntegrityError:  # Collision, we have a Payday already.
-            ts_start = self.db.one("""
-
-                SELECT ts_start
-                  FROM paydays
-                 WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
-
-            """)
+            ts_start = self.get_ts_start()
             log("Picking up with an existing payday.")
 
+            # Counts that weren't flushed before we crashed are gone, so
+            # recompute what we can from the ledger.
+            self.stats.recover(ts_start)
+            self.activity.recover(ts_start)
+
         log("Payday started at %s." % ts_start)
         return ts_start
 
 
+    def get_ts_start(self):
+        """Return the start time of the current Payday.
+        """
+        return self.db.one("""
+
+            SELECT ts_start
+              FROM paydays
+             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+
+        """, default=NoPayday)
+
+
     def zero_out_pending(self, ts_start):
         """Given a timestamp, zero out the pending column.
 
@@ -200,20 +590,82 @@ class Payday(object):
         return None
 
 
-    def get_participants(self, ts_start):
-        """Given a timestamp, return a list of participants dicts.
+    def count_participants(self, ts_start, phase=None, number=None):
+        """Given a timestamp, a phase, and a number, return an int.
+
+        This is the number of participants that get_participants will return.
+
+        """
+        return self.db.one("""\
+
+            SELECT count(*)
+              FROM participants
+             WHERE {}
+
+        """.format(PARTICIPANTS_FILTER), self.filter_params(ts_start, phase,
+                                                            number))
+
+
+    def get_participants(self, ts_start, fetch_size=PARTICIPANTS_FETCH_SIZE,
+                                                       phase=None, number=None):
+        """Given a timestamp, return an iterator of participants.
+
+        We run the query against a named (server-side) cursor and then stream
+        the results fetch_size rows at a time, so that memory use stays flat
+        no matter how many participants we have. The participants we yield
+        only have the attributes in PARTICIPANT_COLUMNS. If phase is given
+        then we skip participants with a checkpoint for that phase in the
+        current payday. If number is given ('singular' or 'plural') then we
+        only return participants of that number.
+
         """
         PARTICIPANTS = """\
-            SELECT participants.*::participants
+            SELECT {}
               FROM participants
-             WHERE claimed_time IS NOT NULL
-               AND claimed_time < %s
-               AND is_suspicious IS NOT true
+             WHERE {}
           ORDER BY claimed_time ASC
-        """
-        participants = self.db.all(PARTICIPANTS, (ts_start,))
+        """.format(', '.join(PARTICIPANT_COLUMNS), PARTICIPANTS_FILTER)
+
+        context = self.db.get_cursor(b'payday_participants', back_as=dict)
+        cursor = context.__enter__()
+        try:
+            cursor.itersize = fetch_size
+            cursor.execute( PARTICIPANTS
+                          , self.filter_params(ts_start, phase, number)
+                           )
+        except:
+            context.__exit__(*sys.exc_info())
+            raise
         log("Fetched participants.")
-        return participants
+        return self._stream_participants(context, cursor)
+
+
+    def filter_params(self, ts_start, phase, number=None):
+        """Given a datetime, a phase, and a number, return a dict.
+
+        These are the parameters for PARTICIPANTS_FILTER.
+
+        """
+        shard, nshards = self.shard or (None, None)
+        return { 'ts_start': ts_start
+               , 'phase': phase
+               , 'number': number
+               , 'shard': shard
+               , 'nshards': nshards
+                }
+
+
+    def _stream_participants(self, context, cursor):
+        """Yield participants from a named cursor, then clean up after it.
+        """
+        try:
+            for rec in cursor:
+                yield participant_from_record(rec)
+        except:
+            context.__exit__(*sys.exc_info())
+            raise
+        else:
+            context.__exit__(None, None, None)
 
 
     def payin(self, ts_start, participants):
@@ -225,43 +677,158 @@ class Payday(object):
             if i % 100 == 0:
                 log("Payin done for %d participants." % i)
             self.charge_and_or_transfer(ts_start, participant, tips, total)
+            self.checkpoints.add('payin', participant)
+            self.progress.tick()
+        log("Did payin for %d participants." % i)
+
+
+    def concurrent_payin(self, ts_start, participants, \
+                                                    window=CONCURRENT_WINDOW):
+        """Given a datetime and an iterator, do the payin side of Payday.
+
+        This has the same results as payin, but for each window of
+        participants we first make all of the credit card charges that are
+        needed (see charge_many), and only then do we transfer money for each
+        participant in turn.
+
+        """
+        i = 0
+        log("Starting concurrent payin loop.")
+        for chunk in chunks(participants, window):
+            shorts = [(participant, total - participant.balance)
+                      for participant, tips, total in chunk]
+            self.charge_many([(p, short) for p, short in shorts if short > 0])
+            for participant, tips, total in chunk:
+                self.transfer_tips(ts_start, participant, tips)
+                self.checkpoints.add('payin', participant)
+                self.progress.tick()
+            i += len(chunk)
+            log("Payin done for %d participants." % i)
+        log("Did payin for %d participants." % i)
+
+
+    def bulk_payin(self, ts_start, participants, chunk_size=BULK_CHUNK_SIZE):
+        """Given a datetime and an iterator, do the payin side of Payday in bulk.
+
+        This has the same results as payin, but instead of using one
+        transaction per tip we work through participants in chunks. For each
+        chunk we charge credit cards as needed (one at a time, as in payin),
+        and then we compute fundable transfers in memory and write them all in
+        one transaction with a handful of set-based statements.
+
+        This is safe because during payin a participant's balance is only ever
+        changed by their own charge and their own tips: transfers credit the
+        tippee's *pending* column, not balance.
+
+        """
+        i = 0
+        chunk = []
+        log("Starting bulk payin loop.")
+        for i, (participant, tips, total) in enumerate(participants, start=1):
+            chunk.append((participant, tips, total))
+            if len(chunk) == chunk_size:
+                self.bulk_charge_and_or_transfer(ts_start, chunk)
+                self.checkpoints.add_many('payin', [c[0] for c in chunk])
+                self.progress.tick(len(chunk))
+                chunk = []
+                log("Payin done for %d participants." % i)
+        if chunk:
+            self.bulk_charge_and_or_transfer(ts_start, chunk)
+            self.checkpoints.add_many('payin', [c[0] for c in chunk])
+            self.progress.tick(len(chunk))
         log("Did payin for %d participants." % i)
 
 
-    def pachinko(self, ts_start, participants):
+    def pachinko(self, ts_start, teams):
+        """Given a datetime and an iterator of teams, do pachinko.
+
+        Pachinko distributes each team's balance to its members: members get
+        their take, most recent member first, until the team's balance runs
+        out. We load all memberships in one query up front (get_memberships),
+        compute each team's distribution in memory (compute_pachinko), and
+        write each team's transfers in one transaction (apply_pachinko).
+
+        """
         i = 0
-        for i, (participant, foo, bar) in enumerate(participants, start=1):
+        memberships = self.get_memberships()
+        for i, team in enumerate(teams, start=1):
             if i % 100 == 0:
-                log("Pachinko done for %d participants." % i)
-            if participant.number != 'plural':
-                continue
+                log("Pachinko done for %d teams." % i)
+            members = memberships.get(team.username, [])
+            transfers = self.compute_pachinko(team, members)
+            self.apply_pachinko(team, transfers)
+            self.progress.tick()
+        log("Did pachinko for %d teams." % i)
 
-            available = participant.balance
-            log("Pachinko out from %s with $%s." % ( participant.username
-                                                   , available
-                                                    ))
-
-            def tip(member, amount):
-                tip = {}
-                tip['tipper'] = participant.username
-                tip['tippee'] = member['username']
-                tip['amount'] = amount
-                tip['claimed_time'] = ts_start
-                self.tip( participant
-                        , tip
-                        , ts_start
-                        , pachinko=True
-                         )
-                return tip['amount']
 
-            for member in participant.get_members():
-                amount = min(member['take'], available)
+    def get_memberships(self):
+        """Return a dict of team username to a list of member dicts.
+
+        The member dicts are the same as what Participant.get_members returns.
+
+        """
+        memberships = {}
+        for rec in self.db.all("""\
+
+            SELECT team, member AS username, take, ctime, mtime
+              FROM current_memberships
+          ORDER BY team, ctime DESC
+
+        """, back_as=dict):
+            memberships.setdefault(rec.pop('team'), []).append(rec)
+        return memberships
+
+
+    def compute_pachinko(self, team, members):
+        """Given a team and a list of member dicts, return a list of transfers.
+
+        Transfers are (team, member, amount) tuples.
+
+        """
+        available = team.balance
+        self.records.add( 'pachinko'
+                        , 'START'
+                        , "Pachinko out from %s with $%s."
+                          % (team.username, available)
+                        , team=team.username
+                        , amount=available
+                         )
+        transfers = []
+        for member in members:
+            amount = min(member['take'], available)
+            if amount > 0:
                 available -= amount
-                tip(member, amount)
-                if available == 0:
-                    break
+                transfers.append((team.username, member['username'], amount))
+            if available == 0:
+                break
+        return transfers
+
+
+    def apply_pachinko(self, team, transfers):
+        """Given a team and a list of transfers, return None.
 
-        log("Did pachinko for %d participants." % i)
+        We write all of the team's transfers and its pachinko checkpoint in
+        one transaction. If the team can't cover the transfers (its balance
+        changed since we computed them) then we log that and move on, as for
+        any other failed transfer.
+
+        """
+        try:
+            with self.db.get_cursor() as cursor:
+                self.apply_transfers(cursor, transfers, context='take')
+                self.checkpoints.write(cursor, 'pachinko', [team])
+        except IntegrityError:
+            self.records.add( 'pachinko'
+                            , 'FAILURE'
+                            , "FAILURE: Pachinko out from %s." % team.username
+                            , team=team.username
+                             )
+            return
+
+        self.activity.add(transfers)
+        for tipper, tippee, amount in transfers:
+            self.mark_pachinko(amount)
+            self.log_transfer('SUCCESS', tipper, tippee, amount, True)
 
 
     def payout(self, ts_start, participants):
@@ -273,6 +840,47 @@ class Payday(object):
             if i % 100 == 0:
                 log("Payout done for %d participants." % i)
             self.ach_credit(ts_start, participant, tips, total)
+            self.checkpoints.add('payout', participant)
+            self.progress.tick()
+        log("Did payout for %d participants." % i)
+
+
+    def concurrent_payout(self, ts_start, participants, \
+                                                    window=CONCURRENT_WINDOW):
+        """Given a datetime and an iterator, do the payout side of Payday.
+
+        This has the same results as payout, but for each window of
+        participants the calls to Balanced are made on up to self.nworkers
+        threads at once. Results are recorded serially, in participant order.
+
+        """
+        i = 0
+        log("Starting concurrent payout loop.")
+        for chunk in chunks(participants, window):
+            credits = [self.prepare_credit(participant, total)
+                       for participant, tips, total in chunk]
+            credits = [credit for credit in credits if credit is not None]
+            outcomes = self.call_processor( self.credit_on_balanced
+                                          , [c[:2] + c[4:] for c in credits]
+                                           )
+            for credit, (error, exc_info) in zip(credits, outcomes):
+                if exc_info is not None:
+                    continue  # Leave the intent for the reconciler.
+                username, _, credit_amount, fee, _, _, intent = credit
+                if error is None:
+                    self.void_intent(intent)
+                else:
+                    self.record_credit( credit_amount
+                                      , fee
+                                      , error
+                                      , username
+                                      , intent=intent
+                                       )
+            reraise_first(outcomes)
+            self.checkpoints.add_many('payout', [c[0] for c in chunk])
+            self.progress.tick(len(chunk))
+            i += len(chunk)
+            log("Payout done for %d participants." % i)
         log("Did payout for %d participants." % i)
 
 
@@ -295,6 +903,12 @@ class Payday(object):
 
             self.charge(participant, short)
 
+        self.transfer_tips(ts_start, participant, tips)
+
+
+    def transfer_tips(self, ts_start, participant, tips):
+        """Given one participant record, transfer money for their tips.
+        """
         nsuccessful_tips = 0
         for tip in tips:
             result = self.tip(participant, tip, ts_start)
@@ -306,6 +920,234 @@ class Payday(object):
         self.mark_participant(nsuccessful_tips)
 
 
+    def bulk_charge_and_or_transfer(self, ts_start, chunk):
+        """Given a datetime and a list of (participant, tips, total), pay their day.
+
+        Charges are committed one at a time, as in charge_and_or_transfer.
+        Then we lock and re-read the chunk's balances, compute transfers in
+        memory, and apply them all in a single transaction.
+
+        We lock everyone the chunk can touch, tippers and tippees, in one
+        statement ordered by username, before reading any balances. If we
+        locked the tippers first and the tippees later, two shards could each
+        hold a tipper the other one is waiting to credit.
+
+        """
+        shorts = [(participant, total - participant.balance)
+                  for participant, tips, total in chunk]
+        self.charge_many([(p, short) for p, short in shorts if short > 0])
+
+        with self.db.get_cursor() as cursor:
+            usernames = set()
+            for participant, tips, _ in chunk:
+                usernames.add(participant.username)
+                usernames.update(tip['tippee'] for tip in tips)
+            balances = self.lock_participants(cursor, usernames)
+
+            transfers = []
+            ntippers = ntips = 0
+            for participant, tips, total in chunk:
+                balance = balances[participant.username]
+                fundable = self.compute_transfers( ts_start
+                                                 , participant
+                                                 , balance
+                                                 , tips
+                                                  )
+                transfers.extend(fundable)
+                ntippers += 1 if fundable else 0
+                ntips += len(fundable)
+
+            self.apply_transfers(cursor, transfers, lock=False)
+
+        self.mark_bulk_payin(len(chunk), ntippers, ntips, transfers)
+        self.activity.add(transfers)
+
+        for tipper, tippee, amount in transfers:
+            self.log_transfer('SUCCESS', tipper, tippee, amount)
+
+
+    def compute_transfers(self, ts_start, participant, balance, tips):
+        """Given a datetime, a participant, a Decimal, and a list, return a list.
+
+        This is the in-memory equivalent of calling tip for each of tips in
+        turn: zero tips are ignored, tips to participants who hadn't claimed
+        their account when payday started are skipped, and we stop at the first
+        tip that balance can't cover. The return value is a list of (tipper,
+        tippee, amount) tuples for the tips that are fundable.
+
+        """
+        out = []
+        for tip in tips:
+            amount = tip['amount']
+            if amount == 0:
+                continue
+            claimed_time = tip['claimed_time']
+            if claimed_time is None or claimed_time > ts_start:
+                self.log_transfer( 'SKIPPED'
+                                 , participant.username
+                                 , tip['tippee']
+                                 , amount
+                                  )
+                continue
+            if amount > balance:
+                self.log_transfer( 'FAILURE'
+                                 , participant.username
+                                 , tip['tippee']
+                                 , amount
+                                  )
+                break
+            balance -= amount
+            out.append((participant.username, tip['tippee'], amount))
+        return out
+
+
+    def lock_participants(self, cursor, usernames):
+        """Given a cursor and some usernames, lock them and return balances.
+
+        The rows are locked in username order, so that concurrent batches
+        (say, in different shards) take their locks in the same order and
+        don't deadlock. The return value is a dict of username to balance.
+
+        """
+        return dict(cursor.all("""\
+
+            SELECT username, balance
+              FROM participants
+             WHERE username = ANY(%s)
+          ORDER BY username
+               FOR UPDATE
+
+        """, (sorted(usernames),)))
+
+
+    def apply_transfers(self, cursor, transfers, lock=True, context='tip'):
+        """Given a cursor and a list of (tipper, tippee, amount), return None.
+
+        We write all the transfers at once, and then debit tippers' balances
+        and credit tippees' pending columns with one UPDATE each. Batches of
+        COPY_MIN_TRANSFERS or more are loaded with COPY (see copy_transfers).
+
+        Before any of that we lock everyone involved (see lock_participants).
+        The UPDATEs join against participants in whatever order the planner
+        likes, so we can't rely on them for that. Pass lock=False if you've
+        already locked all of them in this transaction, in the same single
+        statement. The transfers are recorded with the given context, 'tip' or
+        'take' (for pachinko).
+
+        """
+        if not transfers:
+            return
+
+        debits, credits = {}, {}
+        for tipper, tippee, amount in transfers:
+            debits[tipper] = debits.get(tipper, 0) + amount
+            credits[tippee] = credits.get(tippee, 0) + amount
+
+        if lock:
+            self.lock_participants(cursor, set(debits) | set(credits))
+
+        if len(transfers) >= COPY_MIN_TRANSFERS:
+            self.copy_transfers(cursor, transfers, context)
+            debits_from = """\
+                (SELECT tipper, sum(amount)
+                   FROM transfers_staged
+               GROUP BY tipper
+                )"""
+            credits_from = """\
+                (SELECT tippee, sum(amount)
+                   FROM transfers_staged
+               GROUP BY tippee
+                )"""
+        else:
+            def values(rows):
+                return "(VALUES %s)" % ', '.join(
+                    [cursor.mogrify("(%s, %s)", row).decode('UTF-8')
+                     for row in rows])
+
+            cursor.execute("""\
+
+                INSERT INTO transfers
+                            (tipper, tippee, amount, context)
+                     VALUES %s
+
+            """ % ', '.join([ cursor.mogrify( "(%s, %s, %s, %s)"
+                                            , (tipper, tippee, amount, context)
+                                             ).decode('UTF-8')
+                              for tipper, tippee, amount in transfers
+                             ]))
+            debits_from = values(debits.items())
+            credits_from = values(credits.items())
+
+        # These will fail with IntegrityError if a balance goes below zero,
+        # which would roll back the whole chunk.
+        cursor.execute("""\
+
+            UPDATE participants p
+               SET balance=(p.balance - d.amount)
+              FROM %s AS d (username, amount)
+             WHERE p.username=d.username
+               AND p.pending IS NOT NULL
+
+        """ % debits_from)
+        assert cursor.rowcount == len(debits), debits  # sanity check
+
+        cursor.execute("""\
+
+            UPDATE participants p
+               SET pending=(p.pending + c.amount)
+              FROM %s AS c (username, amount)
+             WHERE p.username=c.username
+               AND p.pending IS NOT NULL
+
+        """ % credits_from)
+        assert cursor.rowcount == len(credits), credits  # sanity check
+
+
+    def copy_transfers(self, cursor, transfers, context='tip'):
+        """Given a cursor, a list of (tipper, tippee, amount), and a context,
+        return None.
+
+        We COPY the transfers into transfers_staged, a temporary table that's
+        emptied when the transaction commits, and insert them into transfers
+        from there. apply_transfers then computes the balance updates from the
+        staged rows. Parsing one COPY stream is much cheaper for Postgres than
+        parsing a multi-row INSERT.
+
+        """
+        cursor.execute("""\
+
+            CREATE TEMP TABLE IF NOT EXISTS transfers_staged
+            ( tipper    text            NOT NULL
+            , tippee    text            NOT NULL
+            , amount    numeric(35,2)   NOT NULL
+             ) ON COMMIT DELETE ROWS
+
+        """)
+        cursor.execute("TRUNCATE transfers_staged")
+
+        data = StringIO()
+        writer = csv.writer(data)
+        for tipper, tippee, amount in transfers:
+            writer.writerow([ tipper.encode('UTF-8')
+                            , tippee.encode('UTF-8')
+                            , str(amount)
+                             ])
+        data.seek(0)
+        cursor.copy_expert( "COPY transfers_staged (tipper, tippee, amount) "
+                            "FROM STDIN WITH CSV"
+                          , data
+                           )
+
+        cursor.execute("""\
+
+            INSERT INTO transfers
+                        (tipper, tippee, amount, context)
+                 SELECT tipper, tippee, amount, %s::transfer_context
+                   FROM transfers_staged
+
+        """, (context,))
+
+
     def move_pending_to_balance_for_teams(self):
         """Transfer pending into balance for teams.
 
@@ -351,29 +1193,69 @@ class Payday(object):
 
 
     def set_nactive(self, ts_start):
-        self.db.run("""\
-
-            UPDATE paydays
-               SET nactive=(
-                    SELECT count(DISTINCT foo.*) FROM (
-                        SELECT tipper FROM transfers WHERE "timestamp" >= %(ts_start)s
-                            UNION
-                        SELECT tippee FROM transfers WHERE "timestamp" >= %(ts_start)s
-                    ) AS foo
-                )
-             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+        """Store counts of who gave and received money on the paydays row.
 
-        """, {'ts_start': ts_start})
+        We used to count distinct tippers and tippees in transfers since
+        ts_start here. Now self.activity collects them as transfers are made
+        (see PaydayActivity), so we only have to write the counts.
 
-    def end(self):
+        """
         self.db.one("""\
 
             UPDATE paydays
-               SET ts_end=now()
+               SET nactive=%(nactive)s
+                 , ngivers=%(ngivers)s
+                 , nreceivers=%(nreceivers)s
+                 , noverlap=%(noverlap)s
              WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
          RETURNING id
 
-        """, default=NoPayday)
+        """, self.activity.counts(), default=NoPayday)
+
+    def end(self):
+        self.accounts.close()
+        self.stats.flush()
+        with self.db.get_cursor() as cursor:
+            payday = cursor.one("""\
+
+                UPDATE paydays
+                   SET ts_end=now()
+                 WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+             RETURNING id
+
+            """, default=NoPayday)
+            self.checkpoints.clear(cursor, payday)
+            self.snapshot_balances(cursor, payday)
+
+
+    def snapshot_balances(self, cursor, payday):
+        """Given a cursor and a payday id, return None.
+
+        We record the balance at the end of this payday of each participant
+        whose balance payday changed, in balance_snapshots. The participants
+        payday touched are in self.activity, and of those we skip anyone whose
+        balance is the same as in their last snapshot.
+
+        """
+        usernames = sorted(self.activity.touched())
+        if not usernames:
+            return
+        cursor.run("""\
+
+            INSERT INTO balance_snapshots
+                        (payday, participant, balance)
+                 SELECT %s, p.username, p.balance
+                   FROM participants p
+                  WHERE p.username = ANY(%s)
+                    AND p.balance IS DISTINCT FROM (
+                            SELECT s.balance
+                              FROM balance_snapshots s
+                             WHERE s.participant = p.username
+                          ORDER BY s.payday DESC
+                             LIMIT 1
+                        )
+
+        """, (payday, usernames))
 
 
     # Move money between Gittip participants.
@@ -389,12 +1271,12 @@ class Payday(object):
             -1 if transfer fails and we cannot continue
 
         """
-        msg = "$%s from %s to %s%s."
-        msg %= ( tip['amount']
-               , participant.username
-               , tip['tippee']
-               , " (pachinko)" if pachinko else ""
-                )
+        log_transfer = lambda status: self.log_transfer( status
+                                                       , participant.username
+                                                       , tip['tippee']
+                                                       , tip['amount']
+                                                       , pachinko
+                                                        )
 
         if tip['amount'] == 0:
 
@@ -412,7 +1294,7 @@ class Payday(object):
             # behalf if they opted-in by claiming their account before the
             # start of this payday.
 
-            log("SKIPPED: %s" % msg)
+            log_transfer('SKIPPED')
             return 0
 
         if not self.transfer(participant.username, tip['tippee'], \
@@ -421,10 +1303,10 @@ class Payday(object):
             # The transfer failed due to a lack of funds for the participant.
             # Don't try any further transfers.
 
-            log("FAILURE: %s" % msg)
+            log_transfer('FAILURE')
             return -1
 
-        log("SUCCESS: %s" % msg)
+        log_transfer('SUCCESS')
         return 1
 
 
@@ -449,13 +1331,16 @@ class Payday(object):
                 return False
 
             self.credit_participant(cursor, tippee, amount)
-            self.record_transfer(cursor, tipper, tippee, amount)
-            if pachinko:
-                self.mark_pachinko(cursor, amount)
-            else:
-                self.mark_transfer(cursor, amount)
+            context = 'take' if pachinko else 'tip'
+            self.record_transfer(cursor, tipper, tippee, amount, context)
+
+        self.activity.add([(tipper, tippee, amount)])
+        if pachinko:
+            self.mark_pachinko(amount)
+        else:
+            self.mark_transfer(amount)
 
-            return True
+        return True
 
 
     def debit_participant(self, cursor, participant, amount):
@@ -512,6 +1397,68 @@ class Payday(object):
         should be the nominal amount. We'll compute Gittip's fee below this
         function and add it to amount to end up with charge_amount.
 
+        """
+        self.charge_many([(participant, amount)])
+
+
+    def charge_many(self, charges):
+        """Given a list of (participant, Decimal), return None.
+
+        This is charge for many participants at once. The calls to Balanced
+        and Stripe are made on up to self.nworkers threads at once, but the
+        results are recorded in the db serially, in the order given. If any
+        call raises we still record all of the results we got before
+        re-raising, so that a crash here leaves us no worse off than a crash
+        in the serial case.
+
+        """
+        hits = []
+        for participant, amount in charges:
+            hit = self.prepare_charge(participant, amount)
+            if hit is not None:
+                hits.append(hit)
+
+        outcomes = self.call_processor(lambda method, *a: method(*a), hits)
+
+        for hit, (things, exc_info) in zip(hits, outcomes):
+            if exc_info is not None:
+                continue
+            charge_amount, fee, error = things
+            amount = charge_amount - fee  # account for possible rounding under
+                                          # charge_on_*
+            self.record_charge( amount
+                              , charge_amount
+                              , fee
+                              , error
+                              , hit[1]
+                              , intent=hit[4]
+                               )
+
+        reraise_first(outcomes)
+
+
+    def call_processor(self, func, args_list):
+        """Given a callable and a list of argument tuples, return outcomes.
+
+        This is call_concurrently with our number of workers, timed as
+        processor time for the current phase.
+
+        """
+        _start = time.time()
+        outcomes = call_concurrently(func, args_list, self.nworkers)
+        self.progress.add_processor_time(time.time() - _start)
+        return outcomes
+
+
+    def prepare_charge(self, participant, amount):
+        """Given dict and Decimal, return a tuple or None.
+
+        We return None if we shouldn't charge this participant. Otherwise we
+        return a tuple of (method, username, id, amount, intent), where method
+        is charge_on_balanced or charge_on_stripe and the rest are its
+        arguments. Intent is the id of the exchange_intents row we open here,
+        before going to the processor (see open_intent).
+
         """
         typecheck(participant, Participant, amount, Decimal)
 
@@ -540,31 +1487,61 @@ class Payday(object):
         # =========================
 
         if balanced_account_uri is not None:
-            things = self.charge_on_balanced( username
-                                            , balanced_account_uri
-                                            , amount
-                                             )
-            charge_amount, fee, error = things
+            method, processor, route = ( self.charge_on_balanced
+                                       , 'balanced'
+                                       , balanced_account_uri
+                                        )
         else:
             assert stripe_customer_id is not None
-            things = self.charge_on_stripe( username
-                                          , stripe_customer_id
-                                          , amount
-                                           )
-            charge_amount, fee, error = things
+            method, processor, route = ( self.charge_on_stripe
+                                       , 'stripe'
+                                       , stripe_customer_id
+                                        )
 
-        amount = charge_amount - fee  # account for possible rounding under
-                                      # charge_on_*
+        cents, msg, charge_amount, fee = self._prep_hit(amount)
+        intent = self.open_intent( username
+                                 , 'charge'
+                                 , processor
+                                 , route
+                                 , charge_amount - fee
+                                 , fee
+                                  )
+        if intent is None:
+            return      # Participant has an unresolved charge.
 
-        self.record_charge( amount
-                          , charge_amount
-                          , fee
-                          , error
-                          , username
-                           )
+        return (method, username, route, amount, intent)
 
 
     def ach_credit(self, ts_start, participant, tips, total):
+        credit = self.prepare_credit(participant, total)
+        if credit is None:
+            return
+        username, balanced_account_uri, credit_amount, fee, cents, msg, \
+                                                                intent = credit
+        _start = time.time()
+        error = self.credit_on_balanced(username, balanced_account_uri, \
+                                                            cents, msg, intent)
+        self.progress.add_processor_time(time.time() - _start)
+        if error is None:
+            self.void_intent(intent)
+        else:
+            self.record_credit( credit_amount
+                              , fee
+                              , error
+                              , username
+                              , intent=intent
+                               )
+
+
+    def prepare_credit(self, participant, total):
+        """Given dict and Decimal, return a tuple or None.
+
+        We return None if we shouldn't credit this participant. Otherwise we
+        return a tuple of (username, balanced_account_uri, credit_amount, fee,
+        cents, msg, intent), where intent is the id of the exchange_intents row
+        we open here (see open_intent).
+
+        """
 
         # Compute the amount to credit them.
         # ==================================
@@ -587,8 +1564,17 @@ class Payday(object):
             if total > 0:
                 also_log = " ($%s balance - $%s in obligations)"
                 also_log %= (balance, total)
-            log("Minimum payout is $%s. %s is only due $%s%s."
-               % (MINIMUM_CREDIT, participant.username, amount, also_log))
+            self.records.add( 'credit'
+                            , 'SKIPPED'
+                            , "Minimum payout is $%s. %s is only due $%s%s."
+                              % ( MINIMUM_CREDIT
+                                , participant.username
+                                , amount
+                                , also_log
+                                 )
+                            , participant=participant.username
+                            , amount=amount
+                             )
             return      # Participant owed too little.
 
         if not is_whitelisted(participant):
@@ -609,35 +1595,66 @@ class Payday(object):
         msg = "Crediting %s %d cents (%s - $%s fee = $%s) on Balanced ... "
         msg %= (participant.username, cents, also_log, fee, credit_amount)
 
+        balanced_account_uri = participant.balanced_account_uri
+        if balanced_account_uri is None:
+            self.records.add( 'credit'
+                            , 'SKIPPED'
+                            , "%s has no balanced_account_uri."
+                              % participant.username
+                            , participant=participant.username
+                             )
+            return  # not in Balanced
+
+        intent = self.open_intent( participant.username
+                                 , 'credit'
+                                 , 'balanced'
+                                 , balanced_account_uri
+                                 , -credit_amount
+                                 , fee
+                                  )
+        if intent is None:
+            return  # has an unresolved credit
+
+        return ( participant.username
+               , balanced_account_uri
+               , credit_amount
+               , fee
+               , cents
+               , msg
+               , intent
+                )
 
-        # Try to dance with Balanced.
-        # ===========================
 
-        try:
+    def credit_on_balanced(self, username, balanced_account_uri, cents, msg,
+                           intent=None):
+        """We have a purported balanced_account_uri. Try to use it.
 
-            balanced_account_uri = participant.balanced_account_uri
-            if balanced_account_uri is None:
-                log("%s has no balanced_account_uri."
-                    % participant.username)
-                return  # not in Balanced
+        We return None if the account isn't a merchant (in which case there's
+        nothing to record), otherwise an error message, empty on success.
 
-            account = balanced.Account.find(balanced_account_uri)
+        """
+        try:
+            account = self.accounts.find(balanced_account_uri)
             if 'merchant' not in account.roles:
-                log("%s is not a merchant." % participant.username)
+                self.records.add( 'credit'
+                                , 'SKIPPED'
+                                , "%s is not a merchant." % username
+                                , participant=username
+                                 )
                 return  # not a merchant
 
-            account.credit(cents)
+            account.credit(cents, meta=intent_meta(intent))
 
             error = ""
-            log(msg + "succeeded.")
         except balanced.exc.HTTPError as err:
             error = err.message
-            log(msg + "failed: %s" % error)
 
-        self.record_credit(credit_amount, fee, error, participant.username)
+        self.log_exchange('credit', username, msg, error, cents, intent)
+        return error
 
 
-    def charge_on_balanced(self, username, balanced_account_uri, amount):
+    def charge_on_balanced(self, username, balanced_account_uri, amount,
+                           intent=None):
         """We have a purported balanced_account_uri. Try to use it.
         """
         typecheck( username, unicode
@@ -649,18 +1666,21 @@ class Payday(object):
         msg = msg % (username, "Balanced")
 
         try:
-            customer = balanced.Account.find(balanced_account_uri)
-            customer.debit(cents, description=username)
-            log(msg + "succeeded.")
+            customer = self.accounts.find(balanced_account_uri)
+            customer.debit( cents
+                          , description=username
+                          , meta=intent_meta(intent)
+                           )
             error = ""
         except balanced.exc.HTTPError as err:
             error = err.message
-            log(msg + "failed: %s" % error)
 
+        self.log_exchange('charge', username, msg, error, cents, intent)
         return charge_amount, fee, error
 
 
-    def charge_on_stripe(self, username, stripe_customer_id, amount):
+    def charge_on_stripe(self, username, stripe_customer_id, amount,
+                         intent=None):
         """We have a purported stripe_customer_id. Try to use it.
         """
         typecheck( username, unicode
@@ -676,13 +1696,13 @@ class Payday(object):
                                 , amount=cents
                                 , description=username
                                 , currency="USD"
+                                , metadata=intent_meta(intent)
                                  )
-            log(msg + "succeeded.")
             error = ""
         except stripe.StripeError, err:
             error = err.message
-            log(msg + "failed: %s" % error)
 
+        self.log_exchange('charge', username, msg, error, cents, intent)
         return charge_amount, fee, error
 
 
@@ -718,34 +1738,95 @@ class Payday(object):
     # Record-keeping.
     # ===============
 
-    def record_charge(self, amount, charge_amount, fee, error, username):
-        """Given a Bunch of Stuff, return None.
+    def open_intent(self, username, kind, processor, route, amount, fee):
+        """Given a Bunch of Stuff, return an int or None.
 
-        This function takes the result of an API call to a payment processor
-        and records the result in our db. If the power goes out at this point
-        then Postgres will be out of sync with the payment processor. We'll
-        have to resolve that manually be reviewing the transaction log at the
-        processor and modifying Postgres accordingly.
+        Before we ask Balanced or Stripe to move money we write down what
+        we're about to do, as a pending row in exchange_intents, and we pass
+        its id through to the processor (see intent_meta). The row is resolved
+        in the same transaction that records the result (record_charge and
+        record_credit). If we crash in between, gittip.billing.reconciler
+        looks the intent up at the processor and finishes the job.
+
+        There can only be one pending intent per participant and kind. If
+        there's one already we return None, and we skip the participant until
+        the reconciler has resolved it. That way rerunning payday after a
+        crash never charges or credits anyone twice.
+
+        """
+        try:
+            return self.db.one("""
+                INSERT INTO exchange_intents
+                            (participant, kind, processor, route, amount, fee)
+                     VALUES (%s, %s, %s, %s, %s, %s)
+                  RETURNING id
+
+            """, (username, kind, processor, route, amount, fee))
+        except IntegrityError:
+            self.records.add( kind
+                            , 'SKIPPED'
+                            , "%s has an unresolved %s. Leaving it for the "
+                              "reconciler." % (username, kind)
+                            , participant=username
+                             )
+            return None
+
+
+    def resolve_intent(self, cursor, intent, status, error=None):
+        """Given a cursor, an int, and a status, return a boolean.
+
+        We return False if the intent was already resolved (by the
+        reconciler), in which case there's nothing more to record.
+
+        """
+        return cursor.one("""
+            UPDATE exchange_intents
+               SET status=%s
+                 , error=%s
+                 , mtime=CURRENT_TIMESTAMP
+             WHERE id=%s
+               AND status='pending'
+         RETURNING id
+
+        """, (status, error, intent)) is not None
+
+
+    def void_intent(self, intent):
+        """Given an int, return None.
+
+        This is for when we didn't end up going to the processor after all.
+
+        """
+        if intent is None:
+            return
+        with self.db.get_cursor() as cursor:
+            self.resolve_intent(cursor, intent, 'void')
 
-        For Balanced, this could be automated by generating an ID locally and
-        commiting that to the db and then passing that through in the meta
-        field.* Then syncing would be a case of simply:
 
-            for payment in unresolved_payments:
-                payment_in_balanced = balanced.Transaction.query.filter(
-                  **{'meta.unique_id': 'value'}).one()
-                payment.transaction_uri = payment_in_balanced.uri
+    def record_charge(self, amount, charge_amount, fee, error, username,
+                      intent=None):
+        """Given a Bunch of Stuff, return None.
 
-        * https://www.balancedpayments.com/docs/meta
+        This function takes the result of an API call to a payment processor
+        and records the result in our db, resolving the exchange intent we
+        opened beforehand (see open_intent) in the same transaction. If the
+        power goes out before we get here, the intent stays pending and
+        gittip.billing.reconciler syncs us up with the processor.
 
         """
 
         with self.db.get_cursor() as cursor:
 
+            if intent is not None:
+                status = 'failed' if error else 'succeeded'
+                if not self.resolve_intent(cursor, intent, status, error):
+                    log("Exchange intent %d was already resolved." % intent)
+                    return
+
             if error:
                 last_bill_result = error
                 amount = Decimal('0.00')
-                self.mark_charge_failed(cursor)
+                self.mark_charge_failed()
             else:
                 last_bill_result = ''
                 EXCHANGE = """\
@@ -756,7 +1837,8 @@ class Payday(object):
 
                 """
                 cursor.execute(EXCHANGE, (amount, fee, username))
-                self.mark_charge_success(cursor, charge_amount, fee)
+                self.mark_charge_success(charge_amount, fee)
+                self.activity.touch(username)
 
 
             # Update the participant's balance.
@@ -774,7 +1856,7 @@ class Payday(object):
             cursor.execute(RESULT, (last_bill_result, amount, username))
 
 
-    def record_credit(self, amount, fee, error, username):
+    def record_credit(self, amount, fee, error, username, intent=None):
         """Given a Bunch of Stuff, return None.
 
         Records in the exchanges table for credits have these characteristics:
@@ -792,10 +1874,16 @@ class Payday(object):
 
         with self.db.get_cursor() as cursor:
 
+            if intent is not None:
+                status = 'failed' if error else 'succeeded'
+                if not self.resolve_intent(cursor, intent, status, error):
+                    log("Exchange intent %d was already resolved." % intent)
+                    return
+
             if error:
                 last_ach_result = error
                 credit = fee = Decimal('0.00')  # ensures balance won't change
-                self.mark_ach_failed(cursor)
+                self.mark_ach_failed()
             else:
                 last_ach_result = ''
                 EXCHANGE = """\
@@ -806,7 +1894,8 @@ class Payday(object):
 
                 """
                 cursor.execute(EXCHANGE, (credit, fee, username))
-                self.mark_ach_success(cursor, amount, fee)
+                self.mark_ach_success(amount, fee)
+                self.activity.touch(username)
 
 
             # Update the participant's balance.
@@ -826,111 +1915,881 @@ class Payday(object):
                                     ))
 
 
-    def record_transfer(self, cursor, tipper, tippee, amount):
+    def log_transfer(self, status, tipper, tippee, amount, pachinko=False):
+        """Given a status, two unicodes, a Decimal, and a boolean, log a tip.
+        """
+        msg = "%s: $%s from %s to %s%s."
+        msg %= ( status
+               , amount
+               , tipper
+               , tippee
+               , " (pachinko)" if pachinko else ""
+                )
+        self.records.add( 'transfer'
+                        , status
+                        , msg
+                        , tipper=tipper
+                        , tippee=tippee
+                        , amount=amount
+                        , pachinko=pachinko
+                         )
+
+
+    def log_exchange(self, kind, username, msg, error, cents, intent):
+        """Given the outcome of a call to a payment processor, log it.
+        """
+        msg += "failed: %s" % error if error else "succeeded."
+        self.records.add( kind
+                        , 'FAILURE' if error else 'SUCCESS'
+                        , msg
+                        , participant=username
+                        , cents=cents
+                        , error=error
+                        , intent=intent
+                         )
+
+
+    def record_transfer(self, cursor, tipper, tippee, amount, context='tip'):
         cursor.run("""\
 
           INSERT INTO transfers
-                      (tipper, tippee, amount)
-               VALUES (%s, %s, %s)
+                      (tipper, tippee, amount, context)
+               VALUES (%s, %s, %s, %s)
 
-        """, (tipper, tippee, amount))
+        """, (tipper, tippee, amount, context))
 
 
     def mark_missing_funding(self):
-        self.db.one("""\
+        self.stats.add(ncc_missing=1)
 
-            UPDATE paydays
-               SET ncc_missing = ncc_missing + 1
-             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
-         RETURNING id
 
-        """, default=NoPayday)
+    def mark_charge_failed(self):
+        self.stats.add(ncc_failing=1)
 
+    def mark_charge_success(self, amount, fee):
+        self.stats.add(ncharges=1, charge_volume=amount, charge_fees_volume=fee)
 
-    def mark_charge_failed(self, cursor):
-        STATS = """\
 
-            UPDATE paydays
-               SET ncc_failing = ncc_failing + 1
-             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
-         RETURNING id
+    def mark_ach_failed(self):
+        self.stats.add(nach_failing=1)
+
+    def mark_ach_success(self, amount, fee):
+        self.stats.add(nachs=1, ach_volume=-amount, ach_fees_volume=fee)
+
+
+    def mark_transfer(self, amount):
+        self.stats.add(ntransfers=1, transfer_volume=amount)
+
+
+    def mark_pachinko(self, amount):
+        self.stats.add(npachinko=1, pachinko_volume=amount)
+
+
+    def mark_bulk_payin(self, nparticipants, ntippers, ntips, transfers):
+        """Record stats for a chunk of bulk payin.
+
+        This is equivalent to calling mark_transfer for each transfer and
+        mark_participant for each participant.
 
         """
-        cursor.execute(STATS)
-        assert cursor.fetchone() is not None
+        transfer_volume = sum([t[2] for t in transfers]) or Decimal('0.00')
+        self.stats.add( nparticipants=nparticipants
+                      , ntippers=ntippers
+                      , ntips=ntips
+                      , ntransfers=len(transfers)
+                      , transfer_volume=transfer_volume
+                       )
 
-    def mark_charge_success(self, cursor, amount, fee):
-        STATS = """\
 
-            UPDATE paydays
-               SET ncharges = ncharges + 1
-                 , charge_volume = charge_volume + %s
-                 , charge_fees_volume = charge_fees_volume + %s
-             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
-         RETURNING id
+    def mark_participant(self, nsuccessful_tips):
+        self.stats.add( nparticipants=1
+                      , ntippers=1 if nsuccessful_tips > 0 else 0
+                      , ntips=nsuccessful_tips  # XXX bug?
+                       )
+
+
+class ShardedPayday(Payday):
+    """Run payday with payin, pachinko, and payout split across processes.
+
+    Participants are partitioned into nshards shards by id, and each shard of
+    each of those phases runs in a pool of worker processes (see run_shard).
+    The rest of payday runs here, in the coordinator, and each phase finishes
+    in every shard before the next phase starts. This is safe because during
+    each phase a participant's balance is only changed by their own shard:
+    transfers credit the tippee's *pending* column, which nobody reads until
+    the next phase. Each shard adds its statistics to the paydays row as it
+    goes, so they're merged there.
+
+    Instantiate with a postgres.Postgres instance, a number of shards, and a
+    callable that returns a new postgres.Postgres instance. The callable is
+    called once in each worker process, since connections can't be shared
+    across processes. Other keyword arguments are passed to Payday in each
+    shard.
+
+    """
+
+    def __init__(self, db, nshards, connect, **kw):
+        super(ShardedPayday, self).__init__(db)
+        self.nshards = nshards
+        self.connect = connect
+        self.kw = kw
+        self.pool = None
+
+    def run(self):
+        self.pool = multiprocessing.Pool( self.nshards
+                                        , initializer=connect_shard
+                                        , initargs=(self.connect,)
+                                         )
+        try:
+            super(ShardedPayday, self).run()
+            self.pool.close()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+
+    def run_participant_phase(self, phase, ts_start):
+        return self.run_phase(phase, self.run_shards, phase)
+
+    def set_nactive(self, ts_start):
+        # Transfers were made in the shards, so we have to read them back.
+        self.activity.recover(ts_start)
+        super(ShardedPayday, self).set_nactive(ts_start)
 
+    def run_shards(self, phase):
+        """Given a phase name, run all shards of it, and wait for them.
         """
-        cursor.execute(STATS, (amount, fee))
-        assert cursor.fetchone() is not None
+        log("Starting %s in %d shards." % (phase, self.nshards))
+        self.pool.map( run_shard
+                     , [(phase, shard, self.nshards, self.kw)
+                        for shard in range(self.nshards)]
+                     , chunksize=1
+                      )
+        log("Did %s in %d shards." % (phase, self.nshards))
 
 
-    def mark_ach_failed(self, cursor):
-        cursor.one("""\
+class PaydayStats(object):
+    """Accumulate statistics about the current payday in memory.
 
-            UPDATE paydays
-               SET nach_failing = nach_failing + 1
-             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
-         RETURNING id
+    The counters on the paydays row used to be bumped with an UPDATE for each
+    event (charge, transfer, etc.), which serialized all of payday on that one
+    row. Now we add to counters in memory and flush them to the paydays row
+    every so often (see FLUSH_EVERY and FLUSH_INTERVAL) and at the end of each
+    payday phase.
 
-        """, default=NoPayday)
+    If we crash, any counts that hadn't been flushed yet are lost. When we
+    pick up an existing payday we call recover, which recomputes the counters
+    that can be derived from the ledger.
 
-    def mark_ach_success(self, cursor, amount, fee):
-        cursor.one("""\
+    """
 
-            UPDATE paydays
-               SET nachs = nachs + 1
-                 , ach_volume = ach_volume + %s
-                 , ach_fees_volume = ach_fees_volume + %s
-             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
-         RETURNING id
+    FIELDS = ( 'nparticipants', 'ntippers', 'ntips'
+             , 'ntransfers', 'transfer_volume'
+             , 'npachinko', 'pachinko_volume'
+             , 'ncc_failing', 'ncc_missing'
+             , 'ncharges', 'charge_volume', 'charge_fees_volume'
+             , 'nach_failing'
+             , 'nachs', 'ach_volume', 'ach_fees_volume'
+              )
 
-        """, (-amount, fee), default=NoPayday)
+    FLUSH_EVERY = 1000      # events
+    FLUSH_INTERVAL = 10     # seconds
 
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.reset()
 
-    def mark_transfer(self, cursor, amount):
-        cursor.one("""\
+    def reset(self):
+        self.counters = dict((field, 0) for field in self.FIELDS)
+        self.nevents = 0
+        self.last_flush = time.time()
 
-            UPDATE paydays
-               SET ntransfers = ntransfers + 1
-                 , transfer_volume = transfer_volume + %s
-             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
-         RETURNING id
+    def add(self, **deltas):
+        """Add the given amounts to our counters, flushing if it's time.
+        """
+        with self.lock:
+            for field, delta in deltas.items():
+                self.counters[field] += delta
+            self.nevents += 1
+            if self.nevents >= self.FLUSH_EVERY or \
+               time.time() - self.last_flush >= self.FLUSH_INTERVAL:
+                self._flush()
+
+    def flush(self):
+        """Write our counters to the current paydays row and reset them.
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.nevents:
+            counters = self.counters
+            assignments = ', '.join([ "{0} = {0} + %({0})s".format(field)
+                                      for field in self.FIELDS
+                                     ])
+            self.db.one("""\
+
+                UPDATE paydays
+                   SET {}
+                 WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+             RETURNING id
 
-        """, (amount,), default=NoPayday)
+            """.format(assignments), counters, default=NoPayday)
+        self.reset()
 
+    def recover(self, ts_start):
+        """Recompute the counters that the ledger can answer.
 
-    def mark_pachinko(self, cursor, amount):
-        cursor.one("""\
+        Payday tags each transfer it makes with its context, 'tip' or 'take'
+        (pachinko), and each charge and credit it makes has an exchange intent
+        that's resolved as 'succeeded' or 'failed' (see open_intent), so we
+        count those since ts_start. The rest of the ledger (transfers and
+        exchanges made outside of payday) is left out. ncc_missing and the
+        participant counters (nparticipants, ntippers, ntips) can't be derived
+        from the ledger, so we leave those as they were last flushed.
 
-            UPDATE paydays
-               SET npachinko = npachinko + 1
-                 , pachinko_volume = pachinko_volume + %s
-             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
-         RETURNING id
+        """
+        with self.lock:
+            self.reset()
+            self.db.one("""\
+
+                WITH tips AS (
+                        SELECT *
+                          FROM transfers
+                         WHERE timestamp >= %(ts_start)s
+                           AND context = 'tip'
+                     )
+                   , pachinkos AS (
+                        SELECT *
+                          FROM transfers
+                         WHERE timestamp >= %(ts_start)s
+                           AND context = 'take'
+                     )
+                   , intents AS (
+                        SELECT *
+                          FROM exchange_intents
+                         WHERE ctime >= %(ts_start)s
+                     )
+                   , charges AS (
+                        SELECT *
+                          FROM intents
+                         WHERE kind = 'charge'
+                           AND status = 'succeeded'
+                     )
+                   , credits AS (
+                        SELECT *
+                          FROM intents
+                         WHERE kind = 'credit'
+                           AND status = 'succeeded'
+                     )
+                UPDATE paydays
+                   SET ntransfers = (SELECT count(*) FROM tips)
+                     , transfer_volume =
+                            (SELECT COALESCE(sum(amount), 0) FROM tips)
+                     , npachinko = (SELECT count(*) FROM pachinkos)
+                     , pachinko_volume =
+                            (SELECT COALESCE(sum(amount), 0) FROM pachinkos)
+                     , ncc_failing = ( SELECT count(*)
+                                         FROM intents
+                                        WHERE kind = 'charge'
+                                          AND status = 'failed'
+                                      )
+                     , ncharges = (SELECT count(*) FROM charges)
+                     , charge_volume =
+                            (SELECT COALESCE(sum(amount + fee), 0) FROM charges)
+                     , charge_fees_volume =
+                            (SELECT COALESCE(sum(fee), 0) FROM charges)
+                     , nach_failing = ( SELECT count(*)
+                                          FROM intents
+                                         WHERE kind = 'credit'
+                                           AND status = 'failed'
+                                       )
+                     , nachs = (SELECT count(*) FROM credits)
+                     , ach_volume =
+                            (SELECT COALESCE(sum(amount), 0) FROM credits)
+                     , ach_fees_volume =
+                            (SELECT COALESCE(sum(fee), 0) FROM credits)
+                 WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+             RETURNING id
 
-        """, (amount,), default=NoPayday)
+            """, {'ts_start': ts_start}, default=NoPayday)
 
 
-    def mark_participant(self, nsuccessful_tips):
-        self.db.one("""\
+class PaydayActivity(object):
+    """Collect the participants who give and receive money during payday.
 
-            UPDATE paydays
-               SET nparticipants = nparticipants + 1
-                 , ntippers = ntippers + %s
-                 , ntips = ntips + %s
+    Payday stores how many participants were active (gave or received money),
+    how many gave, how many received, and how many did both, on the paydays
+    row. Rather than scan transfers for those at the end of payday, we add
+    each transfer's tipper and tippee to a set as we make it.
+
+    We also keep the participants who were charged or credited, so that at
+    the end of payday we know whose balances may have changed (see
+    Payday.snapshot_balances).
+
+    When we pick up an existing payday, or when transfers were made in other
+    processes, we call recover, which reloads the sets from transfers and
+    exchanges since ts_start.
+
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.givers = set()
+        self.receivers = set()
+        self.exchangers = set()
+
+    def add(self, transfers):
+        """Given a list of (tipper, tippee, amount), return None.
+        """
+        with self.lock:
+            for tipper, tippee, amount in transfers:
+                self.givers.add(tipper)
+                self.receivers.add(tippee)
+
+    def touch(self, username):
+        """Given the username of a participant we charged or credited, return
+        None.
+        """
+        with self.lock:
+            self.exchangers.add(username)
+
+    def touched(self):
+        """Return the set of usernames whose balances payday may have changed.
+        """
+        with self.lock:
+            return self.givers | self.receivers | self.exchangers
+
+    def counts(self):
+        """Return a dict of nactive, ngivers, nreceivers, and noverlap.
+        """
+        with self.lock:
+            return { 'nactive': len(self.givers | self.receivers)
+                   , 'ngivers': len(self.givers)
+                   , 'nreceivers': len(self.receivers)
+                   , 'noverlap': len(self.givers & self.receivers)
+                    }
+
+    def recover(self, ts_start):
+        """Reload our sets from transfers and exchanges since ts_start.
+        """
+        transfers = self.db.all("""\
+
+            SELECT tipper, tippee, amount
+              FROM transfers
+             WHERE "timestamp" >= %s
+
+        """, (ts_start,))
+        exchangers = self.db.all("""\
+
+            SELECT DISTINCT participant
+              FROM exchanges
+             WHERE "timestamp" >= %s
+
+        """, (ts_start,))
+        with self.lock:
+            self.givers = set()
+            self.receivers = set()
+            self.exchangers = set(exchangers)
+        self.add(transfers)
+
+
+# Statement timing.
+# =================
+# While a phase runs we time every SQL statement executed through postgres.py
+# cursors, and charge the time to the PaydayProgress of each phase that's
+# running in this process (usually just the one).
+
+TIMED_CURSOR_CLASSES = ( cursors.SimpleTupleCursor
+                       , cursors.SimpleNamedTupleCursor
+                       , cursors.SimpleDictCursor
+                        )
+TIMED_CURSOR_METHODS = ('execute', 'copy_expert')
+
+_timers = []                    # [PaydayProgress]
+_timers_lock = threading.Lock()
+_untimed = []                   # [(cls, name, original or None)]
+
+
+def _timed(method):
+    def timed(cursor, *a, **kw):
+        _start = time.time()
+        try:
+            return method(cursor, *a, **kw)
+        finally:
+            seconds = time.time() - _start
+            for progress in list(_timers):
+                progress.add_db_time(seconds)
+    return timed
+
+
+@contextmanager
+def timing_statements(progress):
+    """Given a PaydayProgress, count SQL statement time towards it for the
+    duration.
+
+    We wrap the cursor methods when the first caller comes in and put them
+    back when the last one leaves. Rows streamed from a named cursor are
+    fetched by psycopg2 without going through execute, so they aren't timed.
+
+    """
+    with _timers_lock:
+        if not _timers:
+            for cls in TIMED_CURSOR_CLASSES:
+                for name in TIMED_CURSOR_METHODS:
+                    _untimed.append((cls, name, cls.__dict__.get(name)))
+                    setattr(cls, name, _timed(getattr(cls, name)))
+        _timers.append(progress)
+    try:
+        yield
+    finally:
+        with _timers_lock:
+            _timers.remove(progress)
+            if not _timers:
+                while _untimed:
+                    cls, name, original = _untimed.pop()
+                    if original is None:
+                        delattr(cls, name)
+                    else:
+                        setattr(cls, name, original)
+
+
+class PaydayProgress(object):
+    """Track progress through the phases of the current payday.
+
+    For each phase we keep a row in payday_progress with start and end times,
+    the number of participants we're done with (out of how many we expect),
+    the time spent waiting on payment processors, the time spent running SQL
+    statements, and an ETA for the end of the phase. The row is
+    updated every FLUSH_INTERVAL seconds while the phase runs, and we log the
+    same information when we do so. This is only instrumentation, so if there
+    is no current payday we don't complain, we just don't record anything.
+
+    """
+
+    FLUSH_INTERVAL = 10     # seconds
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.phase = None
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.last_flush = self.started
+        self.nitems = 0
+        self.ntotal = None
+        self.processor_seconds = 0.0
+        self.db_seconds = 0.0
+
+    def start(self, phase):
+        """Given a phase name, start tracking that phase.
+        """
+        with self.lock:
+            self.phase = phase
+            self.reset()
+            self._insert(phase, aspen.utils.utcnow())
+
+    def expect(self, ntotal):
+        """Given the number of items the current phase will process, store it.
+        """
+        with self.lock:
+            self.ntotal = ntotal
+
+    def tick(self, n=1):
+        """Count n items as processed, flushing if it's time.
+        """
+        with self.lock:
+            self.nitems += n
+            if time.time() - self.last_flush >= self.FLUSH_INTERVAL:
+                self._flush()
+
+    def add_processor_time(self, seconds):
+        """Count seconds spent waiting on Balanced or Stripe.
+        """
+        with self.lock:
+            self.processor_seconds += seconds
+
+    def add_db_time(self, seconds):
+        """Count seconds spent running SQL statements.
+
+        This is called for our own writes to payday_progress too, while we
+        hold self.lock, so it has a lock of its own.
+
+        """
+        with self.db_lock:
+            self.db_seconds += seconds
+
+    def finish(self):
+        """Record the end of the current phase.
+        """
+        with self.lock:
+            self._flush(ts_end=aspen.utils.utcnow())
+            self.phase = None
+
+    def get_eta(self, elapsed):
+        """Given seconds elapsed, return a datetime or None.
+        """
+        if not (self.ntotal and self.nitems and elapsed > 0):
+            return None
+        remaining = max(self.ntotal - self.nitems, 0)
+        seconds = remaining * elapsed / self.nitems
+        return aspen.utils.utcnow() + datetime.timedelta(seconds=seconds)
+
+    def _flush(self, ts_end=None):
+        if self.phase is None:
+            return
+        now = time.time()
+        elapsed = now - self.started
+        eta = None if ts_end is not None else self.get_eta(elapsed)
+        self._update({ 'phase': self.phase
+                     , 'nitems': self.nitems
+                     , 'ntotal': self.ntotal
+                     , 'db_seconds': self.db_seconds
+                     , 'processor_seconds': self.processor_seconds
+                     , 'eta': eta
+                     , 'ts_end': ts_end
+                      })
+        self.last_flush = now
+        if ts_end is None:
+            log("%s: %d of %s participants (%.1f per second), ETA %s."
+               % ( self.phase
+                 , self.nitems
+                 , self.ntotal
+                 , self.nitems / elapsed if elapsed else 0
+                 , eta
+                  ))
+
+    def _insert(self, phase, ts_start):
+        # If we're picking up a payday that crashed, the phase starts over.
+        params = {'phase': phase, 'ts_start': ts_start}
+        with self.db.get_cursor() as cursor:
+            cursor.run("""\
+
+                DELETE FROM payday_progress
+                 WHERE payday=( SELECT id
+                                  FROM paydays
+                                 WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+                               )
+                   AND phase=%(phase)s
+
+            """, params)
+            cursor.run("""\
+
+                INSERT INTO payday_progress
+                            (payday, phase, ts_start)
+                     SELECT id, %(phase)s, %(ts_start)s
+                       FROM paydays
+                      WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+
+            """, params)
+
+    def _update(self, row):
+        self.db.run("""\
+
+            UPDATE payday_progress
+               SET nitems=%(nitems)s
+                 , ntotal=%(ntotal)s
+                 , db_seconds=%(db_seconds)s
+                 , processor_seconds=%(processor_seconds)s
+                 , eta=%(eta)s
+                 , ts_end=%(ts_end)s
+             WHERE payday=( SELECT id
+                              FROM paydays
+                             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+                           )
+               AND phase=%(phase)s
+
+        """, row)
+
+
+class PaydayCheckpoints(object):
+    """Buffer per-participant checkpoints for the current payday.
+
+    When we're done with a participant in a phase we add a checkpoint, and
+    when we pick up a payday that crashed, get_participants skips the
+    participants with a checkpoint for the phase at hand, using the primary
+    key on payday_checkpoints. Checkpoints are written FLUSH_EVERY at a time
+    and at the end of each phase. It's safe to lose the ones that weren't
+    written yet in a crash: those participants will be processed again, and
+    each phase does nothing the second time around (payin only sees tips that
+    haven't been transferred yet, pachinko only has what's left in the team's
+    balance, and payout only sees what's left in the participant's balance).
+
+    """
+
+    FLUSH_EVERY = 1000      # checkpoints
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.buffer = []
+
+    def add(self, phase, participant, status='done'):
+        """Given a phase and a participant, add a checkpoint.
+        """
+        self.add_many(phase, [participant], status)
+
+    def add_many(self, phase, participants, status='done'):
+        """Given a phase and a list of participants, add checkpoints.
+        """
+        with self.lock:
+            self.buffer.extend([(phase, p.id, status) for p in participants])
+            if len(self.buffer) >= self.FLUSH_EVERY:
+                self._flush()
+
+    def flush(self):
+        """Write buffered checkpoints to the database.
+        """
+        with self.lock:
+            self._flush()
+
+    def clear(self, cursor, payday):
+        """Given a cursor and a payday id, drop all checkpoints for the payday.
+
+        This is in the same transaction that ends the payday, so that if we
+        crash we either have an open payday with its checkpoints, or a closed
+        one without.
+
+        """
+        with self.lock:
+            self.buffer = []
+            cursor.run("DELETE FROM payday_checkpoints WHERE payday=%s",
+                       (payday,))
+
+    def write(self, cursor, phase, participants, status='done'):
+        """Given a cursor, a phase, and participants, write checkpoints now.
+
+        This is for when the checkpoints should be in the same transaction as
+        the work they record.
+
+        """
+        self._insert(cursor, [(phase, p.id, status) for p in participants])
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        with self.db.get_cursor() as cursor:
+            self._insert(cursor, self.buffer)
+        self.buffer = []
+
+    def _insert(self, cursor, rows):
+        payday = cursor.one("""\
+
+            SELECT id
+              FROM paydays
              WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
-         RETURNING id
 
-        """, ( 1 if nsuccessful_tips > 0 else 0
-             , nsuccessful_tips  # XXX bug?
-              ), default=NoPayday)
+        """, default=NoPayday)
+        values = ', '.join([cursor.mogrify("(%s, %s, %s)", row).decode('UTF-8')
+                            for row in rows])
+        cursor.execute("""\
+
+            INSERT INTO payday_checkpoints
+                        (payday, phase, participant_id, status)
+                 SELECT %%s, c.*
+                   FROM (VALUES %s) AS c (phase, participant_id, status)
+                  WHERE NOT EXISTS (
+                            SELECT 1
+                              FROM payday_checkpoints x
+                             WHERE x.payday = %%s
+                               AND x.phase = c.phase
+                               AND x.participant_id = c.participant_id
+                        )
+
+        """ % values, (payday, payday))
+
+
+class BalancedAccounts(object):
+    """Cache balanced.Account objects for the duration of a payday.
+
+    Charging and crediting on Balanced both start by looking up the account,
+    which is a round trip to Balanced, and participants who are both charged
+    and credited used to be looked up twice. Here we look up each account at
+    most once per Payday. Payday.prefetch_accounts also calls prefetch ahead
+    of the payin and payout loops, so that lookups happen on background
+    threads while the loop is busy in the database.
+
+    A failed prefetch isn't cached: find tries again in the calling thread,
+    so errors are raised where charge_on_balanced and credit_on_balanced
+    expect them.
+
+    Accounts are kept from payin through payout, for as long as the Payday
+    lasts. Debits and credits are made by Balanced against the account's
+    current cards and bank accounts, so a card that changes in the meantime
+    isn't a problem. Payday.end calls close, which stops our worker threads
+    and empties the cache.
+
+    """
+
+    def __init__(self, nworkers=ACCOUNT_PREFETCH_WORKERS):
+        self.nworkers = nworkers
+        self.lock = threading.Lock()
+        self.accounts = {}      # {uri: balanced.Account}
+        self.pending = {}       # {uri: threading.Event}
+        self.queue = Queue.Queue()
+        self.workers = []
+
+    def find(self, uri):
+        """Given a Balanced account URI, return a balanced.Account.
+        """
+        with self.lock:
+            pending = self.pending.get(uri)
+        if pending is not None:
+            pending.wait()
+        with self.lock:
+            account = self.accounts.get(uri)
+        if account is None:
+            account = balanced.Account.find(uri)
+            with self.lock:
+                self.accounts[uri] = account
+        return account
+
+    def prefetch(self, uri):
+        """Given a Balanced account URI, start looking it up in the background.
+        """
+        with self.lock:
+            if uri in self.accounts or uri in self.pending:
+                return
+            self.pending[uri] = threading.Event()
+            if len(self.workers) < self.nworkers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        self.queue.put(uri)
+
+    def close(self):
+        """Stop our worker threads and empty the cache.
+
+        Workers finish the lookups already queued before they stop, so nobody
+        waiting in find is left hanging, and we wait for them before emptying
+        the cache. We can still be used afterwards; new workers are started as
+        needed.
+
+        """
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            self.queue.put(None)
+        for worker in workers:
+            worker.join()
+        with self.lock:
+            self.accounts.clear()
+
+    def _work(self):
+        while True:
+            uri = self.queue.get()
+            if uri is None:
+                return
+            try:
+                account = balanced.Account.find(uri)
+            except Exception:
+                account = None
+            with self.lock:
+                if account is not None:
+                    self.accounts[uri] = account
+                event = self.pending.pop(uri)
+            event.set()
+
+
+class PaydayLog(object):
+    """Buffer per-participant log records and write them as JSON lines.
+
+    Payday logs a line for every tip, charge, and credit, and formatting and
+    writing those one at a time showed up in the payin loop. With a path we
+    instead buffer records in memory and append them to path FLUSH_EVERY at a
+    time and at the end of each phase, one JSON object per line, with the
+    phase, event, status, and the participants and amounts involved (use
+    PaydayLog.read to query them). Only a summary of each phase goes to
+    stdout. Without a path each record's message is logged as it happens,
+    like before.
+
+    """
+
+    FLUSH_EVERY = 1000      # records
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.phase = None
+        self.buffer = []
+        self.counts = collections.Counter()     # {(event, status): n}
+
+    def start(self, phase):
+        with self.lock:
+            self.phase = phase
+            self.counts.clear()
+
+    def add(self, event, status, msg, **fields):
+        """Given an event, a status, a human-readable message, and more fields,
+        add a record.
+        """
+        if self.path is None:
+            log(msg)
+            return
+        record = dict( fields
+                     , ts=aspen.utils.utcnow().isoformat()
+                     , event=event
+                     , status=status
+                     , msg=msg
+                      )
+        with self.lock:
+            record['phase'] = self.phase
+            self.buffer.append(record)
+            self.counts[(event, status)] += 1
+            if len(self.buffer) >= self.FLUSH_EVERY:
+                self._flush()
+
+    def flush(self):
+        """Append buffered records to the log file.
+        """
+        with self.lock:
+            self._flush()
+
+    def finish(self):
+        """Flush, and log a summary of the records for the current phase.
+        """
+        with self.lock:
+            self._flush()
+            if self.counts:
+                summary = ', '.join([ "%d %s %s" % (n, event, status)
+                                      for (event, status), n
+                                      in sorted(self.counts.items())
+                                     ])
+                log("%s: %s (see %s)." % (self.phase, summary, self.path))
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        lines = [json.dumps(record, default=unicode, sort_keys=True) + '\n'
+                 for record in self.buffer]
+        data = ''.join(lines).encode('UTF-8')
+
+        # We write each batch with a single call to os.write on a file opened
+        # for appending, so that batches from the shards of a ShardedPayday
+        # don't interleave.
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        self.buffer = []
+
+    @staticmethod
+    def read(path, **criteria):
+        """Given a path and field values, yield matching records as dicts.
+
+        For example, PaydayLog.read(path, event='charge', status='FAILURE').
+
+        """
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if all(record.get(k) == v for k, v in criteria.items()):
+                    yield record
@@ -0,0 +1,308 @@
+"""Project the next payday, and keep the projection up to date.
+
+Ops wants to see roughly how big the next payday will be at any time during
+the week. Working that out from scratch means running most of payday's
+selection logic, so instead we keep each participant's contribution to the
+projection in projected_payday_participants, and the totals in a single
+projected_payday row. When something changes a participant's contribution
+(their tips, their credit card, whether they're suspicious) we queue them with
+a ProjectionUpdater, which recomputes their contribution and applies the
+difference to the totals (see update) from a background thread, so that the
+request that made the change neither waits for that nor fails if it does. The
+whole thing is recomputed at the end of each payday, when balances change,
+and seeded by wireup.projection if it's missing (see refresh).
+
+A participant's contribution is a simplified payday: they count if they'd be
+included in payday at all; if their tips to claimed, unsuspicious
+participants come to more than their balance we project a charge on their
+card, provided it's whitelisted and worked last time; and we project that
+their tips are transferred if the money is there. Team takes (pachinko) and
+payouts aren't projected.
+
+"""
+from __future__ import unicode_literals
+
+import threading
+import time
+
+import gittip
+from aspen import log
+from gittip.billing.payday import MINIMUM_CHARGE, upcharge
+
+
+FIELDS = ( 'nparticipants'
+         , 'ntippers'
+         , 'transfer_volume'
+         , 'ncharges'
+         , 'charge_volume'
+          )
+
+# With usernames NULL this is every participant.
+PARTICIPANTS = """\
+
+    WITH current_tips AS (
+            SELECT DISTINCT ON (tipper, tippee)
+                   tipper, tippee, amount
+              FROM tips
+             WHERE %(usernames)s::text[] IS NULL
+                OR tipper = ANY(%(usernames)s::text[])
+          ORDER BY tipper, tippee, mtime DESC
+         )
+       , giving AS (
+            SELECT t.tipper, sum(t.amount) AS giving
+              FROM current_tips t
+              JOIN participants e ON e.username = t.tippee
+             WHERE e.claimed_time IS NOT NULL
+               AND e.is_suspicious IS NOT true
+          GROUP BY t.tipper
+         )
+    SELECT p.username
+         , p.claimed_time
+         , p.is_suspicious
+         , COALESCE(p.balance, 0) AS balance
+         , p.last_bill_result
+         , p.balanced_account_uri
+         , p.stripe_customer_id
+         , COALESCE(g.giving, 0) AS giving
+      FROM participants p
+ LEFT JOIN giving g ON g.tipper = p.username
+     WHERE %(usernames)s::text[] IS NULL
+        OR p.username = ANY(%(usernames)s::text[])
+
+"""
+
+
+def contribution(rec):
+    """Given a dict from PARTICIPANTS, return a dict of FIELDS.
+    """
+    out = dict((field, 0) for field in FIELDS)
+    if rec['claimed_time'] is None or rec['is_suspicious'] is True:
+        return out      # not in payday
+    out['nparticipants'] = 1
+
+    giving, funds = rec['giving'], rec['balance']
+    if giving <= 0:
+        return out
+
+    short = giving - funds
+    has_funding = rec['balanced_account_uri'] is not None \
+               or rec['stripe_customer_id'] is not None
+    if short > 0 and has_funding and rec['is_suspicious'] is False \
+                                  and rec['last_bill_result'] == '':
+        charge_amount, fee = upcharge(max(short, MINIMUM_CHARGE))
+        out['ncharges'] = 1
+        out['charge_volume'] = charge_amount
+        funds += charge_amount - fee
+
+    if funds >= giving:
+        out['ntippers'] = 1
+        out['transfer_volume'] = giving
+    return out
+
+
+def compute(cursor, usernames=None):
+    """Given a cursor and a list of usernames (or None for everyone), return a
+    dict of {username: contribution}.
+    """
+    recs = cursor.all(PARTICIPANTS, {'usernames': usernames})
+    return dict((rec['username'], contribution(rec)) for rec in recs)
+
+
+def update(db, usernames):
+    """Given a postgres.Postgres instance and a list of usernames, recompute
+    their contributions and apply the differences to the totals.
+
+    Updates take turns: the lock on projected_payday_participants conflicts
+    with itself, so two updates of the same participant can't both delete
+    the old row and insert a new one, and overlapping batches can't deadlock
+    on row locks. Requests never wait on this, since updates run through
+    updater. If there's no projection yet there's nothing to update.
+
+    """
+    if not usernames:
+        return
+    with db.get_cursor(back_as=dict) as cursor:
+        cursor.run("LOCK TABLE projected_payday IN ROW EXCLUSIVE MODE")
+        cursor.run("LOCK TABLE projected_payday_participants "
+                   "IN SHARE ROW EXCLUSIVE MODE")
+        if cursor.one("SELECT id FROM projected_payday") is None:
+            return
+
+        old = {}
+        for rec in cursor.all("""\
+
+            DELETE FROM projected_payday_participants
+                  WHERE participant = ANY(%s)
+              RETURNING *
+
+        """, (usernames,)):
+            old[rec.pop('participant')] = rec
+
+        new = compute(cursor, usernames)
+        insert(cursor, new)
+
+        deltas = dict((field, 0) for field in FIELDS)
+        for username in set(old) | set(new):
+            zero = dict((field, 0) for field in FIELDS)
+            before, after = old.get(username, zero), new.get(username, zero)
+            for field in FIELDS:
+                deltas[field] += after[field] - before[field]
+
+        cursor.run("""\
+
+            UPDATE projected_payday
+               SET nparticipants = nparticipants + %(nparticipants)s
+                 , ntippers = ntippers + %(ntippers)s
+                 , transfer_volume = transfer_volume + %(transfer_volume)s
+                 , ncharges = ncharges + %(ncharges)s
+                 , charge_volume = charge_volume + %(charge_volume)s
+                 , mtime = CURRENT_TIMESTAMP
+
+        """, deltas)
+
+
+def update_tippers_of(db, username):
+    """Given a postgres.Postgres instance and a username, update the
+    participant and everyone who tips them.
+
+    This is for when the participant's standing changes, since whether tips to
+    them count depends on it. The update itself goes through updater.
+
+    """
+    tippers = db.all("SELECT DISTINCT tipper FROM tips WHERE tippee=%s",
+                     (username,))
+    updater.add([username] + tippers)
+
+
+def refresh(db):
+    """Given a postgres.Postgres instance, recompute the projection from
+    scratch.
+    """
+    with db.get_cursor(back_as=dict) as cursor:
+        cursor.run("LOCK TABLE projected_payday IN EXCLUSIVE MODE")
+        cursor.run("DELETE FROM projected_payday")
+        cursor.run("DELETE FROM projected_payday_participants")
+        contributions = compute(cursor)
+        insert(cursor, contributions)
+
+        totals = dict((field, 0) for field in FIELDS)
+        for c in contributions.values():
+            for field in FIELDS:
+                totals[field] += c[field]
+        cursor.run("""\
+
+            INSERT INTO projected_payday
+                        ( nparticipants, ntippers, transfer_volume
+                        , ncharges, charge_volume
+                         )
+                 VALUES ( %(nparticipants)s, %(ntippers)s, %(transfer_volume)s
+                        , %(ncharges)s, %(charge_volume)s
+                         )
+
+        """, totals)
+
+
+def insert(cursor, contributions):
+    """Given a cursor and a dict of contributions, store the non-zero ones.
+    """
+    rows = [ (username,) + tuple(c[field] for field in FIELDS)
+             for username, c in sorted(contributions.items())
+             if any(c.values())
+            ]
+    if not rows:
+        return
+    values = ', '.join([cursor.mogrify("(%s, %s, %s, %s, %s, %s)", row)
+                              .decode('UTF-8') for row in rows])
+    cursor.run("""\
+
+        INSERT INTO projected_payday_participants
+                    ( participant, nparticipants, ntippers, transfer_volume
+                    , ncharges, charge_volume
+                     )
+             VALUES %s
+
+    """ % values)
+
+
+def get(db):
+    """Given a postgres.Postgres instance, return the projection as a dict, or
+    None if there isn't one yet.
+    """
+    return db.one("""\
+
+        SELECT ts_refreshed, mtime, nparticipants, ntippers, transfer_volume
+             , ncharges, charge_volume
+          FROM projected_payday
+
+    """, back_as=dict)
+
+
+def seed(db):
+    """Given a postgres.Postgres instance, make a projection if there isn't
+    one yet.
+    """
+    if get(db) is None:
+        refresh(db)
+
+
+class ProjectionUpdater(object):
+    """Queue participants whose contribution changed, and update them.
+
+    Instantiate with a postgres.Postgres instance and a number of seconds.
+    Every flush_every seconds we update everyone queued since last time, in
+    one transaction. With flush_every 0 we update right away instead. Either
+    way a failure is logged and not raised, since the change that queued the
+    participant has already been committed. The participants are queued
+    again, and retried with the next batch.
+
+    """
+
+    def __init__(self, db, flush_every):
+        self.db = db
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.pending = set()    # {username}
+
+    def add(self, usernames):
+        """Given a list of usernames, queue them for update.
+        """
+        with self.lock:
+            self.pending.update(usernames)
+        if not self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Update everyone queued so far.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        self._update(sorted(pending))
+
+    def _update(self, usernames):
+        try:
+            update(self.db or gittip.db, usernames)
+        except Exception as exc:
+            log("Couldn't update the projected payday: %s" % exc)
+            with self.lock:
+                self.pending.update(usernames)
+
+    def run(self):
+        """Flush every flush_every seconds, forever.
+        """
+        while True:
+            time.sleep(self.flush_every)
+            self.flush()
+
+    def start(self):
+        """Start flushing on a daemon thread, if we're queueing.
+        """
+        if not self.flush_every:
+            return
+        flusher = threading.Thread(target=self.run)
+        flusher.daemon = True
+        flusher.start()
+
+
+# Until wireup.projection configures a real one, update gittip.db right away.
+updater = ProjectionUpdater(None, 0)
+
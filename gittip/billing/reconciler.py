@@ -0,0 +1,160 @@
+"""Resolve exchange intents that payday opened but never recorded.
+
+Before payday charges a card or credits a bank account it writes a pending row
+to exchange_intents, and it passes the id of that row to Balanced or Stripe as
+metadata (see Payday.open_intent). Normally the row is resolved in the same
+transaction that records the result. If payday crashes (or a call to the
+processor raises) in between, the row stays pending, and payday won't touch
+that participant's card or bank account again until it's resolved.
+
+The Reconciler defined here resolves those rows in the background. It looks
+each one up at the processor by its id: if the processor has it we record the
+exchange just as payday would have, and if not we void the intent. It's
+installed as `reconcile_exchanges`, via gittip.cli.
+
+"""
+from __future__ import unicode_literals
+
+import time
+
+import balanced
+import stripe
+from aspen import log
+
+
+class Reconciler(object):
+    """Resolve pending exchange intents in batches.
+    """
+
+    BATCH_SIZE = 100
+
+    # Leave recent intents alone, since payday may still be waiting on the
+    # processor for them.
+    MIN_AGE = 600  # seconds
+
+    def __init__(self, db):
+        self.db = db
+
+    def run(self, interval=60):
+        """Reconcile forever, sleeping for interval seconds when idle.
+        """
+        log("Reconciling exchange intents.")
+        while True:
+            if self.reconcile_batch() < self.BATCH_SIZE:
+                time.sleep(interval)
+
+    def reconcile_batch(self):
+        """Resolve up to BATCH_SIZE intents and return how many we resolved.
+
+        If we can't look an intent up (the processor's API is down, say) we
+        log that and leave it pending for a later batch. Since we then resolve
+        fewer than BATCH_SIZE, run sleeps before trying again.
+
+        """
+        intents = self.get_batch()
+        nresolved = 0
+        for intent in intents:
+            try:
+                found = self.look_up(intent)
+            except Exception as exc:
+                log("Couldn't look up %s %d: %s"
+                    % (intent['kind'], intent['id'], exc))
+                continue
+            self.resolve(intent, 'succeeded' if found else 'void')
+            nresolved += 1
+        return nresolved
+
+    def get_batch(self):
+        return self.db.all("""\
+
+            SELECT id, participant, kind, processor, route, amount, fee
+              FROM exchange_intents
+             WHERE status='pending'
+               AND ctime < CURRENT_TIMESTAMP - %s * interval '1 second'
+          ORDER BY id
+             LIMIT %s
+
+        """, (self.MIN_AGE, self.BATCH_SIZE), back_as=dict)
+
+
+    # Processors.
+    # ===========
+
+    def look_up(self, intent):
+        """Given an intent dict, return a boolean.
+
+        True means the processor went through with the charge or credit.
+
+        """
+        if intent['processor'] == 'balanced':
+            return self.look_up_on_balanced(intent)
+        else:
+            return self.look_up_on_stripe(intent)
+
+    def look_up_on_balanced(self, intent):
+        cls = balanced.Debit if intent['kind'] == 'charge' else balanced.Credit
+        meta = {'meta.exchange_intent': unicode(intent['id'])}
+        return len(cls.query.filter(**meta).all()) > 0
+
+    def look_up_on_stripe(self, intent):
+        charges = stripe.Charge.all(customer=intent['route'], count=100)
+        for charge in charges.data:
+            metadata = getattr(charge, 'metadata', None) or {}
+            if metadata.get('exchange_intent') == unicode(intent['id']):
+                return charge.paid
+        return False
+
+
+    # Record-keeping.
+    # ===============
+
+    def resolve(self, intent, status):
+        """Given an intent dict and a status, return None.
+
+        For successful intents we record the exchange and update the balance
+        the same way Payday.record_charge and Payday.record_credit do, in the
+        same transaction as resolving the intent. If payday got to the intent
+        first there's nothing to do.
+
+        """
+        with self.db.get_cursor() as cursor:
+            resolved = cursor.one("""\
+
+                UPDATE exchange_intents
+                   SET status=%s
+                     , mtime=CURRENT_TIMESTAMP
+                 WHERE id=%s
+                   AND status='pending'
+             RETURNING id
+
+            """, (status, intent['id']))
+            if resolved is None:
+                return
+
+            username = intent['participant']
+            if status == 'succeeded':
+                amount, fee = intent['amount'], intent['fee']
+                cursor.run("""\
+
+                    INSERT INTO exchanges
+                           (amount, fee, participant)
+                    VALUES (%s, %s, %s)
+
+                """, (amount, fee, username))
+
+                if intent['kind'] == 'charge':
+                    column, delta = 'last_bill_result', amount
+                else:
+                    column, delta = 'last_ach_result', amount - fee
+                cursor.run("""\
+
+                    UPDATE participants
+                       SET {}=''
+                         , balance=(balance + %s)
+                     WHERE username=%s
+
+                """.format(column), (delta, username))
+
+        log("Reconciled %s %d for %s: %s."
+            % (intent['kind'], intent['id'], username, status))
+
@@ -0,0 +1,498 @@
+"""Simulate payday against an in-memory ledger.
+
+We want to be able to forecast payday volume and duration before Thursday. The
+SimulatedPayday defined here runs the same payin -> pachinko -> payout pipeline
+as gittip.billing.payday.Payday, but against a snapshot of the database taken
+when it starts. Nothing is written to Postgres, and we don't talk to Balanced
+or Stripe: we assume that cards and bank accounts behave the same way they did
+last time (as recorded in last_bill_result and last_ach_result).
+
+Running against memory only tells us how long our own code takes, so to
+forecast how long payday will take for real we add the time the last payday
+spent on the database and on payment processors, per participant and per
+charge or credit (see Latencies).
+
+"""
+from __future__ import unicode_literals
+
+import time
+from decimal import Decimal
+
+from aspen import log
+from gittip.billing.payday import ( Payday
+                                  , PaydayCheckpoints
+                                  , PaydayProgress
+                                  , PaydayStats
+                                  , PARTICIPANT_COLUMNS
+                                  , participant_from_record
+                                   )
+from gittip.models.participant import total_tips
+
+
+class Ledger(object):
+    """Represent a snapshot of the data that payday works with.
+    """
+
+    def __init__(self, ts_start, participants, tips, members):
+        self.ts_start = ts_start
+        self.participants = participants    # {username: dict}
+        self.tips = tips                    # {tipper: [dict]}
+        self.members = members              # {team: [dict]}
+        self.transfers = []                 # [(tipper, tippee, amount, bool)]
+        self.transferred = set()            # {(tipper, tippee)}
+        self.charges = []                   # [(username, amount, fee)]
+        self.credits = []                   # [(username, amount, fee)]
+        self.intents = []                   # [(username, kind, amount, fee)]
+
+    @classmethod
+    def snapshot(cls, db):
+        """Given a postgres.Postgres instance, return a Ledger.
+
+        We take the snapshot in a single REPEATABLE READ transaction, so that
+        it's consistent.
+
+        """
+        COLUMNS = PARTICIPANT_COLUMNS + ( 'pending'
+                                        , 'last_bill_result'
+                                        , 'last_ach_result'
+                                         )
+        with db.get_cursor(back_as=dict) as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            ts_start = cursor.one("SELECT CURRENT_TIMESTAMP")
+
+            participants = {}
+            for rec in cursor.all("SELECT {} FROM participants"
+                                  .format(', '.join(COLUMNS))):
+                participants[rec['username']] = rec
+
+            tips = {}
+            for rec in cursor.all("""\
+
+                SELECT DISTINCT ON (tipper, tippee)
+                       tipper, tippee, amount, ctime
+                  FROM tips
+              ORDER BY tipper, tippee, mtime DESC
+
+            """):
+                tips.setdefault(rec['tipper'], []).append(rec)
+
+            members = {}
+            for rec in cursor.all("""\
+
+                SELECT team, member AS username, take, ctime, mtime
+                  FROM current_memberships
+              ORDER BY ctime DESC
+
+            """):
+                members.setdefault(rec.pop('team'), []).append(rec)
+
+        return cls(ts_start, participants, tips, members)
+
+
+    def get_tips(self, tipper, for_payday):
+        """Given a username and a date (or False), return a list of dicts.
+
+        These are the same as what Participant.get_tips_and_total returns.
+
+        """
+        out = []
+        for tip in self.tips.get(tipper, []):
+            tippee = self.participants[tip['tippee']]
+            if tippee['is_suspicious'] is True:
+                continue
+            if for_payday and (tipper, tip['tippee']) in self.transferred:
+                continue
+            out.append({ 'amount': tip['amount']
+                       , 'tippee': tip['tippee']
+                       , 'ctime': tip['ctime']
+                       , 'claimed_time': tippee['claimed_time']
+                        })
+        if for_payday:
+            out.sort(key=lambda t: (t['ctime'], t['tippee']))
+        else:
+            out.sort(key=lambda t: (-t['amount'], t['tippee']))
+        return out
+
+
+class Latencies(object):
+    """Represent how long the last finished payday waited on things.
+
+    For each phase we take how long the last payday spent running SQL
+    statements per item (participant or team) and waiting on payment
+    processors per call, as recorded in payday_progress. Shards of a phase
+    ('payin.0', 'payin.1', ...) are added together.
+
+    """
+
+    # The kind of processor call that each phase makes.
+    PROCESSOR_CALLS = {'payin': 'charge', 'payout': 'credit'}
+
+    def __init__(self, ts_start, phases):
+        self.ts_start = ts_start
+        self.phases = phases        # {phase: dict}
+
+    @classmethod
+    def measure(cls, db):
+        """Given a postgres.Postgres instance, return a Latencies or None.
+
+        We return None if no payday has finished yet.
+
+        """
+        payday = db.one("""\
+
+            SELECT id
+                 , ts_start
+                 , COALESCE(ncharges, 0) + COALESCE(ncc_failing, 0) AS charge
+                 , COALESCE(nachs, 0) + COALESCE(nach_failing, 0) AS credit
+              FROM paydays
+             WHERE ts_end > ts_start
+          ORDER BY ts_start DESC
+             LIMIT 1
+
+        """, back_as=dict)
+        if payday is None:
+            return None
+
+        phases = {}
+        for rec in db.all("""\
+
+            SELECT regexp_replace(phase, '[.][0-9]+$', '') AS name
+                 , sum(nitems)::bigint AS nitems
+                 , sum(db_seconds) AS db_seconds
+                 , sum(processor_seconds) AS processor_seconds
+              FROM payday_progress
+             WHERE payday = %s
+          GROUP BY name
+
+        """, (payday['id'],), back_as=dict):
+            kind = cls.PROCESSOR_CALLS.get(rec['name'])
+            rec['ncalls'] = payday[kind] if kind else 0
+            phases[rec.pop('name')] = rec
+
+        return cls(payday['ts_start'], phases)
+
+    def estimate(self, phase, seconds, nitems, ncalls):
+        """Given a phase name, the seconds it took us to simulate it, and the
+        number of items and processor calls we projected for it, return the
+        number of seconds we expect it to take for real.
+
+        Phases that don't process items (zero_out_pending, etc.) are expected
+        to spend as long on the database as they did last time.
+
+        """
+        last = self.phases.get(phase)
+        if last is None:
+            return seconds
+
+        db_seconds = last['db_seconds']
+        if last['nitems']:
+            db_seconds *= float(nitems) / last['nitems']
+        processor_seconds = 0.0
+        if last['ncalls']:
+            processor_seconds = last['processor_seconds'] * float(ncalls) \
+                                                            / last['ncalls']
+        return seconds + db_seconds + processor_seconds
+
+
+class LedgerStats(PaydayStats):
+    """Accumulate payday statistics in memory only.
+    """
+
+    def __init__(self):
+        self.totals = dict((field, 0) for field in self.FIELDS)
+        super(LedgerStats, self).__init__(None)
+
+    def _flush(self):
+        for field, value in self.counters.items():
+            self.totals[field] += value
+        self.reset()
+
+    def recover(self, ts_start):
+        pass
+
+
+class LedgerProgress(PaydayProgress):
+    """Track progress through payday phases in memory only.
+    """
+
+    def __init__(self):
+        super(LedgerProgress, self).__init__(None)
+        self.rows = []
+
+    def _insert(self, phase, ts_start):
+        self.rows.append({'phase': phase, 'ts_start': ts_start})
+
+    def _update(self, row):
+        self.rows[-1].update(row)
+
+
+class LedgerCheckpoints(PaydayCheckpoints):
+    """Drop checkpoints, since a simulated payday is never resumed.
+    """
+
+    def __init__(self):
+        super(LedgerCheckpoints, self).__init__(None)
+
+    def _flush(self):
+        self.buffer = []
+
+
+class SimulatedPayday(Payday):
+    """Run payday against a Ledger instead of the database.
+
+    Instantiate with a postgres.Postgres instance and call simulate. The
+    database is only read when we start, to take the snapshot and to measure
+    the last payday's latencies.
+
+    """
+
+    def __init__(self, db):
+        super(SimulatedPayday, self).__init__(db)
+        self.stats = LedgerStats()
+        self.progress = LedgerProgress()
+        self.checkpoints = LedgerCheckpoints()
+        self.ledger = None
+        self.latencies = None
+        self.active = {}
+        self.timings = []
+
+    def simulate(self):
+        """Run a simulated payday and return a report dict (see report).
+        """
+        self.run()
+        return self.report()
+
+    def report(self):
+        """Return a dict describing the simulated payday.
+        """
+        out = dict(self.stats.totals)
+        out['ts_start'] = self.ledger.ts_start
+        out.update(self.active)
+        out['phases'] = self.timings
+        out['estimates'] = self.estimate()
+        if self.latencies is not None:
+            out['estimated_from'] = self.latencies.ts_start
+        out['transfers'] = self.ledger.transfers
+        out['charges'] = self.ledger.charges
+        out['credits'] = self.ledger.credits
+        return out
+
+    def estimate(self):
+        """Return a list of (phase, seconds) forecasting how long each phase
+        will take for real, or an empty list if no payday has finished yet.
+
+        The forecast is for a serial payday (no workers or shards).
+
+        """
+        if self.latencies is None:
+            return []
+        ncalls = {}
+        for username, kind, amount, fee in self.ledger.intents:
+            ncalls[kind] = ncalls.get(kind, 0) + 1
+        nitems = dict((row['phase'], row.get('nitems', 0))
+                      for row in self.progress.rows)
+        out = []
+        for name, seconds in self.timings:
+            kind = Latencies.PROCESSOR_CALLS.get(name)
+            out.append((name, self.latencies.estimate( name
+                                                     , seconds
+                                                     , nitems.get(name, 0)
+                                                     , ncalls.get(kind, 0)
+                                                      )))
+        return out
+
+    def run_phase(self, name, func, *a):
+        _start = time.time()
+        out = super(SimulatedPayday, self).run_phase(name, func, *a)
+        self.timings.append((name, time.time() - _start))
+        return out
+
+
+    # Reading.
+    # ========
+
+    def start(self):
+        self.ledger = Ledger.snapshot(self.db)
+        self.latencies = Latencies.measure(self.db)
+        log("Simulating payday from a snapshot of %d participants."
+            % len(self.ledger.participants))
+        log("Payday started at %s." % self.ledger.ts_start)
+        return self.ledger.ts_start
+
+    def count_participants(self, ts_start, phase=None, number=None):
+        return len(self._filter_participants(ts_start, number))
+
+    def get_participants(self, ts_start, phase=None, number=None):
+        for rec in self._filter_participants(ts_start, number):
+            rec = dict((k, rec[k]) for k in PARTICIPANT_COLUMNS)
+            yield participant_from_record(rec)
+
+    def _filter_participants(self, ts_start, number):
+        recs = [ p for p in self.ledger.participants.values()
+                 if p['claimed_time'] is not None
+                and p['claimed_time'] < ts_start
+                and p['is_suspicious'] is not True
+                and number in (None, p['number'])
+                ]
+        recs.sort(key=lambda p: p['claimed_time'])
+        return recs
+
+    def genparticipants(self, ts_start, for_payday, phase=None):
+        for participant in self.get_participants(ts_start):
+            tips = self.ledger.get_tips(participant.username, for_payday)
+            yield participant, tips, total_tips(tips, for_payday)
+
+    def get_memberships(self):
+        return dict((team, [dict(member) for member in members])
+                    for team, members in self.ledger.members.items())
+
+
+    # Writing.
+    # ========
+
+    def zero_out_pending(self, ts_start):
+        for p in self.ledger.participants.values():
+            if p['pending'] is None and p['claimed_time'] is not None \
+                                    and p['claimed_time'] < ts_start:
+                p['pending'] = Decimal('0.00')
+
+    def move_pending_to_balance_for_teams(self):
+        for p in self.ledger.participants.values():
+            if p['number'] == 'plural' and p['pending'] is not None:
+                p['balance'] += p['pending']
+                p['pending'] = Decimal('0.00')
+
+    def clear_pending_to_balance(self):
+        for p in self.ledger.participants.values():
+            if p['pending'] is not None:
+                p['balance'] += p['pending']
+                p['pending'] = None
+
+    def set_nactive(self, ts_start):
+        self.active = self.activity.counts()
+
+    def end(self):
+        log("Finished simulating payday.")
+
+    def apply_pachinko(self, team, transfers):
+        for tipper, tippee, amount in transfers:
+            self.transfer(tipper, tippee, amount, pachinko=True)
+
+    def transfer(self, tipper, tippee, amount, pachinko=False):
+        debit = self.ledger.participants[tipper]
+        credit = self.ledger.participants[tippee]
+        assert debit['pending'] is not None, (amount, tipper)
+        if debit['balance'] < amount:
+            return False
+        assert credit['pending'] is not None, (tippee, amount)
+
+        debit['balance'] -= amount
+        credit['pending'] += amount
+        self.ledger.transfers.append((tipper, tippee, amount, pachinko))
+        self.ledger.transferred.add((tipper, tippee))
+        self.activity.add([(tipper, tippee, amount)])
+
+        if pachinko:
+            self.mark_pachinko(amount)
+        else:
+            self.mark_transfer(amount)
+        return True
+
+    def open_intent(self, username, kind, processor, route, amount, fee):
+        self.ledger.intents.append((username, kind, amount, fee))
+        return len(self.ledger.intents)
+
+    def void_intent(self, intent):
+        pass
+
+    def record_charge(self, amount, charge_amount, fee, error, username,
+                      intent=None):
+        participant = self.ledger.participants[username]
+        if error:
+            amount = Decimal('0.00')
+            self.mark_charge_failed()
+        else:
+            self.ledger.charges.append((username, amount, fee))
+            self.mark_charge_success(charge_amount, fee)
+        participant['last_bill_result'] = error
+        participant['balance'] += amount
+
+    def record_credit(self, amount, fee, error, username, intent=None):
+        participant = self.ledger.participants[username]
+        credit = -amount
+        if error:
+            credit = fee = Decimal('0.00')
+            self.mark_ach_failed()
+        else:
+            self.ledger.credits.append((username, credit, fee))
+            self.mark_ach_success(amount, fee)
+        participant['last_ach_result'] = error
+        participant['balance'] += credit - fee
+
+
+    # Processors.
+    # ===========
+    # We predict that a card or bank account that failed last time will fail
+    # again, and that one that succeeded (or was never tried) will succeed.
+
+    def charge_on_balanced(self, username, balanced_account_uri, amount,
+                           intent=None):
+        return self._simulate_charge(username, amount, "Balanced")
+
+    def charge_on_stripe(self, username, stripe_customer_id, amount,
+                         intent=None):
+        return self._simulate_charge(username, amount, "Stripe")
+
+    def _simulate_charge(self, username, amount, processor):
+        cents, msg, charge_amount, fee = self._prep_hit(amount)
+        msg = msg % (username, processor)
+        error = self.ledger.participants[username]['last_bill_result'] or ""
+        log(msg + ("would fail: %s" % error if error else "would succeed."))
+        return charge_amount, fee, error
+
+    def credit_on_balanced(self, username, balanced_account_uri, cents, msg,
+                           intent=None):
+        error = self.ledger.participants[username]['last_ach_result'] or ""
+        log(msg + ("would fail: %s" % error if error else "would succeed."))
+        return error
+
+    def prefetch_accounts(self, participants, wanted):
+        return participants     # we never go to Balanced
+
+
+def format_report(report):
+    """Given a report dict from SimulatedPayday.simulate, return a list of lines.
+
+    The projected transfers, charges, and credits are listed at the end.
+
+    """
+    LISTS = ('phases', 'estimates', 'transfers', 'charges', 'credits')
+    out = ["Projected payday starting %s:" % report['ts_start']]
+    for key in sorted(report):
+        if key in ('ts_start', 'estimated_from') + LISTS:
+            continue
+        out.append("  %-20s %s" % (key, report[key]))
+    out.append("Projected timing:")
+    for name, seconds in report['phases']:
+        out.append("  %-35s %.3f seconds" % (name, seconds))
+    if report['estimates']:
+        out.append("Estimated duration, from the payday of %s:"
+                   % report['estimated_from'])
+        for name, seconds in report['estimates']:
+            out.append("  %-35s %.3f seconds" % (name, seconds))
+        total = sum(seconds for name, seconds in report['estimates'])
+        out.append("  %-35s %.3f seconds" % ('total', total))
+    else:
+        out.append("No payday has finished yet, so we can't estimate how "
+                   "long this one will take.")
+    out.append("Projected transfers:")
+    for tipper, tippee, amount, pachinko in report['transfers']:
+        note = " (pachinko)" if pachinko else ""
+        out.append("  %s -> %s %s%s" % (tipper, tippee, amount, note))
+    out.append("Projected charges:")
+    for username, amount, fee in report['charges']:
+        out.append("  %s %s (fee %s)" % (username, amount, fee))
+    out.append("Projected credits:")
+    for username, amount, fee in report['credits']:
+        out.append("  %s %s (fee %s)" % (username, amount, fee))
+    return out
@@ -16,24 +16,34 @@ under situations where funds contain funds themselves, and when the payout graph
 
 __author__ = "Roy Liu <carsomyr@gmail.com>"
 
+import random
 import sys
+import time
+from numpy import diag
+from numpy import zeros
+from scipy.sparse import coo_matrix
 from scipy.sparse import csr_matrix
 from scipy.sparse import eye
 from scipy.sparse import issparse
 from scipy.sparse import lil_matrix
+from scipy.sparse.linalg import gmres
+from scipy.sparse.linalg import splu
 
 class SteadyState:
     """Contains core functionality for computing the steady state payouts.
     """
 
+    # The largest graph for which solve will compute the full steady state matrix, which is dense.
+    max_dense_nodes = 5000
+
     def __init__(self):
         """Default constructor.
         """
 
     @staticmethod
     def converge(payouts, epsilon = 1e-10, max_rounds = 100):
-        """Computes the the payday steady state by iteratively building a geometric sum of the payout matrix. TODO: Use
-        a sparse solver to compute the exact answer.
+        """Computes the the payday steady state by iteratively building a geometric sum of the payout matrix. See solve
+        for the exact answer.
 
         Args:
             n_rounds: The number of payout rounds to run.
@@ -74,6 +84,218 @@ class SteadyState:
 
         return acc1 * payouts_d + acc2
 
+    @staticmethod
+    def solve(payouts, initial=None, method="lu", tol=1e-10):
+        """Computes the payday steady state exactly. Writing the payout matrix as A + D, where D is its diagonal, the
+        geometric sum in converge tends to (I - A)^-1 D, so we solve (I - A) X = D with a sparse solver instead.
+
+        The full steady state matrix is dense, so it's only computed for graphs of up to max_dense_nodes nodes.
+        Larger graphs (Gittip's has 100k+ nodes) must pass initial.
+
+        Args:
+            payouts: The sparse, square payout matrix.
+            initial: If given, a 1 x n vector of initial funds. We then solve the transposed system for this vector
+                only, which scales to graphs far too big for the full steady state matrix.
+            method: "lu" to use a sparse LU decomposition, or "iterative" to use GMRES.
+            tol: The tolerance for the iterative method.
+
+        Returns:
+            The steady state matrix, or the 1 x n steady state of the initial funds if those were given.
+        """
+        if not issparse(payouts):
+            raise ValueError("Please provide a sparse matrix")
+
+        (n_rows, n_cols) = payouts.shape
+
+        if n_rows != n_cols:
+            raise ValueError("The payout matrix must be square")
+
+        if method not in ("lu", "iterative"):
+            raise ValueError("Unknown method: %s" % method)
+
+        if initial is None and n_rows > SteadyState.max_dense_nodes:
+            raise ValueError("The steady state of %d nodes is too big to compute in full; pass initial" % n_rows)
+
+        diagonal = payouts.diagonal()
+
+        payouts_without_d = payouts.tocsr().copy()
+        payouts_without_d.setdiag([0] * n_rows)
+
+        system = (eye(n_rows, n_cols, format="csr") - payouts_without_d).tocsc()
+
+        if initial is not None:
+            initial = initial.toarray() if issparse(initial) else initial
+            rhs = zeros(n_rows)
+            rhs[:] = initial.ravel()
+            funds = SteadyState._solver(system.T.tocsc(), method, tol)(rhs)
+            return csr_matrix(funds * diagonal)
+
+        solve_one = SteadyState._solver(system, method, tol)
+
+        if method == "lu":
+            result = solve_one(diag(diagonal))
+        else:
+            result = zeros((n_rows, n_cols))
+            for i in diagonal.nonzero()[0]:
+                rhs = zeros(n_rows)
+                rhs[i] = diagonal[i]
+                result[:, i] = solve_one(rhs)
+
+        return csr_matrix(result)
+
+    @staticmethod
+    def _solver(system, method, tol):
+        """Prepares to solve a sparse system. For "lu" the system is factorized once, up front.
+
+        Returns:
+            A function of a right hand side that returns the solution.
+        """
+        if method == "lu":
+            return splu(system).solve
+
+        def solve_one(rhs):
+            (result, info) = gmres(system, rhs, tol=tol)
+
+            if info != 0:
+                raise RuntimeError("The payout matrix failed to converge")
+
+            return result
+
+        return solve_one
+
+    @staticmethod
+    def from_db(db):
+        """Builds the payout matrix for Gittip from the database. Each participant is a node. Teams pay each member
+        their take as a fraction of what the team receives (or of the total take, if that's more), and keep the rest.
+        Everyone else keeps everything.
+
+        Args:
+            db: A postgres.Postgres instance.
+
+        Returns:
+            A tuple of (usernames, payouts, initial), where usernames gives the node order, payouts is the sparse
+            payout matrix, and initial is a 1 x n sparse vector of what each participant receives from tips.
+        """
+        receiving = dict(db.all("""
+
+            SELECT tippee, sum(amount)
+              FROM ( SELECT DISTINCT ON (tipper, tippee)
+                            tippee, amount
+                       FROM tips
+                   ORDER BY tipper, tippee, mtime DESC
+                    ) AS tips
+             WHERE amount > 0
+          GROUP BY tippee
+
+        """, back_as=tuple))
+
+        takes = db.all("""
+
+            SELECT team, member, take
+              FROM current_memberships
+             WHERE take > 0
+
+        """, back_as=tuple)
+
+        teams = {}
+        for (team, member, take) in takes:
+            teams.setdefault(team, []).append((member, float(take)))
+
+        usernames = sorted(set(receiving) | set(teams) | set(member for (_, member, _) in takes))
+        index = dict((username, i) for (i, username) in enumerate(usernames))
+
+        (rows, cols, values) = ([], [], [])
+
+        for username in usernames:
+            i = index[username]
+            members = teams.get(username, [])
+            total_take = sum(take for (_, take) in members)
+            budget = max(float(receiving.get(username, 0)), total_take)
+
+            for (member, take) in members:
+                rows.append(i)
+                cols.append(index[member])
+                values.append(take / budget)
+
+            rows.append(i)
+            cols.append(i)
+            values.append(1.0 - total_take / budget if members else 1.0)
+
+        n = len(usernames)
+        payouts = coo_matrix((values, (rows, cols)), shape=(n, n)).tocsr()
+
+        initial = lil_matrix((1, n))
+
+        for (username, amount) in receiving.items():
+            initial[0, index[username]] = float(amount)
+
+        return (usernames, payouts, initial.tocsr())
+
+def random_payouts(n_nodes, n_teams, max_members=10, seed=None):
+    """Builds a random payout matrix for benchmarking. The first n_teams nodes are teams, whose members are random nodes
+    (including other teams, so that there are funds of funds and cycles). Each team keeps a random part of its funds.
+
+    Args:
+        n_nodes: The number of nodes.
+        n_teams: The number of teams.
+        max_members: The maximum number of members per team.
+        seed: The random seed.
+
+    Returns:
+        A tuple of (payouts, initial).
+    """
+    rng = random.Random(seed)
+    (rows, cols, values) = ([], [], [])
+
+    for i in range(n_nodes):
+        if i < n_teams:
+            members = set(rng.sample(range(n_nodes), rng.randint(1, max_members))) - set([i])
+            kept = rng.uniform(0.05, 0.5)
+            weights = [rng.random() for _ in members]
+            total = sum(weights)
+
+            for (member, weight) in zip(members, weights):
+                rows.append(i)
+                cols.append(member)
+                values.append((1 - kept) * weight / total)
+        else:
+            kept = 1.0
+
+        rows.append(i)
+        cols.append(i)
+        values.append(kept)
+
+    payouts = coo_matrix((values, (rows, cols)), shape=(n_nodes, n_nodes)).tocsr()
+    initial = csr_matrix([[rng.uniform(0, 100) for _ in range(n_nodes)]])
+
+    return (payouts, initial)
+
+def benchmark(sizes=(100, 1000, 10000, 100000), team_fraction=0.1, seed=0):
+    """Compares converge with both modes of solve on random topologies, and prints the timings.
+
+    Args:
+        sizes: The numbers of nodes to try.
+        team_fraction: The fraction of nodes that are teams.
+        seed: The random seed.
+    """
+    for n_nodes in sizes:
+        (payouts, initial) = random_payouts(n_nodes, int(n_nodes * team_fraction), seed=seed)
+        results = {}
+
+        for (name, compute) in [("lu", lambda: SteadyState.solve(payouts, initial, method="lu")),
+                                ("iterative", lambda: SteadyState.solve(payouts, initial, method="iterative")),
+                                ("converge", lambda: initial * SteadyState.converge(payouts))]:
+            start = time.time()
+
+            try:
+                results[name] = compute().toarray()
+            except (RuntimeError, MemoryError) as e:
+                print("%7d nodes %-10s failed: %s" % (n_nodes, name, e))
+                continue
+
+            error = abs(results[name] - results["lu"]).max() if "lu" in results else 0.0
+            print("%7d nodes %-10s %9.3f seconds (max difference from lu: %g)" % (n_nodes, name,
+                                                                                 time.time() - start, error))
 def main():
     """The main method body.
     """
@@ -90,6 +312,10 @@ def main():
     print(payouts.todense())
     print(initial.todense())
     print(initial * SteadyState.converge(payouts).todense())
+    print(SteadyState.solve(payouts, initial).todense())
+
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
 
 #
 
@@ -0,0 +1,276 @@
+"""Check participant balances against the ledger, incrementally.
+
+A participant's balance is expected to be receipts - disbursements, that is,
+the sum of their exchanges (charges count their amount, credits their
+amount less the fee, as on the history page) plus transfers to them less
+transfers from them. During payday incoming transfers accrue to pending, so
+that's balance + pending.
+
+Recomputing that from scratch means scanning all of exchanges and transfers.
+Instead we keep running totals in ledger_totals, and each run only folds in
+the rows added since the last run (as recorded in ledger_checks). Then we
+compare every participant's balance to their total and report the ones that
+have drifted. This is installed as `verify_balances`, via gittip.cli, to be
+run from cron.
+
+We don't lock exchanges or transfers, since that would hold up the site (and
+payday) for as long as we run. Instead we work from a REPEATABLE READ
+snapshot, in which balances and the ledger agree. A row can commit with an id
+below our ceiling after we've taken our snapshot, though, so we remember the
+ids at or below the ceiling that we couldn't see (pending), and look for them
+again next time. Ids that stay missing after every transaction that was in
+flight during our run has finished belong to rolled back transactions, and
+we forget them.
+
+"""
+from __future__ import unicode_literals
+
+from aspen import log
+
+
+TABLES = ('exchanges', 'transfers')
+
+
+class LedgerVerifier(object):
+    """Fold new exchanges and transfers into ledger_totals and find drift.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def run(self):
+        """Verify balances and return a list of drifted participants (dicts).
+        """
+        with self.db.get_cursor(back_as=dict) as cursor:
+            last = self.begin(cursor)
+            ceilings = self.get_ceilings(cursor)
+            nfolded = self.fold(cursor, last, ceilings)
+            pending = self.get_pending(cursor, last, ceilings)
+            drifted = self.get_drifted(cursor)
+            cursor.run("""\
+
+                INSERT INTO ledger_checks
+                            ( exchanges_through, transfers_through
+                            , exchanges_pending, transfers_pending
+                            , txid, nfolded, ndrifted
+                             )
+                     VALUES ( %s, %s
+                            , %s, %s
+                            , txid_current(), %s, %s
+                             )
+
+            """, ( ceilings['exchanges'], ceilings['transfers']
+                 , pending['exchanges'], pending['transfers']
+                 , nfolded, len(drifted)
+                  ))
+
+        for rec in drifted:
+            log("DRIFT: %(username)s has $%(balance)s but the ledger says "
+                "$%(expected)s." % rec)
+        log("Folded %d ledger rows. %d balances drifted."
+            % (nfolded, len(drifted)))
+        return drifted
+
+    def begin(self, cursor):
+        """Take our snapshot and return where the last run left off, as a dict.
+
+        We lock ledger_checks (which only the verifier writes) before the
+        snapshot is taken, so that runs and resets happen one at a time.
+
+        """
+        cursor.run("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.run("LOCK TABLE ledger_checks IN EXCLUSIVE MODE")
+        last = cursor.one("""\
+
+            SELECT exchanges_through, transfers_through
+                 , exchanges_pending, transfers_pending
+                 , txid
+              FROM ledger_checks
+          ORDER BY id DESC
+             LIMIT 1
+
+        """)
+        if last is None:
+            last = { 'exchanges_through': 0
+                   , 'transfers_through': 0
+                   , 'exchanges_pending': []
+                   , 'transfers_pending': []
+                   , 'txid': None
+                    }
+        return last
+
+    def get_ceilings(self, cursor):
+        return cursor.one("""\
+
+            SELECT (SELECT COALESCE(max(id), 0) FROM exchanges) AS exchanges
+                 , (SELECT COALESCE(max(id), 0) FROM transfers) AS transfers
+
+        """)
+
+    def get_params(self, last, ceilings):
+        params = {}
+        for table in TABLES:
+            params[table + '_since'] = last[table + '_through']
+            params[table + '_through'] = ceilings[table]
+            params[table + '_pending'] = last[table + '_pending']
+        return params
+
+    def fold(self, cursor, last, ceilings):
+        """Add ledger rows we haven't seen before to ledger_totals.
+
+        Those are the rows after the last run's ceilings, up to ours, and the
+        rows the last run was still waiting for. Return the number of
+        (participant, row) pairs folded in.
+
+        """
+        cursor.run("""\
+
+            CREATE TEMP TABLE ledger_deltas ON COMMIT DROP AS
+                SELECT participant
+                     , sum(delta) AS delta
+                     , count(*) AS nrows
+                  FROM (
+                        SELECT e.participant
+                             , CASE WHEN e.amount > 0 THEN e.amount
+                                    ELSE e.amount - e.fee
+                                END AS delta
+                          FROM exchanges e
+                         WHERE ( e.id > %(exchanges_since)s
+                                 AND e.id <= %(exchanges_through)s
+                                )
+                            OR e.id = ANY(%(exchanges_pending)s)
+                     UNION ALL
+                        SELECT x.tippee, x.amount
+                          FROM transfers x
+                         WHERE ( x.id > %(transfers_since)s
+                                 AND x.id <= %(transfers_through)s
+                                )
+                            OR x.id = ANY(%(transfers_pending)s)
+                     UNION ALL
+                        SELECT x.tipper, -x.amount
+                          FROM transfers x
+                         WHERE ( x.id > %(transfers_since)s
+                                 AND x.id <= %(transfers_through)s
+                                )
+                            OR x.id = ANY(%(transfers_pending)s)
+                       ) AS ledger
+              GROUP BY participant
+
+        """, self.get_params(last, ceilings))
+        cursor.run("""\
+
+            UPDATE ledger_totals t
+               SET total = t.total + d.delta
+              FROM ledger_deltas d
+             WHERE t.participant = d.participant
+
+        """)
+        cursor.run("""\
+
+            INSERT INTO ledger_totals
+                        (participant, total)
+                 SELECT participant, delta
+                   FROM ledger_deltas d
+                  WHERE NOT EXISTS (
+                            SELECT 1
+                              FROM ledger_totals t
+                             WHERE t.participant = d.participant
+                        )
+
+        """)
+        return int(cursor.one("SELECT COALESCE(sum(nrows), 0) "
+                              "FROM ledger_deltas"))
+
+    def get_pending(self, cursor, last, ceilings):
+        """Return a dict of lists of ids at or below our ceilings that we
+        can't see.
+
+        We keep waiting for the ids the last run was waiting for until every
+        transaction up to and including the last run's own has finished. A
+        transaction that took one of those ids did so in an INSERT that was
+        under way before the last run's snapshot, and that INSERT gave it a
+        transaction id before the last run got its own, when it recorded the
+        check. So after that, any id still missing was rolled back.
+
+        """
+        params = self.get_params(last, ceilings)
+        params['txid'] = last['txid']
+        out = {}
+        for table in TABLES:
+            out[table] = cursor.one("""\
+
+                SELECT COALESCE(array_agg(id ORDER BY id), '{{}}')
+                  FROM (
+                        SELECT generate_series( %({0}_since)s + 1
+                                              , %({0}_through)s
+                                               ) AS id
+                         UNION
+                        SELECT unnest(%({0}_pending)s::bigint[])
+                         WHERE txid_snapshot_xmin(txid_current_snapshot())
+                                   <= %(txid)s
+                       ) AS ids
+                 WHERE NOT EXISTS (SELECT 1 FROM {0} x WHERE x.id = ids.id)
+
+            """.format(table), params)
+        return out
+
+    def get_drifted(self, cursor):
+        return cursor.all("""\
+
+            SELECT username, balance, expected
+              FROM (
+                    SELECT p.username
+                         , COALESCE(p.balance, 0) + COALESCE(p.pending, 0)
+                               AS balance
+                         , COALESCE(t.total, 0) AS expected
+                      FROM participants p
+                 LEFT JOIN ledger_totals t ON t.participant = p.username
+                   ) AS balances
+             WHERE balance <> expected
+          ORDER BY username
+
+        """)
+
+    def reset(self, username):
+        """Recompute one participant's total from their entire history.
+
+        This is for after a drifted balance has been investigated and fixed
+        up in the ledger. We count exactly the rows that the last run had
+        folded in (those up to its ceilings that it wasn't waiting for), so
+        that later runs don't count any of them again.
+
+        """
+        with self.db.get_cursor(back_as=dict) as cursor:
+            last = self.begin(cursor)
+            params = dict(last, username=username)
+            cursor.run("DELETE FROM ledger_totals WHERE participant=%s",
+                       (username,))
+            cursor.run("""\
+
+                INSERT INTO ledger_totals
+                            (participant, total)
+                     SELECT %(username)s
+                          , ( SELECT COALESCE(sum(
+                                      CASE WHEN amount > 0 THEN amount
+                                           ELSE amount - fee
+                                       END), 0)
+                                FROM exchanges
+                               WHERE participant = %(username)s
+                                 AND id <= %(exchanges_through)s
+                                 AND NOT id = ANY(%(exchanges_pending)s)
+                             )
+                          + ( SELECT COALESCE(sum(amount), 0)
+                                FROM transfers
+                               WHERE tippee = %(username)s
+                                 AND id <= %(transfers_through)s
+                                 AND NOT id = ANY(%(transfers_pending)s)
+                             )
+                          - ( SELECT COALESCE(sum(amount), 0)
+                                FROM transfers
+                               WHERE tipper = %(username)s
+                                 AND id <= %(transfers_through)s
+                                 AND NOT id = ANY(%(transfers_pending)s)
+                             )
+
+            """, params)
+        log("Reset the ledger total for %s." % username)
@@ -1,9 +1,30 @@
-"""This is installed as `payday`.
+"""These are installed as `payday`, `reconcile_exchanges`, `verify_balances`,
+and `hash_api_keys`.
 """
+import argparse
+import io
+import os
+import sys
+
 from gittip import wireup
 
 
 def payday():
+    parser = argparse.ArgumentParser(description="Run Gittip's payday.")
+    parser.add_argument( '--simulate'
+                       , action='store_true'
+                       , help="run against an in-memory snapshot of the "
+                              "database, without writing to it or calling "
+                              "payment processors, and report the results"
+                        )
+    parser.add_argument( '--output'
+                       , metavar='PATH'
+                       , help="with --simulate, write the report (including "
+                              "the projected transfers, charges, and credits) "
+                              "to PATH instead of the log"
+                        )
+    args = parser.parse_args()
+
     db = wireup.db()
     wireup.billing()
     wireup.nanswers()
@@ -17,10 +38,108 @@ def payday():
     from gittip.billing.payday import Payday
 
     try:
-        Payday(db).run()
+        if args.simulate:
+            from gittip.billing.simulator import SimulatedPayday, format_report
+            import aspen
+            report = SimulatedPayday(db).simulate()
+            lines = format_report(report)
+            if args.output:
+                with io.open(args.output, 'w', encoding='UTF-8') as fp:
+                    for line in lines:
+                        fp.write(line + u'\n')
+                aspen.log("Wrote the simulated payday to %s." % args.output)
+            else:
+                for line in lines:
+                    aspen.log(line)
+        else:
+            # Set PAYDAY_BULK to yes to run payin with the set-based engine
+            # (see Payday.bulk_payin), PAYDAY_NWORKERS to talk to our
+            # processors from a thread pool, PAYDAY_NSHARDS to split payday
+            # across worker processes, and PAYDAY_LOG to write
+            # per-participant log records to a file as JSON lines instead of
+            # to stdout.
+            bulk = os.environ.get('PAYDAY_BULK', '').lower()
+            kw = { 'bulk': bulk in ('1', 'true', 'yes')
+                 , 'nworkers': int(os.environ.get('PAYDAY_NWORKERS', '0'))
+                 , 'log_path': os.environ.get('PAYDAY_LOG') or None
+                  }
+            nshards = int(os.environ.get('PAYDAY_NSHARDS', '0'))
+            if nshards > 1:
+                from gittip.billing.payday import ShardedPayday
+                ShardedPayday(db, nshards, wireup.db, **kw).run()
+            else:
+                Payday(db, **kw).run()
+
+            # Balances are checked against the ledger by verify_balances,
+            # which runs from cron rather than here, so that it can't hold up
+            # payday or the steps below.
+
+            # Balances have moved, so project the next payday from scratch.
+            from gittip.billing import projection
+            projection.refresh(db)
     except KeyboardInterrupt:
         pass
     except:
         import aspen
         import traceback
         aspen.log(traceback.format_exc())
+
+
+def reconcile_exchanges():
+    parser = argparse.ArgumentParser(description="Resolve exchange intents "
+                                                 "that payday left pending.")
+    parser.add_argument( '--once'
+                       , action='store_true'
+                       , help="resolve one batch and exit"
+                        )
+    args = parser.parse_args()
+
+    db = wireup.db()
+    wireup.billing()
+
+    from gittip.billing.reconciler import Reconciler
+
+    # Set RECONCILER_INTERVAL to the number of seconds to sleep when idle.
+    reconciler = Reconciler(db)
+    try:
+        if args.once:
+            reconciler.reconcile_batch()
+        else:
+            reconciler.run(int(os.environ.get('RECONCILER_INTERVAL', '60')))
+    except KeyboardInterrupt:
+        pass
+
+
+def verify_balances():
+    parser = argparse.ArgumentParser(description="Check participant balances "
+                                                 "against the ledger.")
+    parser.add_argument( '--reset'
+                       , metavar='USERNAME'
+                       , action='append'
+                       , default=[]
+                       , help="recompute this participant's ledger total from "
+                              "scratch first (may be given more than once)"
+                        )
+    args = parser.parse_args()
+
+    db = wireup.db()
+
+    from gittip.billing.verifier import LedgerVerifier
+
+    verifier = LedgerVerifier(db)
+    for username in args.reset:
+        verifier.reset(username.decode('UTF-8'))
+    if verifier.run():
+        sys.exit(1)
+
+
+def hash_api_keys():
+    argparse.ArgumentParser(description="Hash API keys that are only stored "
+                                        "in plain text.").parse_args()
+
+    db = wireup.db()
+
+    from aspen import log
+    from gittip.models.participant import backfill_api_key_hashes
+
+    log("Hashed %d API keys." % backfill_api_key_hashes(db))
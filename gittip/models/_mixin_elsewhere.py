@@ -3,6 +3,7 @@ import os
 from gittip import NotSane
 from aspen.utils import typecheck
 from psycopg2 import IntegrityError
+from gittip.security import sessions
 
 
 # Exceptions
@@ -338,7 +339,7 @@ class MixinElsewhere(object):
 
                 for archive_username in gen_random_usernames():
                     try:
-                        username = cursor.one("""
+                        archived = cursor.one("""
 
                             UPDATE participants
                                SET username=%s
@@ -346,7 +347,7 @@ class MixinElsewhere(object):
                                  , session_token=NULL
                                  , session_expires=now()
                              WHERE username=%s
-                         RETURNING username
+                         RETURNING id, username
 
                         """, ( archive_username
                              , archive_username.lower()
@@ -357,7 +358,7 @@ class MixinElsewhere(object):
                                   # extremely unlikely, but ...
                                   # XXX But can the UPDATE fail in other ways?
                     else:
-                        assert username == archive_username
+                        assert archived.username == archive_username
                         break
 
 
@@ -374,6 +375,11 @@ class MixinElsewhere(object):
                              )
                            )
 
+        if this_is_others_last_account_elsewhere:
+            # Now that we've committed, drop any cached sessions of the old
+            # participant (see gittip.security.sessions).
+            sessions.forget(archived.id)
+
 # Utter Hack
 # ==========
 
@@ -11,6 +11,7 @@ of participant, based on certain properties.
 from __future__ import print_function, unicode_literals
 
 import datetime
+import hashlib
 import random
 import uuid
 from decimal import Decimal
@@ -23,6 +24,7 @@ from psycopg2 import IntegrityError
 from postgres.orm import Model
 from gittip.models._mixin_elsewhere import MixinElsewhere
 from gittip.models._mixin_team import MixinTeam
+from gittip.security import sessions
 from gittip.utils import canonicalize
 
 
@@ -83,11 +85,17 @@ class Participant(Model, MixinElsewhere, MixinTeam):
     def from_api_key(cls, api_key):
         """Return an existing participant based on API key.
         """
-        return cls._from_thing("api_key", api_key)
+        if api_key is None:
+            return None
+        return cls._from_thing("api_key_hash", hash_api_key(api_key))
 
     @classmethod
     def _from_thing(cls, thing, value):
-        assert thing in ("id", "username_lower", "session_token", "api_key")
+        assert thing in ( "id"
+                        , "username_lower"
+                        , "session_token"
+                        , "api_key_hash"
+                         )
         return cls.db.one("""
 
             SELECT participants.*::participants
@@ -122,6 +130,7 @@ class Participant(Model, MixinElsewhere, MixinTeam):
                    , (new_token, self.id,)
                     )
         self.set_attributes(session_token=new_token)
+        sessions.forget(self.id)
 
     def set_session_expires(self, expires):
         """Set session_expires in the database.
@@ -162,9 +171,23 @@ class Participant(Model, MixinElsewhere, MixinTeam):
     # =======
 
     def recreate_api_key(self):
+        """Make a new API key and return it.
+
+        We only store a hash of the key, so this is the only chance to see it.
+
+        """
         api_key = str(uuid.uuid4())
-        SQL = "UPDATE participants SET api_key=%s WHERE username=%s"
-        gittip.db.run(SQL, (api_key, self.username))
+        api_key_hash = hash_api_key(api_key)
+        gittip.db.run("""\
+
+            UPDATE participants
+               SET api_key_hash=%s
+                 , api_key=NULL
+             WHERE username=%s
+
+        """, (api_key_hash, self.username))
+        self.set_attributes(api_key_hash=api_key_hash, api_key=None)
+        sessions.forget(self.id)
         return api_key
 
 
@@ -287,6 +310,7 @@ class Participant(Model, MixinElsewhere, MixinTeam):
 
             assert (suggested, lowercased) == actual  # sanity check
             self.set_attributes(username=suggested, username_lower=lowercased)
+            sessions.forget(self.id)
 
 
     def update_goal(self, goal):
@@ -337,6 +361,10 @@ class Participant(Model, MixinElsewhere, MixinTeam):
         args = (self.username, tippee, self.username, tippee, amount, \
                                                                  self.username)
         first_time_tipper = gittip.db.one(NEW_TIP, args)
+
+        from gittip.billing import projection  # avoid circular import
+        projection.updater.add([self.username])
+
         return amount, first_time_tipper
 
 
@@ -629,27 +657,73 @@ class Participant(Model, MixinElsewhere, MixinTeam):
 
         """ % (ts_filter, order_by)  # XXX, No injections here, right?!
         tips = self.db.all(TIPS, args, back_as=dict)
+        return tips, total_tips(tips, for_payday)
 
 
-        # Compute the total.
-        # ==================
-        # For payday we only want to process payments to tippees who have
-        # themselves opted into Gittip. For the tipper's profile page we want
-        # to show the total amount they've pledged (so they're not surprised
-        # when someone *does* start accepting tips and all of a sudden they're
-        # hit with bigger charges.
+    @classmethod
+    def get_tips_and_totals(cls, participants, for_payday=False):
+        """Given a list of participants and a date, return a list of tuples.
+
+        This is a batched version of get_tips_and_total for payday: we fetch
+        tips for all of the given participants in one query, and we check for
+        tips that have already been transferred during this payday with an
+        anti-join instead of a subquery per tip. The return value is a list of
+        (participant, tips, total) in the same order as participants.
+
+        """
+        usernames = [p.username for p in participants]
 
         if for_payday:
-            to_total = [t for t in tips if t['claimed_time'] is not None]
+            order_by = "ctime ASC"
+            ts_filter = """\
+
+                   AND mtime < %(ts)s
+                   AND NOT EXISTS ( SELECT 1
+                                      FROM transfers
+                                     WHERE tipper=t.tipper
+                                       AND tippee=t.tippee
+                                       AND timestamp >= %(ts)s
+                                   )
+
+            """
         else:
-            to_total = tips
-        total = sum([t['amount'] for t in to_total])
+            order_by = "amount DESC"
+            ts_filter = ""
 
-        if not total:
-            # If to_total is an empty list, total is int 0. We want a Decimal.
-            total = Decimal('0.00')
+        TIPS = """\
 
-        return tips, total
+            SELECT * FROM (
+                SELECT DISTINCT ON (tipper, tippee)
+                       tipper
+                     , amount
+                     , tippee
+                     , t.ctime
+                     , p.claimed_time
+                  FROM tips t
+                  JOIN participants p ON p.username = t.tippee
+                 WHERE tipper = ANY(%%(usernames)s)
+                   AND p.is_suspicious IS NOT true
+                   %s
+              ORDER BY tipper
+                     , tippee
+                     , t.mtime DESC
+            ) AS foo
+            ORDER BY tipper
+                   , %s
+                   , tippee
+
+        """ % (ts_filter, order_by)
+        args = {'usernames': usernames, 'ts': for_payday}
+
+        tips_by_tipper = dict((username, []) for username in usernames)
+        for tip in cls.db.all(TIPS, args, back_as=dict):
+            tips_by_tipper[tip.pop('tipper')].append(tip)
+
+        out = []
+        for participant in participants:
+            tips = tips_by_tipper[participant.username]
+            out.append((participant, tips, total_tips(tips, for_payday)))
+        return out
 
 
     def get_og_title(self):
@@ -697,9 +771,87 @@ class NoSelfTipping(Exception): pass
 class BadAmount(Exception): pass
 
 
+# Tip Helpers
+# ===========
+
+def total_tips(tips, for_payday):
+    """Given a list of tip dicts and a date (or False), return a Decimal.
+
+    For payday we only want to process payments to tippees who have
+    themselves opted into Gittip. For the tipper's profile page we want to
+    show the total amount they've pledged (so they're not surprised when
+    someone *does* start accepting tips and all of a sudden they're hit with
+    bigger charges.
+
+    """
+    if for_payday:
+        to_total = [t for t in tips if t['claimed_time'] is not None]
+    else:
+        to_total = tips
+    total = sum([t['amount'] for t in to_total])
+
+    if not total:
+        # If to_total is an empty list, total is int 0. We want a Decimal.
+        total = Decimal('0.00')
+
+    return total
+
+
 # Username Helpers
 # ================
 
+def hash_api_key(api_key):
+    """Given an API key, return the hex SHA-256 hash that we store.
+
+    API keys are random UUIDs, so a fast, unsalted hash is enough.
+
+    """
+    if isinstance(api_key, unicode):
+        api_key = api_key.encode('UTF-8')
+    return hashlib.sha256(api_key).hexdigest()
+
+
+def backfill_api_key_hashes(db):
+    """Given a Postgres object, hash API keys that are only stored in plain.
+
+    This is safe to run more than once, and while the site is up. It leaves
+    the plaintext keys alone, so that we can still go back to them until a
+    deploy has shown that the hashes work. Return the number of participants
+    whose key we hashed.
+
+    """
+    keys = db.all("""\
+
+        SELECT api_key
+          FROM participants
+         WHERE api_key IS NOT NULL
+           AND api_key_hash IS NULL
+
+    """)
+    n = 0
+    for api_key in keys:
+        with db.get_cursor() as cursor:
+            api_key_hash = hash_api_key(api_key)
+            n += len(cursor.all("""\
+
+                UPDATE participants
+                   SET api_key_hash=%s
+                 WHERE api_key=%s
+                   AND api_key_hash IS NULL
+             RETURNING username
+
+            """, (api_key_hash, api_key)))
+            cursor.run("""\
+
+                UPDATE api_keys
+                   SET api_key_hash=%s
+                 WHERE api_key=%s
+                   AND api_key_hash IS NULL
+
+            """, (api_key_hash, api_key))
+    return n
+
+
 def gen_random_usernames():
     """Yield up to 100 random 12-hex-digit unicodes.
 
@@ -4,7 +4,6 @@ import rfc822
 import time
 
 from aspen import Response
-from gittip.security import csrf
 from gittip.security.user import User
 
 
@@ -37,12 +36,8 @@ def inbound(request):
             user = User.from_api_key(token)
 
             # We don't require CSRF if they basically authenticated.
-            csrf_token = csrf._get_new_csrf_key()
-            request.headers.cookie['csrf_token'] = csrf_token
-            request.headers['X-CSRF-TOKEN'] = csrf_token
-            if 'Referer' not in request.headers:
-                request.headers['Referer'] = \
-                                        'https://%s/' % csrf._get_host(request)
+            if not user.ANON:
+                request.context['csrf_exempt'] = True
     elif 'session' in request.headers.cookie:
         token = request.headers.cookie['session'].value
         user = User.from_session_token(token)
@@ -95,8 +90,7 @@ def outbound(response):
     else: # user is authenticated
         response.headers['Expires'] = BEGINNING_OF_EPOCH # don't cache
         response.headers.cookie['session'] = user.participant.session_token
-        expires = time.time() + TIMEOUT
-        user.keep_signed_in_until(expires)
+        expires = user.keep_signed_in_until(time.time() + TIMEOUT)
 
     cookie = response.headers.cookie['session']
     # I am not setting domain, because it is supposed to default to what we
@@ -87,6 +87,12 @@ def inbound(request):
     """Given a Request object, reject it if it's a forgery.
     """
 
+    if request.context.get('csrf_exempt'):
+        # Authenticated with an API key (see authentication.inbound). Don't
+        # check, and don't set a cookie either (see outbound).
+        request.context['csrf_token'] = None
+        return
+
     try:
         csrf_token = request.headers.cookie.get('csrf_token')
         csrf_token = '' if csrf_token is None else csrf_token.value
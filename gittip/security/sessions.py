@@ -0,0 +1,210 @@
+"""Look up and extend sessions without hitting participants on every request.
+
+authentication.inbound used to SELECT the participant for a session token on
+every request. Now it goes through a SessionCache, which keeps recently seen
+participants in memory for up to ttl seconds. Anything that revokes a session
+(signing in or out, being marked suspicious, being archived by take_over)
+calls forget, so a revoked session is never honored by this process. Other
+processes find out when their entries expire, so keep ttl short if there are
+several.
+
+API keys get a SessionCache of their own, and recreating a key forgets the
+participant there too.
+
+authentication.outbound used to UPDATE session_expires for every response to
+a signed-in user, so every page view and JSON call wrote to participants. Now
+it goes through a SessionRefresher, which only extends a session when less
+than refresh_within seconds of it remain, and which buffers the new expiry
+times in memory and writes them all with one UPDATE every flush_every
+seconds, from a background thread (see wireup.sessions).
+
+If we crash before a flush, the sessions in the buffer keep their old expiry
+times, which are at least refresh_within seconds after the request that
+extended them, so nobody gets signed out early.
+
+"""
+from __future__ import unicode_literals
+
+import calendar
+import collections
+import datetime
+import threading
+import time
+
+import pytz
+from aspen import log
+
+
+class SessionRefresher(object):
+    """Decide when to extend sessions, and write the new expiry times.
+
+    Instantiate with a postgres.Postgres instance, a number of seconds, and a
+    number of seconds. With flush_every 0 we write through to the database
+    instead of buffering.
+
+    """
+
+    def __init__(self, db, refresh_within, flush_every):
+        self.db = db
+        self.refresh_within = refresh_within
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.pending = {}   # {participant id: datetime}
+
+    def refresh(self, participant, expires):
+        """Given a Participant and a UNIX timestamp, return a UNIX timestamp.
+
+        If the participant's session has more than refresh_within seconds
+        left we leave it alone, and return when it expires. Otherwise we
+        extend it to expires, and return that.
+
+        """
+        current = participant.session_expires
+        if current is not None:
+            current = calendar.timegm(current.utctimetuple())
+            if current - time.time() > self.refresh_within:
+                return current
+
+        if not self.flush_every:
+            participant.set_session_expires(expires)
+            return expires
+
+        session_expires = datetime.datetime.fromtimestamp(expires) \
+                                                      .replace(tzinfo=pytz.utc)
+        with self.lock:
+            self.pending[participant.id] = session_expires
+        participant.set_attributes(session_expires=session_expires)
+        return expires
+
+    def flush(self):
+        """Write buffered expiry times to the database with one UPDATE.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        with self.db.get_cursor() as cursor:
+            values = ', '.join([cursor.mogrify("(%s, %s)", row).decode('UTF-8')
+                                for row in sorted(pending.items())])
+            cursor.run("""\
+
+                UPDATE participants p
+                   SET session_expires=v.session_expires
+                  FROM (VALUES %s) AS v (id, session_expires)
+                 WHERE p.id=v.id
+                   AND p.is_suspicious IS NOT true
+
+            """ % values)
+
+    def run(self):
+        """Flush every flush_every seconds, forever.
+        """
+        while True:
+            time.sleep(self.flush_every)
+            try:
+                self.flush()
+            except Exception as exc:
+                log("Couldn't flush session expiry times: %s" % exc)
+
+    def start(self):
+        """Start flushing on a daemon thread, if we're buffering.
+        """
+        if not self.flush_every:
+            return
+        flusher = threading.Thread(target=self.run)
+        flusher.daemon = True
+        flusher.start()
+
+
+class SessionCache(object):
+    """Map session tokens (or API keys) to participant ids, for at most ttl
+    seconds.
+
+    Instantiate with a number of seconds and a maximum number of entries.
+    With ttl 0 nothing is cached. When we're full we drop the least recently
+    used entry.
+
+    We only cache which participant a token belongs to, not the participant
+    itself: their row is loaded by id on every request, so that changes to
+    it (a new card, is_suspicious, and so on) show up right away. Only
+    changes to who a token belongs to need a forget.
+
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # {token: (timestamp, id)}
+        self.generation = 0     # bumped by forget
+
+    def get(self, token, fetch):
+        """Given a session token and a callable, return a Participant or None.
+
+        On a miss we call fetch with the token to look up the participant.
+
+        """
+        if not self.ttl:
+            return fetch(token)
+
+        with self.lock:
+            entry = self.entries.pop(token, None)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.entries[token] = entry     # most recently used
+                participant_id = entry[1]
+            else:
+                participant_id = None
+            generation = self.generation
+
+        if participant_id is not None:
+            participant = load(participant_id)
+            if participant is not None:
+                return participant
+
+        participant = fetch(token)
+        if participant is None:
+            return None
+
+        with self.lock:
+            # If a session was revoked while we were fetching, what we fetched
+            # may already be stale, so don't keep it.
+            if self.generation == generation:
+                self.entries[token] = (time.time(), participant.id)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return participant
+
+    def forget(self, participant_id):
+        """Given a participant id, drop their entries.
+        """
+        with self.lock:
+            self.generation += 1
+            for token, (ts, _participant_id) in self.entries.items():
+                if _participant_id == participant_id:
+                    del self.entries[token]
+
+
+def load(participant_id):
+    """Given a participant id, return their current row as a Participant.
+    """
+    # Import here, since the participant model imports us.
+    from gittip.models.participant import Participant
+    return Participant.from_id(participant_id)
+
+
+def forget(participant_id):
+    """Given a participant id, drop them from both caches.
+
+    Call this after committing anything that should end or change their
+    sessions or API access.
+
+    """
+    cache.forget(participant_id)
+    api_key_cache.forget(participant_id)
+
+
+# Until wireup.sessions configures real ones, look up the participant and
+# extend their session on every request, writing through, as we used to.
+refresher = SessionRefresher(None, 0, 0)
+cache = SessionCache(0, 0)
+api_key_cache = SessionCache(0, 0)
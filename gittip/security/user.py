@@ -1,4 +1,5 @@
 from gittip.models.participant import Participant
+from gittip.security import sessions
 
 
 class User(object):
@@ -16,7 +17,9 @@ class User(object):
         """Find a participant based on token and return a User.
         """
         self = cls()
-        self.participant = Participant.from_session_token(token)
+        self.participant = sessions.cache.get( token
+                                             , Participant.from_session_token
+                                              )
         return self
 
     @classmethod
@@ -24,7 +27,9 @@ class User(object):
         """Find a participant based on token and return a User.
         """
         self = cls()
-        self.participant = Participant.from_api_key(api_key)
+        self.participant = sessions.api_key_cache.get( api_key
+                                                     , Participant.from_api_key
+                                                      )
         return self
 
     @classmethod
@@ -56,9 +61,11 @@ class User(object):
         """Extend the user's current session.
 
         :param float expires: A UNIX timestamp (XXX timezone?)
+        :returns: A UNIX timestamp, when the session actually expires (see
+            gittip.security.sessions)
 
         """
-        self.participant.set_session_expires(expires)
+        return sessions.refresher.refresh(self.participant, expires)
 
     def sign_out(self):
         """End the user's current session.
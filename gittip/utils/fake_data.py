@@ -2,6 +2,7 @@ from faker import Factory
 from gittip import wireup, MAX_TIP, MIN_TIP
 from gittip.models.participant import Participant
 
+import bisect
 import decimal
 import random
 import string
@@ -48,13 +49,25 @@ def fake_int_id(nmax=2 ** 31 -1):
     return random.randint(0, nmax)
 
 
-def fake_participant(db, number="singular", is_admin=False, anonymous=False):
+def fake_int_ids(n, nmax=2 ** 31 - 1):
+    """Return an iterator over n distinct random int ids.
+    """
+    return iter(random.sample(xrange(1, nmax + 1), n))
+
+
+def fake_participant(db, number="singular", is_admin=False, anonymous=False,
+                     id=None, suffix=''):
     """Create a fake User.
+
+    Pass an id and a username suffix that are unique to this run if you're
+    making a lot of participants; random ones start colliding in the tens of
+    thousands.
+
     """
-    username = faker.firstName() + fake_text_id(3)
+    username = faker.firstName() + fake_text_id(3) + suffix
     _fake_thing( db
                , "participants"
-               , id=fake_int_id()
+               , id=fake_int_id() if id is None else id
                , username=username
                , username_lower=username.lower()
                , statement=faker.sentence()
@@ -82,12 +95,12 @@ def fake_tip_amount():
     return decimal_amount
 
 
-def fake_tip(db, tipper, tippee):
+def fake_tip(db, tipper, tippee, id=None):
     """Create a fake tip.
     """
     _fake_thing( db
                , "tips"
-               , id=fake_int_id()
+               , id=fake_int_id() if id is None else id
                , ctime=faker.dateTimeThisYear()
                , mtime=faker.dateTimeThisMonth()
                , tipper=tipper.username
@@ -96,7 +109,7 @@ def fake_tip(db, tipper, tippee):
                 )
 
 
-def fake_elsewhere(db, participant, platform=None):
+def fake_elsewhere(db, participant, platform=None, id=None):
     """Create a fake elsewhere.
     """
     if platform is None:
@@ -124,22 +137,60 @@ def fake_elsewhere(db, participant, platform=None):
 
     _fake_thing( db
                , "elsewhere"
-               , id=fake_int_id()
+               , id=fake_int_id() if id is None else id
                , platform=platform
-               , user_id=fake_text_id()
+               , user_id=fake_text_id() + str(participant.id)
                , is_locked=False
                , participant=participant.username
                , user_info=info_templates[platform]
                 )
 
 
-def populate_db(db, num_participants=100, num_tips=50, num_teams=5):
+def fake_tip_pairs(tippers, tippees, num_tips, tippee_exponent=None):
+    """Return a list of num_tips (tipper, tippee) pairs.
+
+    By default tippees are picked uniformly at random. If tippee_exponent is
+    given then the tippee at rank r (in a random ranking) is picked with
+    probability proportional to r ** -tippee_exponent, which gives the
+    long-tailed distribution we see in real life: a few participants receive
+    most of the tips.
+
+    """
+    tippees = list(tippees)
+    random.shuffle(tippees)
+    cumulative = []
+    total = 0.0
+    for rank in xrange(1, len(tippees) + 1):
+        total += 1.0 if tippee_exponent is None else rank ** -tippee_exponent
+        cumulative.append(total)
+
+    pairs = []
+    while len(pairs) < num_tips:
+        tipper = random.choice(tippers)
+        i = bisect.bisect(cumulative, random.random() * total)
+        tippee = tippees[min(i, len(tippees) - 1)]
+        if tipper.username != tippee.username:
+            pairs.append((tipper, tippee))
+    return pairs
+
+
+def populate_db(db, num_participants=100, num_tips=50, num_teams=5,
+                tippee_exponent=None):
     """Populate DB with fake data.
+
+    See fake_tip_pairs for tippee_exponent.
+
     """
+    # Draw all ids up front, so that they're unique however many we make.
+    ids = fake_int_ids( num_participants * (1 + len(platforms))
+                      + num_teams
+                      + num_tips
+                       )
+
     #Make the participants
     participants = []
     for i in xrange(num_participants):
-        p = fake_participant(db)
+        p = fake_participant(db, id=next(ids), suffix=str(i))
         participants.append(p)
 
     #Make the "Elsewhere's"
@@ -147,20 +198,30 @@ def populate_db(db, num_participants=100, num_tips=50, num_teams=5):
         #All participants get between 1 and 3 elsewheres
         num_elsewheres = random.randint(1, 3)
         for platform_name in platforms[:num_elsewheres]:
-            fake_elsewhere(db, p, platform_name)
+            fake_elsewhere(db, p, platform_name, id=next(ids))
 
     #Make teams
+    teams = []
     for i in xrange(num_teams):
-        t = fake_participant(db, number="plural")
+        t = fake_participant( db
+                            , number="plural"
+                            , id=next(ids)
+                            , suffix=str(num_participants + i)
+                             )
+        teams.append(t)
         #Add 1 to 3 members to the team
         members = random.sample(participants, random.randint(1, 3))
         for p in members:
             t.add_member(p)
 
     #Make the tips
-    for i in xrange(num_tips):
-        tipper, tippee = random.sample(participants, 2)
-        fake_tip(db, tipper, tippee)
+    pairs = fake_tip_pairs( participants
+                          , participants + teams
+                          , num_tips
+                          , tippee_exponent
+                           )
+    for tipper, tippee in pairs:
+        fake_tip(db, tipper, tippee, id=next(ids))
 
 
 def main():
@@ -1,3 +1,4 @@
+import collections
 import sys
 import threading
 import time
@@ -19,6 +20,7 @@ class Entry(object):
     timestamp = None    # The timestamp of the last query run [datetime.datetime]
     lock = None         # Access control for this record [threading.Lock]
     exc = None          # Any exception in query or formatting [Exception]
+    size = 0            # Approximate size of result in bytes [int]
 
     def __init__(self, timestamp=0, lock=None, result=None):
         """Populate with dummy data or an actual db entry.
@@ -28,6 +30,27 @@ class Entry(object):
         self.result = result
 
 
+def approximate_size(obj, depth=3):
+    """Given an object, return its approximate size in bytes.
+
+    We count the object itself plus, for lists, tuples, sets, and dicts, their
+    items, down to depth levels. That's enough for result sets (lists of
+    records) and what callbacks usually make of them.
+
+    """
+    size = sys.getsizeof(obj)
+    if depth > 0:
+        if isinstance(obj, dict):
+            items = obj.keys() + obj.values()
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            items = obj
+        else:
+            items = ()
+        for item in items:
+            size += approximate_size(item, depth - 1)
+    return size
+
+
 class QueryCache(object):
     """Implement a caching SQL post-processor.
 
@@ -56,6 +79,13 @@ class QueryCache(object):
     entries on a more relaxed schedule (default: 60 seconds). It keeps the
     cache clean without interfering too much with actual usage.
 
+    Since callers often build queries from the querystring, the number of
+    distinct keys can be large. To bound memory, pass max_entries and/or
+    max_bytes (measured approximately, see approximate_size). When the cache
+    goes over either, we evict the least recently used entries in one batch
+    until it's back under 90% of both, and count them in <self.nevictions>.
+    The cache is kept in order of use, so finding those entries is cheap.
+
     If the actual database call or the formatting callback raise an Exception,
     then that is cached as well, and will be raised on further calls until the
     cache expires as usual.
@@ -66,23 +96,32 @@ class QueryCache(object):
     """
 
     db = None               # PostgresManager object
-    cache = None            # the query cache [dictionary]
+    cache = None            # the query cache, least recently used first
+                            # [collections.OrderedDict]
     locks = None            # access controls for self.cache [Locks]
     threshold = 5           # maximum life of a cache entry [seconds as int]
     threshold_prune = 60    # time between pruning runs [seconds as int]
+    max_entries = None      # maximum number of entries [int or None]
+    max_bytes = None        # approximate maximum size of results [int or None]
+    nbytes = 0              # approximate size of results [int]
+    nevictions = 0          # entries evicted to stay under budget [int]
 
 
-    def __init__(self, db, threshold=5, threshold_prune=60):
+    def __init__(self, db, threshold=5, threshold_prune=60, max_entries=None,
+                 max_bytes=None):
         """
         """
         self.db = db
         self.threshold = threshold
         self.threshold_prune = threshold_prune
-        self.cache = {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()
 
         class Locks:
             checkin = threading.Lock()
             checkout = threading.Lock()
+            accounting = threading.Lock()
         self.locks = Locks()
 
         self.pruner = threading.Thread(target=self.prune)
@@ -130,7 +169,12 @@ class QueryCache(object):
 
                 entry = self.cache[key]
                 entry.lock.acquire()
-                entry = self.cache[key]
+                self.locks.checkin.acquire()
+                try:  # critical section
+                    entry = self.cache.pop(key)
+                    self.cache[key] = entry     # most recently used
+                finally:
+                    self.locks.checkin.release()
 
             else:
 
@@ -185,6 +229,10 @@ class QueryCache(object):
             # Check the queryset back in.
             # ===========================
 
+            size = approximate_size(entry.result)
+            self._account(size - entry.size)
+            entry.size = size
+
             self.locks.checkin.acquire()
             try:  # critical section
                 entry.timestamp = time.time()
@@ -198,6 +246,65 @@ class QueryCache(object):
 
         finally:
             entry.lock.release()
+            if self._over_budget():
+                self.evict()
+
+
+    # Memory accounting.
+    # ==================
+
+    def _account(self, delta):
+        with self.locks.accounting:
+            self.nbytes += delta
+
+    def _over_budget(self, headroom=False):
+        """Return whether we're over budget, or within 10% of it if headroom.
+        """
+        if self.max_entries is not None:
+            limit = self.max_entries
+            if headroom:
+                limit -= self.max_entries // 10
+            if len(self.cache) > limit:
+                return True
+        if self.max_bytes is not None:
+            limit = self.max_bytes
+            if headroom:
+                limit -= self.max_bytes // 10
+            if self.nbytes > limit:
+                return True
+        return False
+
+    def evict(self):
+        """Remove least recently used entries until we're under budget.
+
+        We leave 10% headroom, so that we don't have to evict again on the
+        very next miss. Entries that are in use are skipped, as in prune, and
+        go back at the end of the line.
+
+        """
+        self.locks.checkout.acquire()
+        self.locks.checkin.acquire()
+        try:  # critical section
+            busy = []
+            while self.cache and self._over_budget(headroom=True):
+                key, entry = self.cache.popitem(last=False)
+                if not entry.lock.acquire(False):
+                    busy.append((key, entry))
+                    continue
+                try:  # critical section
+                    self._account(-entry.size)
+                    self.nevictions += 1
+                finally:
+                    entry.lock.release()
+            for key, entry in busy:
+                self.cache[key] = entry
+        finally:
+            self.locks.checkin.release()
+            self.locks.checkout.release()
+
+    def _remove(self, key, entry):
+        del self.cache[key]
+        self._account(-entry.size)
 
 
     def prune(self):
@@ -232,7 +339,7 @@ class QueryCache(object):
 
                     try:  # critical section
                         if time.time() - entry.timestamp > self.threshold_prune:
-                            del self.cache[key]
+                            self._remove(key, entry)
                     finally:
                         entry.lock.release()
 
@@ -0,0 +1,56 @@
+"""Values that every page shows, computed once for the whole process.
+
+The footer of every page says how many people are active on Gittip and how
+much money changes hands each week. We used to look that up from paydays, and
+format it, on every request (including for assets and JSON). Now a SiteGlobals
+looks it up when asked to refresh, which configure-aspen.py does at startup
+and then on a timer, and keeps an immutable, preformatted Snapshot that the
+inbound hook puts into each request's context.
+
+"""
+from __future__ import unicode_literals
+
+import locale
+from collections import namedtuple
+
+
+Snapshot = namedtuple('Snapshot', 'gnactive gtransfer_volume')
+
+
+def format_snapshot(nactive, transfer_volume):
+    """Given two numbers, return a Snapshot, rounded to the hundreds.
+    """
+    fmt = lambda n: locale.format("%d", round(n, -2), grouping=True)
+    return Snapshot(fmt(nactive), fmt(transfer_volume))
+
+
+class SiteGlobals(object):
+    """Hold the current Snapshot of site globals.
+
+    Instantiate with a postgres.Postgres instance. The snapshot is replaced
+    whole on refresh, so readers on other threads don't need a lock.
+
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.snapshot = format_snapshot(0, 0)
+
+    def refresh(self):
+        """Look up the latest payday's numbers and replace the snapshot.
+        """
+        nactive, transfer_volume = self.db.one("""\
+
+            SELECT nactive, transfer_volume
+              FROM paydays
+          ORDER BY ts_end DESC
+             LIMIT 1
+
+        """, default=(0, 0.0))
+        self.snapshot = format_snapshot(nactive, transfer_volume)
+        return self.snapshot
+
+    def inbound(self, request):
+        """An inbound hook to put the snapshot into the request context.
+        """
+        request.context.update(self.snapshot._asdict())
@@ -78,6 +78,33 @@ def nmembers(website):
     community.NMEMBERS_THRESHOLD = int(os.environ['NMEMBERS_THRESHOLD'])
     website.NMEMBERS_THRESHOLD = community.NMEMBERS_THRESHOLD
 
+def sessions(website):
+    """Configure sessions from settings that envvars has read.
+    """
+    from gittip.security import sessions
+    refresher = sessions.SessionRefresher( gittip.db
+                                         , website.session_refresh_within
+                                         , website.session_flush_every
+                                          )
+    refresher.start()
+    sessions.refresher = refresher
+
+    ttl = website.session_cache_ttl
+    size = website.session_cache_size
+    sessions.cache = sessions.SessionCache(ttl, size)
+    sessions.api_key_cache = sessions.SessionCache(ttl, size)
+
+def projection(website):
+    """Seed the projected payday and start updating it in the background.
+    """
+    from gittip.billing import projection
+    projection.seed(gittip.db)
+    updater = projection.ProjectionUpdater( gittip.db
+                                          , website.projection_flush_every
+                                           )
+    updater.start()
+    projection.updater = updater
+
 def envvars(website):
 
     missing_keys = []
@@ -91,6 +118,10 @@ def envvars(website):
     def is_yesish(val):
         return val.lower() in ('1', 'true', 'yes')
 
+    def int_envvar(key):
+        # A missing key is reported below, so 0 is only a placeholder.
+        return int(envvar(key) or 0)
+
     website.bitbucket_consumer_key = envvar('BITBUCKET_CONSUMER_KEY')
     website.bitbucket_consumer_secret = envvar('BITBUCKET_CONSUMER_SECRET')
     website.bitbucket_callback = envvar('BITBUCKET_CALLBACK')
@@ -116,6 +147,13 @@ def envvars(website):
                                           .replace('%version', website.version)
     website.cache_static = is_yesish(envvar('GITTIP_CACHE_STATIC'))
 
+    website.session_refresh_within = int_envvar('SESSION_REFRESH_WITHIN')
+    website.session_flush_every = int_envvar('SESSION_FLUSH_EVERY')
+    website.session_cache_ttl = int_envvar('SESSION_CACHE_TTL')
+    website.session_cache_size = int_envvar('SESSION_CACHE_SIZE')
+
+    website.projection_flush_every = int_envvar('PROJECTION_FLUSH_EVERY')
+
     if missing_keys:
         missing_keys.sort()
         these = len(missing_keys) != 1 and 'these' or 'this'
@@ -280,29 +280,14 @@ Gittip.profile.init = function()
     // Wire up API Key
     // ===============
     //
-    $('.api-key')
-        .data('callback', function (data) {
-            $('.api-key span').text(data.api_key || 'xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx');
-
-            if (data.api_key) {
-                $('.api-key').data('api-key', data.api_key);
-                $('.api-key .show')
-                    .text('Hide Key')
-                    .toggleClass('show hide');
-            }
-            else
-                $('.api-key .hide')
-                    .text('Show Key')
-                    .toggleClass('show hide');
-        })
-        .on('click', '.show', function () {
-            if ($('.api-key').data('api-key'))
-                return $('.api-key').data('callback')({ api_key: $('.api-key').data('api-key') });
-
-            $.get('api-key.json', { action: 'show' }, $('.api-key').data('callback'));
-        })
-        .on('click', '.hide', $('.api-key').data('callback'))
-        .on('click', '.recreate', function () {
-            $.post('api-key.json', { action: 'show' }, $('.api-key').data('callback'));
+    // We only keep a hash of the key, so we can only show it when it's made.
+    $('.api-key').on('click', '.recreate', function () {
+        if (!confirm( "Recreating your API key will stop your old key from "
+                    + "working. Continue?"
+                     ))
+            return;
+        $.post('api-key.json', {}, function (data) {
+            $('.api-key span').text(data.api_key);
         });
+    });
 }
@@ -57,7 +57,7 @@ require () {
 }
 
 start () {
-    echo "Logging to $LOG."
+    echo "Logging to $LOG and $PAYDAY_LOG."
     echo >> $LOG
     date -u >> $LOG
 }
@@ -72,6 +72,9 @@ else
     LOG="../paydays/test-$1.log"
 fi
 
+# Records for each tip, charge, and credit go here, one JSON object per line.
+export PAYDAY_LOG="${LOG%.log}.jsonl"
+
 if [ -f $LOG ]; then
     RUN="Rerun"
 else
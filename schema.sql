@@ -912,3 +912,214 @@ UPDATE paydays SET nactive=(
         SELECT tippee FROM transfers WHERE "timestamp" >= ts_start AND "timestamp" < ts_end
         ) AS foo
 );
+
+
+-------------------------------------------------------------------------------
+-- Progress through each phase of payday, for /about/payday-progress.json.
+-- db_seconds is time spent running SQL statements during the phase.
+
+CREATE TABLE payday_progress
+( id                    serial                      PRIMARY KEY
+, payday                int                         NOT NULL REFERENCES paydays ON DELETE CASCADE
+, phase                 text                        NOT NULL
+, ts_start              timestamp with time zone    NOT NULL DEFAULT CURRENT_TIMESTAMP
+, ts_end                timestamp with time zone    DEFAULT NULL
+, nitems                bigint                      NOT NULL DEFAULT 0
+, ntotal                bigint                      DEFAULT NULL
+, db_seconds            double precision            NOT NULL DEFAULT 0
+, processor_seconds     double precision            NOT NULL DEFAULT 0
+, eta                   timestamp with time zone    DEFAULT NULL
+, UNIQUE (payday, phase)
+ );
+
+
+-------------------------------------------------------------------------------
+-- Per-participant checkpoints, so that a payday that crashed can skip the
+-- participants it already finished. Rows are deleted when the payday ends.
+
+CREATE TABLE payday_checkpoints
+( payday                int                         NOT NULL REFERENCES paydays ON DELETE CASCADE
+, phase                 text                        NOT NULL
+, participant_id        bigint                      NOT NULL
+, status                text                        NOT NULL DEFAULT 'done'
+, PRIMARY KEY (payday, phase, participant_id)
+ );
+
+
+-------------------------------------------------------------------------------
+-- Charges and credits we're about to make, written before we call Balanced
+-- or Stripe and resolved when we record the result. Intents left pending by
+-- a crash are resolved by gittip/billing/reconciler.py.
+
+CREATE TABLE exchange_intents
+( id                    bigserial                   PRIMARY KEY
+, ctime                 timestamp with time zone    NOT NULL DEFAULT CURRENT_TIMESTAMP
+, mtime                 timestamp with time zone    NOT NULL DEFAULT CURRENT_TIMESTAMP
+, participant           text                        NOT NULL REFERENCES participants(username) ON UPDATE CASCADE ON DELETE RESTRICT
+, kind                  text                        NOT NULL CHECK (kind IN ('charge', 'credit'))
+, processor             text                        NOT NULL CHECK (processor IN ('balanced', 'stripe'))
+, route                 text                        NOT NULL
+, amount                numeric(35,2)               NOT NULL
+, fee                   numeric(35,2)               NOT NULL
+, status                text                        NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'succeeded', 'failed', 'void'))
+, error                 text                        DEFAULT NULL
+ );
+
+-- At most one unresolved charge and one unresolved credit per participant.
+CREATE UNIQUE INDEX exchange_intents_pending
+    ON exchange_intents (participant, kind) WHERE status = 'pending';
+
+
+-------------------------------------------------------------------------------
+-- Running totals of exchanges and transfers per participant, for checking
+-- participants.balance against the ledger without rescanning it (see
+-- gittip/billing/verifier.py).
+
+CREATE TABLE ledger_totals
+( participant           text                        PRIMARY KEY REFERENCES participants(username) ON UPDATE CASCADE ON DELETE RESTRICT
+, total                 numeric(35,2)               NOT NULL DEFAULT 0
+ );
+
+-- One row per run of the verifier. The next run starts after these ids, and
+-- also looks again for the ids at or below them that this run couldn't see
+-- yet (their transactions were still in flight). txid is the verifier's own
+-- transaction, so that it knows when to give up on those.
+CREATE TABLE ledger_checks
+( id                    serial                      PRIMARY KEY
+, ts                    timestamp with time zone    NOT NULL DEFAULT CURRENT_TIMESTAMP
+, exchanges_through     bigint                      NOT NULL
+, transfers_through     bigint                      NOT NULL
+, exchanges_pending     bigint[]                    NOT NULL DEFAULT '{}'
+, transfers_pending     bigint[]                    NOT NULL DEFAULT '{}'
+, txid                  bigint                      DEFAULT NULL
+, nfolded               bigint                      NOT NULL
+, ndrifted              bigint                      NOT NULL
+ );
+
+
+-------------------------------------------------------------------------------
+-- Projection of the next payday, for /about/projected-payday.json. Each
+-- participant's contribution is stored so that it can be recomputed and the
+-- difference applied to the single projected_payday row when their tips,
+-- funding, or standing change (see gittip/billing/projection.py).
+
+CREATE TABLE projected_payday_participants
+( participant           text                        PRIMARY KEY REFERENCES participants(username) ON UPDATE CASCADE ON DELETE CASCADE
+, nparticipants         int                         NOT NULL DEFAULT 0
+, ntippers              int                         NOT NULL DEFAULT 0
+, transfer_volume       numeric(35,2)               NOT NULL DEFAULT 0
+, ncharges              int                         NOT NULL DEFAULT 0
+, charge_volume         numeric(35,2)               NOT NULL DEFAULT 0
+ );
+
+CREATE TABLE projected_payday
+( id                    serial                      PRIMARY KEY
+, ts_refreshed          timestamp with time zone    NOT NULL DEFAULT CURRENT_TIMESTAMP
+, mtime                 timestamp with time zone    NOT NULL DEFAULT CURRENT_TIMESTAMP
+, nparticipants         bigint                      NOT NULL DEFAULT 0
+, ntippers              bigint                      NOT NULL DEFAULT 0
+, transfer_volume       numeric(35,2)               NOT NULL DEFAULT 0
+, ncharges              bigint                      NOT NULL DEFAULT 0
+, charge_volume         numeric(35,2)               NOT NULL DEFAULT 0
+ );
+
+
+-------------------------------------------------------------------------------
+-- Payday now counts givers and receivers as it makes transfers, and stores
+-- them alongside nactive, so that /about/stats doesn't scan transfers.
+
+ALTER TABLE paydays ADD COLUMN ngivers bigint DEFAULT 0;
+ALTER TABLE paydays ADD COLUMN nreceivers bigint DEFAULT 0;
+ALTER TABLE paydays ADD COLUMN noverlap bigint DEFAULT 0;
+
+UPDATE paydays SET ngivers=(
+    SELECT count(DISTINCT tipper) FROM transfers WHERE "timestamp" >= ts_start AND "timestamp" < ts_end
+), nreceivers=(
+    SELECT count(DISTINCT tippee) FROM transfers WHERE "timestamp" >= ts_start AND "timestamp" < ts_end
+), noverlap=(
+    SELECT count(*) FROM (
+        SELECT tipper FROM transfers WHERE "timestamp" >= ts_start AND "timestamp" < ts_end
+            INTERSECT
+        SELECT tippee FROM transfers WHERE "timestamp" >= ts_start AND "timestamp" < ts_end
+        ) AS foo
+);
+
+
+-------------------------------------------------------------------------------
+-- Balances at the end of each payday, for participants whose balance payday
+-- changed (see Payday.snapshot_balances).
+
+CREATE TABLE balance_snapshots
+( payday                int                         NOT NULL REFERENCES paydays ON DELETE CASCADE
+, participant           text                        NOT NULL REFERENCES participants(username) ON UPDATE CASCADE ON DELETE CASCADE
+, balance               numeric(35,2)               NOT NULL
+, PRIMARY KEY (participant, payday)
+ );
+
+
+-------------------------------------------------------------------------------
+-- Store API keys hashed (SHA-256, hex), with a unique index for lookups. The
+-- key itself is only shown to the participant when it's created. Existing
+-- keys are hashed by the hash_api_keys script (see gittip/cli.py), and we keep
+-- the plaintext columns until a deploy has confirmed that the hashes work.
+
+BEGIN;
+
+    ALTER TABLE participants ADD COLUMN api_key_hash text DEFAULT NULL UNIQUE;
+    ALTER TABLE api_keys ADD COLUMN api_key_hash text DEFAULT NULL UNIQUE;
+    ALTER TABLE api_keys ALTER COLUMN api_key DROP NOT NULL;
+
+    -- New keys are only stored hashed, with api_key set to NULL, so only log
+    -- plaintext keys that are actually there.
+    DROP RULE log_api_key_changes ON participants;
+    CREATE RULE log_api_key_changes
+    AS ON UPDATE TO participants
+              WHERE NEW.api_key IS NOT NULL
+                AND NEW.api_key IS DISTINCT FROM OLD.api_key
+                 DO
+        INSERT INTO api_keys
+                    (ctime, participant, api_key)
+             VALUES ( COALESCE (( SELECT ctime
+                                    FROM api_keys
+                                   WHERE participant=OLD.username
+                                   LIMIT 1
+                                 ), CURRENT_TIMESTAMP)
+                    , OLD.username
+                    , NEW.api_key
+                     );
+
+    -- Backfilling a hash for an existing key isn't a new key, so leave that
+    -- out by requiring the plaintext to be gone.
+    CREATE RULE log_api_key_hash_changes
+    AS ON UPDATE TO participants
+              WHERE NEW.api_key IS NULL
+                AND NEW.api_key_hash IS NOT NULL
+                AND NEW.api_key_hash IS DISTINCT FROM OLD.api_key_hash
+                 DO
+        INSERT INTO api_keys
+                    (ctime, participant, api_key_hash)
+             VALUES ( COALESCE (( SELECT ctime
+                                    FROM api_keys
+                                   WHERE participant=OLD.username
+                                   LIMIT 1
+                                 ), CURRENT_TIMESTAMP)
+                    , OLD.username
+                    , NEW.api_key_hash
+                     );
+
+END;
+
+
+-------------------------------------------------------------------------------
+-- Say why payday made each transfer: 'tip' for tips and 'take' for pachinko
+-- transfers from a team to its members. That way a payday picking up after a
+-- crash can count them from the ledger (see PaydayStats.recover). Transfers
+-- made outside of payday are NULL.
+
+BEGIN;
+
+    CREATE TYPE transfer_context AS ENUM ('tip', 'take');
+
+    ALTER TABLE transfers ADD COLUMN context transfer_context DEFAULT NULL;
+
+END;
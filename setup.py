@@ -16,6 +16,10 @@ setup( name='gittip'
                       : [ 'payday=gittip.cli:payday'
                         , 'swaddle=gittip.utils.swaddle:main'
                         , 'fake_data=gittip.utils.fake_data:main'
+                        , 'payday_benchmark=gittip.billing.benchmark:main'
+                        , 'reconcile_exchanges=gittip.cli:reconcile_exchanges'
+                        , 'verify_balances=gittip.cli:verify_balances'
+                        , 'hash_api_keys=gittip.cli:hash_api_keys'
                          ]
                        }
       )
@@ -0,0 +1,40 @@
+from __future__ import print_function, unicode_literals
+
+from nose.tools import assert_equals
+
+from gittip.billing.benchmark import StatementCounter, benchmark
+from gittip.testing import Harness
+
+
+class TestBenchmark(Harness):
+
+    def test_statement_counter_counts_statements_and_rows_written(self):
+        self.make_participant('alice')
+        counter = StatementCounter()
+        with counter.installed():
+            self.db.one("SELECT username FROM participants")
+            self.db.run("UPDATE participants SET balance=1")
+        assert_equals(counter.read(), (2, 1))
+
+    def test_statement_counter_uninstalls(self):
+        counter = StatementCounter()
+        with counter.installed():
+            pass
+        self.db.one("SELECT 1")
+        assert_equals(counter.read(), (0, 0))
+
+    def test_benchmark_records_each_phase(self):
+        result = benchmark(self.db, 10)
+        names = [phase['name'] for phase in result['phases']]
+        assert_equals(names, [ 'zero_out_pending'
+                             , 'payin'
+                             , 'move_pending_to_balance_for_teams'
+                             , 'pachinko'
+                             , 'clear_pending_to_balance'
+                             , 'payout'
+                             , 'set_nactive'
+                              ])
+        assert result['statements'] > 0
+        assert result['rows_written'] > 0
+        paydays = self.db.all("SELECT * FROM paydays")
+        assert_equals(len(paydays), 1)
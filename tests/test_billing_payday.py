@@ -1,4 +1,9 @@
 from __future__ import print_function, unicode_literals
+import os
+import shutil
+import tempfile
+import threading
+import time
 from decimal import Decimal
 from datetime import datetime, timedelta
 
@@ -6,10 +11,20 @@ import balanced
 import mock
 from nose.tools import assert_equals, assert_raises
 from psycopg2 import IntegrityError
+from psycopg2.extensions import TransactionRollbackError
 
 from aspen.utils import typecheck, utcnow
-from gittip import billing
-from gittip.billing.payday import Payday, skim_credit
+from gittip import billing, wireup
+from gittip.billing.payday import ( SHARD_ATTEMPTS
+                                  , BalancedAccounts
+                                  , Payday
+                                  , PaydayLog
+                                  , ShardedPayday
+                                  , call_concurrently
+                                  , connect_shard
+                                  , run_shard
+                                  , skim_credit
+                                   )
 from gittip.models.participant import Participant
 from gittip.testing import Harness
 
@@ -19,6 +34,7 @@ from test_billing import TestBillingBase
 class TestPaydayBase(TestBillingBase):
 
     def fetch_payday(self):
+        self.payday.stats.flush()
         return self.db.one("SELECT * FROM paydays", back_as=dict)
 
 
@@ -46,7 +62,8 @@ class TestPaydayCharge(TestPaydayBase):
 
         """
         payday = self.fetch_payday()
-        keys = [key for key in sorted(payday) if key.startswith('n')]
+        keys = [key for key in sorted(payday) if key.startswith('n')
+                and key not in ('ngivers', 'nreceivers', 'noverlap')]
         return [payday[key] for key in keys]
 
     def test_charge_without_cc_details_returns_None(self):
@@ -186,8 +203,7 @@ class TestBillingCharges(TestPaydayBase):
         before = self.fetch_payday()
         fail_count = before['ncc_failing']
 
-        with self.db.get_cursor() as cursor:
-            self.payday.mark_charge_failed(cursor)
+        self.payday.mark_charge_failed()
 
         after = self.fetch_payday()
         self.assertEqual(after['ncc_failing'], fail_count + 1)
@@ -196,8 +212,7 @@ class TestBillingCharges(TestPaydayBase):
         self.payday.start()
         charge_amount, fee = 4, 2
 
-        with self.db.get_cursor() as cursor:
-            self.payday.mark_charge_success(cursor, charge_amount, fee)
+        self.payday.mark_charge_success(charge_amount, fee)
 
         # verify paydays
         actual = self.fetch_payday()
@@ -579,6 +594,23 @@ class TestBillingPayday(TestPaydayBase):
         for args, _ in log.call_args_list:
             assert_equals(args[0], expected_logging_call_args.pop())
 
+    def test_get_participants_streams_payday_columns_only(self):
+        self.db.run("UPDATE participants SET claimed_time=now(), balance=1 "
+                    "WHERE username='alice'")
+        for username in ('bob', 'carl'):
+            self.make_participant(username, claimed_time='now', balance=1)
+
+        ts_start = self.payday.start()
+
+        participants = list(self.payday.get_participants(ts_start, fetch_size=2))
+        actual = [(p.username, p.balance) for p in participants]
+        expected = [ ('alice', Decimal('1.00'))
+                   , ('bob', Decimal('1.00'))
+                   , ('carl', Decimal('1.00'))
+                    ]
+        assert actual == expected, actual
+        assert not hasattr(participants[0], 'statement')
+
     @mock.patch('gittip.billing.payday.log')
     def test_end(self, log):
         self.payday.start()
@@ -719,8 +751,7 @@ class TestBillingTransfer(TestPaydayBase):
         # Forces a load with current state in dict
         before_transfer = self.fetch_payday()
 
-        with self.db.get_cursor() as cursor:
-            self.payday.mark_transfer(cursor, amount)
+        self.payday.mark_transfer(amount)
 
         # Forces a load with current state in dict
         after_transfer = self.fetch_payday()
@@ -775,5 +806,776 @@ class TestPachinko(Harness):
 
         ts_start = self.payday.start()
 
+        teams = self.payday.genteams(ts_start)
+        self.payday.pachinko(ts_start, teams)
+
+        actual = self.db.all("SELECT username, balance, pending "
+                             "FROM participants ORDER BY username",
+                             back_as=tuple)
+        assert_equals(actual, [ ('a_team', Decimal('19.98'), Decimal('0.00'))
+                              , ('alice', Decimal('0.00'), Decimal('0.01'))
+                              , ('bob', Decimal('0.00'), Decimal('0.01'))
+                               ])
+
+    def test_genteams_only_gets_teams(self):
+        self.make_participant('a_team', claimed_time='now', number='plural')
+        self.make_participant('alice', claimed_time='now')
+
+        ts_start = self.payday.start()
+
+        actual = [p.username for p in self.payday.genteams(ts_start)]
+        assert_equals(actual, ['a_team'])
+
+    def test_compute_pachinko_caps_takes_at_balance(self):
+        team = mock.Mock(username='a_team', balance=Decimal('5.00'))
+        members = [ {'username': 'alice', 'take': Decimal('0.00')}
+                  , {'username': 'bob', 'take': Decimal('3.00')}
+                  , {'username': 'carl', 'take': Decimal('3.00')}
+                  , {'username': 'dana', 'take': Decimal('3.00')}
+                   ]
+        actual = Payday(mock.Mock()).compute_pachinko(team, members)
+        assert_equals(actual, [ ('a_team', 'bob', Decimal('3.00'))
+                              , ('a_team', 'carl', Decimal('2.00'))
+                               ])
+
+    def test_pachinko_checkpoints_teams_with_their_transfers(self):
+        a_team = self.make_participant('a_team', claimed_time='now', number='plural', balance=20, pending=0)
+        a_team.add_member(self.make_participant('alice', claimed_time='now', balance=0, pending=0))
+
+        ts_start = self.payday.start()
+        self.payday.pachinko(ts_start, self.payday.genteams(ts_start))
+
+        actual = self.db.one("SELECT phase FROM payday_checkpoints "
+                             "WHERE participant_id=%s", (a_team.id,))
+        assert_equals(actual, 'pachinko')
+        assert_equals(list(self.payday.genteams(ts_start, 'pachinko')), [])
+
+    def test_pachinko_transfers_are_recorded_as_takes(self):
+        a_team = self.make_participant('a_team', claimed_time='now', number='plural', balance=20, pending=0)
+        a_team.add_member(self.make_participant('alice', claimed_time='now', balance=1, pending=0))
+        a_team.add_member(self.make_participant('bob', claimed_time='now', balance=0, pending=0))
+
+        ts_start = self.payday.start()
+        with mock.patch('gittip.billing.payday.COPY_MIN_TRANSFERS', 2):
+            self.payday.pachinko(ts_start, self.payday.genteams(ts_start))
+        self.payday.transfer('alice', 'bob', Decimal('0.01'))
+
+        actual = self.db.all("SELECT tipper, tippee, context FROM transfers "
+                             "ORDER BY id", back_as=tuple)
+        assert_equals(actual, [ ('a_team', 'alice', 'take')
+                              , ('a_team', 'bob', 'take')
+                              , ('alice', 'bob', 'tip')
+                               ])
+
+
+class TestBulkPayin(Harness):
+
+    def setUp(self):
+        super(TestBulkPayin, self).setUp()
+        self.payday = Payday(self.db, bulk=True)
+
+    def make_graph(self):
+        day_ago = utcnow() - timedelta(days=1)
+        alice = self.make_participant('alice', claimed_time=day_ago, balance=5,
+                                      is_suspicious=False)
+        self.make_participant('bob', claimed_time=day_ago, is_suspicious=False)
+        self.make_participant('carl', claimed_time=day_ago, is_suspicious=False)
+        self.make_participant('dana', claimed_time=None)
+        alice.set_tip_to('bob', '2.00')
+        alice.set_tip_to('dana', '1.00')
+        alice.set_tip_to('carl', '4.00')
+
+    def test_compute_transfers_stops_at_first_unfundable_tip(self):
+        payday = Payday(mock.Mock())
+        alice = mock.Mock(username='alice')
+        ts_start = utcnow()
+        day_ago = ts_start - timedelta(days=1)
+        tips = [ {'amount': Decimal('2.00'), 'tippee': 'bob', 'claimed_time': day_ago}
+               , {'amount': Decimal('0.00'), 'tippee': 'carl', 'claimed_time': day_ago}
+               , {'amount': Decimal('1.00'), 'tippee': 'dana', 'claimed_time': None}
+               , {'amount': Decimal('4.00'), 'tippee': 'emma', 'claimed_time': day_ago}
+               , {'amount': Decimal('1.00'), 'tippee': 'fred', 'claimed_time': day_ago}
+                ]
+        actual = payday.compute_transfers(ts_start, alice, Decimal('5.00'), tips)
+        assert_equals(actual, [('alice', 'bob', Decimal('2.00'))])
+
+    def test_bulk_payin_matches_payin(self):
+        self.make_graph()
+        ts_start = self.payday.start()
+        self.payday.zero_out_pending(ts_start)
         participants = self.payday.genparticipants(ts_start, ts_start)
-        self.payday.pachinko(ts_start, participants)
+        self.payday.bulk_payin(ts_start, participants, chunk_size=2)
+
+        transfers = self.db.all("SELECT tipper, tippee, amount FROM transfers "
+                                "ORDER BY tippee", back_as=tuple)
+        assert_equals(transfers, [('alice', 'bob', Decimal('2.00'))])
+
+        balances = self.db.all("SELECT username, balance, pending "
+                               "FROM participants WHERE username IN "
+                               "('alice', 'bob', 'carl') ORDER BY username",
+                               back_as=tuple)
+        assert_equals(balances, [ ('alice', Decimal('3.00'), Decimal('0.00'))
+                                , ('bob', Decimal('0.00'), Decimal('2.00'))
+                                , ('carl', Decimal('0.00'), Decimal('0.00'))
+                                 ])
+
+        self.payday.stats.flush()
+        payday = self.db.one("SELECT * FROM paydays", back_as=dict)
+        actual = [payday[k] for k in ('nparticipants', 'ntippers', 'ntips',
+                                      'ntransfers', 'transfer_volume')]
+        assert_equals(actual, [3, 1, 1, 1, Decimal('2.00')])
+
+    @mock.patch('gittip.billing.payday.COPY_MIN_TRANSFERS', 1)
+    def test_apply_transfers_can_copy(self):
+        day_ago = utcnow() - timedelta(days=1)
+        for username, balance in (('alice', 5), ('bob', 3), ('carl', 0)):
+            self.make_participant(username, claimed_time=day_ago,
+                                  balance=balance, pending=0)
+        transfers = [ ('alice', 'bob', Decimal('2.00'))
+                    , ('alice', 'carl', Decimal('1.00'))
+                    , ('bob', 'carl', Decimal('3.00'))
+                     ]
+        with self.db.get_cursor() as cursor:
+            self.payday.apply_transfers(cursor, transfers)
+
+        actual = self.db.all("SELECT tipper, tippee, amount FROM transfers "
+                             "ORDER BY tipper, tippee", back_as=tuple)
+        assert_equals(actual, transfers)
+        balances = self.db.all("SELECT username, balance, pending "
+                               "FROM participants ORDER BY username",
+                               back_as=tuple)
+        assert_equals(balances, [ ('alice', Decimal('2.00'), Decimal('0.00'))
+                                , ('bob', Decimal('0.00'), Decimal('2.00'))
+                                , ('carl', Decimal('0.00'), Decimal('4.00'))
+                                 ])
+
+    @mock.patch('gittip.billing.payday.COPY_MIN_TRANSFERS', 1)
+    def test_copied_transfers_roll_back_together(self):
+        day_ago = utcnow() - timedelta(days=1)
+        self.make_participant('alice', claimed_time=day_ago, balance=1,
+                              pending=0)
+        self.make_participant('bob', claimed_time=day_ago, pending=0)
+        transfers = [('alice', 'bob', Decimal('2.00'))]
+        with assert_raises(IntegrityError):
+            with self.db.get_cursor() as cursor:
+                self.payday.apply_transfers(cursor, transfers)
+        assert_equals(self.db.one("SELECT count(*) FROM transfers"), 0)
+
+    def test_bulk_payin_locks_tippees_before_tippers_it_sorts_after(self):
+        # bob tips alice. If another transaction holds alice, bulk payin must
+        # wait for her before locking bob, or a shard paying alice's tips to
+        # bob could deadlock with it.
+        day_ago = utcnow() - timedelta(days=1)
+        self.make_participant('alice', claimed_time=day_ago, pending=0,
+                              is_suspicious=False)
+        bob = self.make_participant('bob', claimed_time=day_ago, balance=5,
+                                    pending=0, is_suspicious=False)
+        bob.set_tip_to('alice', '1.00')
+        ts_start = self.payday.start()
+        tips = [{'amount': Decimal('1.00'), 'tippee': 'alice',
+                 'claimed_time': day_ago}]
+        chunk = [(Participant.from_username('bob'), tips, Decimal('1.00'))]
+
+        with self.db.get_cursor() as cursor:
+            cursor.execute("SELECT 1 FROM participants "
+                           "WHERE username='alice' FOR UPDATE")
+            pay = self.payday.bulk_charge_and_or_transfer
+            payer = threading.Thread(target=pay, args=(ts_start, chunk))
+            payer.start()
+            for i in range(100):
+                if self.db.one("SELECT count(*) FROM pg_locks "
+                               "WHERE NOT granted"):
+                    break
+                time.sleep(0.05)
+            with self.db.get_cursor() as other:
+                other.execute("SELECT 1 FROM participants "
+                              "WHERE username='bob' FOR UPDATE NOWAIT")
+        payer.join()
+
+        actual = self.db.all("SELECT tipper, tippee, amount FROM transfers",
+                             back_as=tuple)
+        assert_equals(actual, [('bob', 'alice', Decimal('1.00'))])
+
+
+class FakeProcessor(object):
+    """A stand-in for Balanced that takes a while and tracks concurrency.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __call__(self, username, balanced_account_uri, amount, intent=None):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+        return Decimal('10.00'), Decimal('0.59'), ""
+
+
+class TestConcurrentPayday(Harness):
+
+    def test_call_concurrently_bounds_in_flight_calls(self):
+        fake = FakeProcessor()
+        args_list = [('user%d' % i, '/v1/blah', Decimal('1.00'))
+                     for i in range(10)]
+        outcomes = call_concurrently(fake, args_list, 3)
+        assert_equals(len(outcomes), 10)
+        assert all(exc_info is None for _, exc_info in outcomes)
+        assert 1 < fake.max_in_flight <= 3, fake.max_in_flight
+
+    def test_call_concurrently_captures_errors(self):
+        def boom(i):
+            if i == 2:
+                raise ValueError(i)
+            return i
+        outcomes = call_concurrently(boom, [(i,) for i in range(4)], 2)
+        assert_equals([result for result, _ in outcomes], [0, 1, None, 3])
+        assert outcomes[2][1][0] is ValueError
+
+    def test_charge_many_records_charges_in_order(self):
+        usernames = ['alice', 'bob', 'carl', 'dana']
+        participants = []
+        for username in usernames:
+            participants.append(self.make_participant( username
+                                                     , balanced_account_uri='/v1/blah/' + username
+                                                     , is_suspicious=False
+                                                      ))
+        payday = Payday(self.db, nworkers=2)
+        payday.start()
+        fake = FakeProcessor()
+        with mock.patch.object(Payday, 'charge_on_balanced', side_effect=fake):
+            payday.charge_many([(p, Decimal('1.00')) for p in participants])
+        payday.stats.flush()
+
+        actual = self.db.all("SELECT participant FROM exchanges ORDER BY id")
+        assert_equals(actual, usernames)
+        assert fake.max_in_flight <= 2, fake.max_in_flight
+        assert_equals(self.db.one("SELECT ncharges FROM paydays"), 4)
+
+
+class TestPaydayStats(Harness):
+
+    def setUp(self):
+        super(TestPaydayStats, self).setUp()
+        self.payday = Payday(self.db)
+
+    def test_stats_are_accumulated_in_memory_until_flushed(self):
+        self.payday.start()
+        self.payday.mark_transfer(Decimal('1.00'))
+        self.payday.mark_transfer(Decimal('2.00'))
+        assert_equals(self.db.one("SELECT ntransfers FROM paydays"), 0)
+
+        self.payday.stats.flush()
+        actual = self.db.one("SELECT ntransfers, transfer_volume FROM paydays",
+                             back_as=tuple)
+        assert_equals(actual, (2, Decimal('3.00')))
+
+    def test_stats_are_recovered_from_the_ledger_when_resuming(self):
+        alice = self.make_participant('alice', balance=10, pending=0)
+        self.make_participant('bob', balance=0, pending=0)
+        self.payday.start()
+        self.payday.transfer('alice', 'bob', Decimal('3.00'))
+        intent = self.payday.open_intent( alice.username, 'charge', 'balanced'
+                                        , '/v1/blah', Decimal('9.41')
+                                        , Decimal('0.59')
+                                         )
+        self.payday.record_charge( Decimal('9.41'), Decimal('10.00')
+                                 , Decimal('0.59'), '', alice.username
+                                 , intent=intent
+                                  )
+        # Crash without flushing, then pick up again.
+        Payday(self.db).start()
+
+        actual = self.db.one("SELECT ntransfers, transfer_volume, "
+                             "ncharges, charge_volume, charge_fees_volume "
+                             "FROM paydays", back_as=tuple)
+        assert_equals(actual, ( 1, Decimal('3.00')
+                              , 1, Decimal('10.00'), Decimal('0.59')
+                               ))
+
+    def test_recover_leaves_participant_counters_as_flushed(self):
+        self.make_participant('alice', balance=10, pending=0)
+        self.make_participant('bob', balance=0, pending=0)
+        self.payday.start()
+        self.payday.mark_participant(1)
+        self.payday.stats.flush()
+        self.payday.transfer('alice', 'bob', Decimal('3.00'))
+        self.payday.transfer('alice', 'bob', Decimal('1.00'))
+        Payday(self.db).start()
+
+        actual = self.db.one("SELECT nparticipants, ntippers, ntips, "
+                             "ntransfers FROM paydays", back_as=tuple)
+        assert_equals(actual, (1, 1, 1, 2))
+
+    def test_recover_tells_pachinko_from_tips_to_members(self):
+        team = self.make_participant('team', claimed_time='now',
+                                     number='plural', balance=10, pending=0)
+        alice = self.make_participant('alice', claimed_time='now', pending=0)
+        bob = self.make_participant('bob', claimed_time='now', pending=0)
+        team.add_member(alice)
+        team.add_member(bob)
+        self.payday.start()
+        with self.db.get_cursor() as cursor:
+            self.payday.apply_transfers( cursor
+                                       , [('team', 'alice', Decimal('1.00'))]
+                                       , context='take'
+                                        )
+        self.payday.transfer('team', 'bob', Decimal('2.00'))
+        Payday(self.db).start()
+
+        actual = self.db.one("SELECT npachinko, pachinko_volume, ntransfers, "
+                             "transfer_volume FROM paydays", back_as=tuple)
+        assert_equals(actual, (1, Decimal('1.00'), 1, Decimal('2.00')))
+
+    def test_recover_leaves_out_exchanges_and_transfers_not_by_payday(self):
+        self.make_participant('alice', balance=10, pending=0)
+        self.make_participant('bob', balance=0, pending=0)
+        self.payday.start()
+        self.db.run("INSERT INTO transfers (tipper, tippee, amount) "
+                    "VALUES ('alice', 'bob', 1.00)")
+        self.db.run("INSERT INTO exchanges (amount, fee, participant) "
+                    "VALUES (9.41, 0.59, 'bob')")
+        intent = self.payday.open_intent( 'bob', 'charge', 'balanced'
+                                        , '/v1/blah', Decimal('9.41')
+                                        , Decimal('0.59')
+                                         )
+        self.payday.record_charge( Decimal('9.41'), Decimal('10.00')
+                                 , Decimal('0.59'), 'Declined', 'bob'
+                                 , intent=intent
+                                  )
+        Payday(self.db).start()
+
+        actual = self.db.one("SELECT ntransfers, ncharges, ncc_failing "
+                             "FROM paydays", back_as=tuple)
+        assert_equals(actual, (0, 0, 1))
+
+
+class TestPaydayActivity(Harness):
+
+    def setUp(self):
+        super(TestPaydayActivity, self).setUp()
+        self.payday = Payday(self.db)
+        for username in ('alice', 'bob', 'carl'):
+            self.make_participant(username, balance=10, pending=0)
+
+    def fetch_activity(self):
+        return self.db.one("SELECT nactive, ngivers, nreceivers, noverlap "
+                           "FROM paydays", back_as=tuple)
+
+    def test_set_nactive_stores_counts_collected_during_transfers(self):
+        ts_start = self.payday.start()
+        self.payday.transfer('alice', 'bob', Decimal('1.00'))
+        self.payday.transfer('bob', 'carl', Decimal('1.00'))
+        self.payday.transfer('alice', 'carl', Decimal('1.00'))
+        self.payday.set_nactive(ts_start)
+        assert_equals(self.fetch_activity(), (3, 2, 2, 1))
+
+    def test_activity_is_recovered_from_the_ledger_when_resuming(self):
+        self.payday.start()
+        self.payday.transfer('alice', 'bob', Decimal('1.00'))
+
+        # Crash, then pick up again.
+        payday = Payday(self.db)
+        ts_start = payday.start()
+        payday.transfer('bob', 'alice', Decimal('1.00'))
+        payday.set_nactive(ts_start)
+        assert_equals(self.fetch_activity(), (2, 2, 2, 2))
+
+
+class TestBalanceSnapshots(Harness):
+
+    def setUp(self):
+        super(TestBalanceSnapshots, self).setUp()
+        for username in ('alice', 'bob', 'carl'):
+            self.make_participant(username, balance=10, pending=0)
+
+    def fetch_snapshots(self):
+        return self.db.all("SELECT participant, balance "
+                           "FROM balance_snapshots ORDER BY participant",
+                           back_as=tuple)
+
+    def test_end_snapshots_balances_that_payday_changed(self):
+        payday = Payday(self.db)
+        payday.start()
+        payday.transfer('alice', 'bob', Decimal('1.00'))
+        payday.record_charge( Decimal('9.41'), Decimal('10.00')
+                            , Decimal('0.59'), '', 'carl'
+                             )
+        payday.clear_pending_to_balance()
+        payday.end()
+        assert_equals(self.fetch_snapshots(), [ ('alice', Decimal('9.00'))
+                                              , ('bob', Decimal('11.00'))
+                                              , ('carl', Decimal('19.41'))
+                                               ])
+
+    def test_end_skips_balances_unchanged_since_the_last_snapshot(self):
+        for transfers in ( [('alice', 'bob')]
+                         , [('alice', 'bob'), ('bob', 'alice')]
+                          ):
+            payday = Payday(self.db)
+            payday.start()
+            for tipper, tippee in transfers:
+                payday.transfer(tipper, tippee, Decimal('1.00'))
+            payday.clear_pending_to_balance()
+            payday.end()
+        assert_equals(self.fetch_snapshots(), [ ('alice', Decimal('9.00'))
+                                              , ('bob', Decimal('11.00'))
+                                               ])
+
+
+class TestPaydayProgress(Harness):
+
+    def setUp(self):
+        super(TestPaydayProgress, self).setUp()
+        self.payday = Payday(self.db)
+
+    def test_each_phase_is_recorded(self):
+        self.make_participant('alice', claimed_time='now', balance=0)
+        self.payday.run()
+        actual = self.db.all("SELECT phase FROM payday_progress ORDER BY id")
+        assert_equals(actual, [ 'zero_out_pending'
+                              , 'payin'
+                              , 'move_pending_to_balance_for_teams'
+                              , 'pachinko'
+                              , 'clear_pending_to_balance'
+                              , 'payout'
+                              , 'set_nactive'
+                               ])
+        assert_equals(self.db.one("SELECT count(*) FROM payday_progress "
+                                  "WHERE ts_end IS NULL"), 0)
+
+    def test_participants_are_counted(self):
+        day_ago = utcnow() - timedelta(days=1)
+        self.make_participant('alice', claimed_time=day_ago, balance=0)
+        self.make_participant('bob', claimed_time=day_ago, balance=0)
+        ts_start = self.payday.start()
+        self.payday.run_phase( 'payin'
+                             , self.payday.payin
+                             , ts_start
+                             , self.payday.genparticipants(ts_start, ts_start)
+                              )
+        actual = self.db.one("SELECT nitems, ntotal FROM payday_progress "
+                             "WHERE phase='payin'", back_as=tuple)
+        assert_equals(actual, (2, 2))
+
+    def test_participants_are_counted_when_were_done_with_them(self):
+        day_ago = utcnow() - timedelta(days=1)
+        self.make_participant('alice', claimed_time=day_ago, balance=0)
+        self.make_participant('bob', claimed_time=day_ago, balance=0)
+        ts_start = self.payday.start()
+        progress = self.payday.progress
+        seen = []
+        def pay(ts_start, participant, tips, total):
+            seen.append(progress.nitems)
+        with mock.patch.object(self.payday, 'charge_and_or_transfer', pay):
+            participants = self.payday.genparticipants(ts_start, ts_start)
+            participants = self.payday.prefetch_accounts( participants
+                                                        , lambda *a: False
+                                                         )
+            self.payday.run_phase( 'payin'
+                                 , self.payday.payin
+                                 , ts_start
+                                 , participants
+                                  )
+        assert_equals(seen, [0, 1])
+
+    def test_db_time_is_measured_not_inferred(self):
+        self.payday.start()
+        self.payday.run_phase('sleeping', time.sleep, 0.3)
+        sleeping = self.db.one("SELECT db_seconds FROM payday_progress "
+                               "WHERE phase='sleeping'")
+        self.payday.run_phase('querying', self.db.one, "SELECT pg_sleep(0.3)")
+        querying = self.db.one("SELECT db_seconds FROM payday_progress "
+                               "WHERE phase='querying'")
+        assert sleeping < 0.2, sleeping
+        assert querying >= 0.3, querying
+
+    def test_rerunning_a_phase_starts_it_over(self):
+        self.payday.start()
+        self.payday.progress.start('payin')
+        self.payday.progress.tick(5)
+        self.payday.progress.finish()
+        self.payday.progress.start('payin')
+        actual = self.db.one("SELECT nitems, ts_end FROM payday_progress",
+                             back_as=tuple)
+        assert_equals(actual, (0, None))
+
+    def test_eta_is_projected_from_throughput(self):
+        progress = self.payday.progress
+        progress.expect(10)
+        progress.tick(5)
+        eta = progress.get_eta(60)
+        expected = utcnow() + timedelta(seconds=60)
+        assert abs((eta - expected).total_seconds()) < 5, eta
+
+
+class TestPaydayCheckpoints(Harness):
+
+    def setUp(self):
+        super(TestPaydayCheckpoints, self).setUp()
+        self.payday = Payday(self.db)
+        day_ago = utcnow() - timedelta(days=1)
+        self.alice = self.make_participant('alice', claimed_time=day_ago)
+        self.make_participant('bob', claimed_time=day_ago)
+
+    def test_payin_checkpoints_each_participant(self):
+        ts_start = self.payday.start()
+        self.payday.run_phase( 'payin'
+                             , self.payday.payin
+                             , ts_start
+                             , self.payday.genparticipants(ts_start, ts_start,
+                                                           'payin')
+                              )
+        actual = self.db.all("SELECT participant_id FROM payday_checkpoints "
+                             "WHERE phase='payin' ORDER BY participant_id")
+        expected = self.db.all("SELECT id FROM participants ORDER BY id")
+        assert_equals(actual, expected)
+
+    def test_resume_skips_checkpointed_participants(self):
+        ts_start = self.payday.start()
+        self.payday.checkpoints.add('payin', self.alice)
+        self.payday.checkpoints.flush()
+
+        payday = Payday(self.db)
+        ts_start = payday.start()
+        actual = [p.username for p in payday.get_participants(ts_start,
+                                                              phase='payin')]
+        assert_equals(actual, ['bob'])
+        assert_equals(payday.count_participants(ts_start, 'payin'), 1)
+        assert_equals(payday.count_participants(ts_start, 'payout'), 2)
+
+    def test_checkpoints_are_cleared_when_payday_ends(self):
+        self.payday.run()
+        assert_equals(self.db.one("SELECT count(*) FROM payday_checkpoints"), 0)
+
+    @mock.patch('gittip.billing.payday.Payday.snapshot_balances')
+    def test_checkpoints_survive_if_ending_payday_fails(self, snapshot):
+        snapshot.side_effect = ZeroDivisionError
+        self.payday.start()
+        self.payday.checkpoints.add('payin', self.alice)
+        self.payday.checkpoints.flush()
+        assert_raises(ZeroDivisionError, self.payday.end)
+        assert_equals(self.db.one("SELECT count(*) FROM payday_checkpoints"), 1)
+        assert_equals(self.db.one("SELECT count(*) FROM paydays "
+                                  "WHERE ts_end='1970-01-01T00:00:00+00'"), 1)
+
+
+class TestShardedPayday(Harness):
+
+    def make_graph(self):
+        day_ago = utcnow() - timedelta(days=1)
+        for username in ('alice', 'bob', 'carl', 'dana'):
+            self.make_participant(username, claimed_time=day_ago, balance=10,
+                                  pending=0, is_suspicious=False)
+        for tipper, tippee in (('alice', 'bob'), ('bob', 'alice'),
+                               ('carl', 'dana'), ('dana', 'alice')):
+            Participant.from_username(tipper).set_tip_to(tippee, '1.00')
+
+    def test_shards_partition_participants(self):
+        self.make_graph()
+        ts_start = Payday(self.db).start()
+        shards = []
+        for shard in range(3):
+            payday = Payday(self.db, shard=(shard, 3))
+            participants = payday.get_participants(ts_start)
+            shards.append([p.username for p in participants])
+        actual = sorted(sum(shards, []))
+        assert_equals(actual, ['alice', 'bob', 'carl', 'dana'])
+
+    def test_sharded_payday_moves_money(self):
+        self.make_graph()
+        ShardedPayday(self.db, 2, wireup.db).run()
+        actual = self.db.all("SELECT username, balance FROM participants "
+                             "ORDER BY username", back_as=tuple)
+        assert_equals(actual, [ ('alice', Decimal('11.00'))
+                              , ('bob', Decimal('10.00'))
+                              , ('carl', Decimal('9.00'))
+                              , ('dana', Decimal('10.00'))
+                               ])
+        actual = self.db.one("SELECT ntransfers, transfer_volume FROM paydays",
+                             back_as=tuple)
+        assert_equals(actual, (4, Decimal('4.00')))
+        actual = self.db.one("SELECT nactive, ngivers, nreceivers, noverlap "
+                             "FROM paydays", back_as=tuple)
+        assert_equals(actual, (4, 4, 3, 3))
+
+    @mock.patch('gittip.billing.payday.time.sleep')
+    @mock.patch('gittip.billing.payday.Payday.run_participant_phase')
+    def test_run_shard_retries_rollbacks_then_gives_up(self, run_phase, sleep):
+        Payday(self.db).start()
+        run_phase.side_effect = TransactionRollbackError()
+        connect_shard(lambda: self.db)
+        assert_raises(TransactionRollbackError, run_shard, ('payin', 0, 2, {}))
+        assert_equals(run_phase.call_count, SHARD_ATTEMPTS)
+        assert_equals(sleep.call_count, SHARD_ATTEMPTS - 1)
+
+
+class TestExchangeIntents(Harness):
+
+    def setUp(self):
+        super(TestExchangeIntents, self).setUp()
+        self.payday = Payday(self.db)
+        self.bob = self.make_participant( 'bob'
+                                        , balanced_account_uri='/v1/blah/bob'
+                                        , is_suspicious=False
+                                         )
+
+    def get_intents(self):
+        return self.db.all("SELECT kind, amount, fee, status "
+                           "FROM exchange_intents ORDER BY id", back_as=tuple)
+
+    @mock.patch('gittip.billing.payday.Payday.charge_on_balanced')
+    def test_charge_resolves_its_intent(self, cob):
+        cob.return_value = (Decimal('10.00'), Decimal('0.59'), "")
+        self.payday.start()
+        self.payday.charge(self.bob, Decimal('1.00'))
+        assert_equals(self.get_intents(), [ ( 'charge'
+                                            , Decimal('9.41')
+                                            , Decimal('0.59')
+                                            , 'succeeded'
+                                             )])
+        intent = self.db.one("SELECT id FROM exchange_intents")
+        assert_equals(cob.call_args[0][3], intent)
+
+    @mock.patch('gittip.billing.payday.Payday.charge_on_balanced')
+    def test_charge_that_raises_leaves_its_intent_pending(self, cob):
+        cob.side_effect = ValueError
+        self.payday.start()
+        assert_raises(ValueError, self.payday.charge, self.bob,
+                      Decimal('1.00'))
+        actual = [intent[3] for intent in self.get_intents()]
+        assert_equals(actual, ['pending'])
+
+    @mock.patch('gittip.billing.payday.Payday.charge_on_balanced')
+    def test_pending_intent_blocks_another_charge(self, cob):
+        cob.side_effect = ValueError
+        self.payday.start()
+        assert_raises(ValueError, self.payday.charge, self.bob,
+                      Decimal('1.00'))
+
+        # Payday is rerun after the crash.
+        cob.side_effect = None
+        cob.return_value = (Decimal('10.00'), Decimal('0.59'), "")
+        self.payday.charge(self.bob, Decimal('1.00'))
+        assert_equals(cob.call_count, 1)
+        assert_equals(self.db.one("SELECT count(*) FROM exchanges"), 0)
+
+    def test_recording_a_resolved_intent_is_a_noop(self):
+        self.payday.start()
+        intent = self.payday.open_intent( 'bob', 'charge', 'balanced'
+                                        , '/v1/blah/bob', Decimal('9.41')
+                                        , Decimal('0.59')
+                                         )
+        self.payday.void_intent(intent)
+        self.payday.record_charge( Decimal('9.41'), Decimal('10.00')
+                                 , Decimal('0.59'), '', 'bob', intent=intent
+                                  )
+        assert_equals(self.db.one("SELECT count(*) FROM exchanges"), 0)
+        assert_equals(self.db.one("SELECT balance FROM participants "
+                                  "WHERE username='bob'"), Decimal('0.00'))
+
+
+class TestBalancedAccounts(Harness):
+
+    URI = '/v1/marketplaces/M123/accounts/A123'
+
+    @mock.patch('balanced.Account')
+    def test_find_looks_up_each_account_once(self, ba):
+        accounts = BalancedAccounts()
+        assert accounts.find(self.URI) is ba.find.return_value
+        assert accounts.find(self.URI) is ba.find.return_value
+        assert_equals(ba.find.call_count, 1)
+
+    @mock.patch('balanced.Account')
+    def test_find_uses_prefetched_account(self, ba):
+        accounts = BalancedAccounts()
+        accounts.prefetch(self.URI)
+        accounts.prefetch(self.URI)
+        assert accounts.find(self.URI) is ba.find.return_value
+        assert_equals(ba.find.call_count, 1)
+
+    @mock.patch('balanced.Account')
+    def test_close_stops_workers_and_empties_the_cache(self, ba):
+        accounts = BalancedAccounts()
+        accounts.prefetch(self.URI)
+        workers = accounts.workers
+        accounts.close()
+        assert not any(worker.is_alive() for worker in workers)
+        assert_equals(accounts.accounts, {})
+
+    @mock.patch('balanced.Account')
+    def test_find_retries_failed_prefetch(self, ba):
+        account = mock.Mock()
+        ba.find.side_effect = [balanced.exc.HTTPError('Woah, crazy'), account]
+        accounts = BalancedAccounts()
+        accounts.prefetch(self.URI)
+        assert accounts.find(self.URI) is account
+        assert_equals(ba.find.call_count, 2)
+
+    def test_prefetch_accounts_prefetches_wanted_participants_in_order(self):
+        payday = Payday(self.db)
+        payday.accounts = mock.Mock()
+        items = [(mock.Mock(balanced_account_uri='/v1/%d' % i), [], i)
+                 for i in range(5)]
+        wanted = lambda participant, tips, total: total % 2 == 0
+        actual = list(payday.prefetch_accounts(iter(items), wanted, ahead=2))
+        assert_equals(actual, items)
+        prefetched = [c[0][0] for c in payday.accounts.prefetch.call_args_list]
+        assert_equals(prefetched, ['/v1/0', '/v1/2', '/v1/4'])
+
+
+class TestPaydayLog(Harness):
+
+    def setUp(self):
+        super(TestPaydayLog, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'payday.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(TestPaydayLog, self).tearDown()
+
+    def test_records_are_buffered_until_flushed(self):
+        records = PaydayLog(self.path)
+        records.start('payin')
+        records.add('transfer', 'SUCCESS', "SUCCESS: $1.00 from alice to bob.",
+                    tipper='alice', tippee='bob', amount=Decimal('1.00'))
+        assert not os.path.exists(self.path)
+
+        records.finish()
+        actual = list(PaydayLog.read(self.path))
+        assert_equals(len(actual), 1)
+        record = actual[0]
+        assert_equals( [record[k] for k in ('phase', 'event', 'status',
+                                            'tipper', 'tippee', 'amount')]
+                     , ['payin', 'transfer', 'SUCCESS', 'alice', 'bob', '1.00']
+                      )
+
+    def test_read_filters_records(self):
+        records = PaydayLog(self.path)
+        records.start('payin')
+        records.add('charge', 'SUCCESS', "...", participant='alice')
+        records.add('charge', 'FAILURE', "...", participant='bob')
+        records.flush()
+        actual = [r['participant'] for r in PaydayLog.read(self.path,
+                                                           status='FAILURE')]
+        assert_equals(actual, ['bob'])
+
+    def test_payday_writes_transfers_to_the_log(self):
+        day_ago = utcnow() - timedelta(days=1)
+        self.make_participant('alice', claimed_time=day_ago, balance=10,
+                              pending=0, is_suspicious=False)
+        self.make_participant('bob', claimed_time=day_ago, balance=0,
+                              pending=0, is_suspicious=False)
+        Participant.from_username('alice').set_tip_to('bob', '1.00')
+
+        Payday(self.db, log_path=self.path).run()
+
+        actual = [ (r['phase'], r['tipper'], r['tippee'], r['amount'])
+                   for r in PaydayLog.read(self.path, event='transfer')
+                  ]
+        assert_equals(actual, [('payin', 'alice', 'bob', '1.00')])
@@ -0,0 +1,101 @@
+from __future__ import print_function, unicode_literals
+from decimal import Decimal
+
+import mock
+from nose.tools import assert_equals
+
+from gittip.billing.reconciler import Reconciler
+from gittip.testing import Harness
+
+
+class TestReconciler(Harness):
+
+    def setUp(self):
+        super(TestReconciler, self).setUp()
+        self.make_participant('alice', balance=10, last_ach_result='failure')
+        self.make_participant('bob', balance=0, last_bill_result='failure')
+        self.reconciler = Reconciler(self.db)
+
+    def make_intent(self, username, kind, amount, fee, age='1 hour'):
+        return self.db.one("""\
+
+            INSERT INTO exchange_intents
+                        ( ctime, participant, kind, processor, route
+                        , amount, fee
+                         )
+                 VALUES (CURRENT_TIMESTAMP - %s::interval, %s, %s, 'balanced',
+                         '/v1/blah', %s, %s)
+              RETURNING id
+
+        """, (age, username, kind, amount, fee))
+
+    def get_state(self):
+        intents = self.db.all("SELECT participant, status "
+                              "FROM exchange_intents ORDER BY id",
+                              back_as=tuple)
+        exchanges = self.db.all("SELECT participant, amount, fee "
+                                "FROM exchanges ORDER BY id", back_as=tuple)
+        balances = self.db.all("SELECT username, balance FROM participants "
+                               "ORDER BY username", back_as=tuple)
+        return intents, exchanges, balances
+
+    @mock.patch.object(Reconciler, 'look_up')
+    def test_reconciler_records_intents_found_at_the_processor(self, look_up):
+        look_up.return_value = True
+        self.make_intent('alice', 'credit', Decimal('-9.00'), Decimal('0.00'))
+        self.make_intent('bob', 'charge', Decimal('9.41'), Decimal('0.59'))
+        assert_equals(self.reconciler.reconcile_batch(), 2)
+
+        intents, exchanges, balances = self.get_state()
+        assert_equals(intents, [('alice', 'succeeded'), ('bob', 'succeeded')])
+        assert_equals(exchanges, [ ('alice', Decimal('-9.00'), Decimal('0.00'))
+                                 , ('bob', Decimal('9.41'), Decimal('0.59'))
+                                  ])
+        assert_equals(balances, [ ('alice', Decimal('1.00'))
+                                , ('bob', Decimal('9.41'))
+                                 ])
+        results = self.db.all("SELECT last_ach_result, last_bill_result "
+                              "FROM participants ORDER BY username",
+                              back_as=tuple)
+        assert_equals(results, [('', None), (None, '')])
+
+    @mock.patch.object(Reconciler, 'look_up')
+    def test_reconciler_voids_intents_missing_at_the_processor(self, look_up):
+        look_up.return_value = False
+        self.make_intent('bob', 'charge', Decimal('9.41'), Decimal('0.59'))
+        self.reconciler.reconcile_batch()
+
+        intents, exchanges, balances = self.get_state()
+        assert_equals(intents, [('bob', 'void')])
+        assert_equals(exchanges, [])
+        assert_equals(balances, [ ('alice', Decimal('10.00'))
+                                , ('bob', Decimal('0.00'))
+                                 ])
+
+    @mock.patch.object(Reconciler, 'look_up')
+    def test_reconciler_leaves_intents_it_cant_look_up_pending(self, look_up):
+        look_up.side_effect = [Exception("Balanced is down."), True]
+        self.make_intent('alice', 'credit', Decimal('-9.00'), Decimal('0.00'))
+        self.make_intent('bob', 'charge', Decimal('9.41'), Decimal('0.59'))
+        assert_equals(self.reconciler.reconcile_batch(), 1)
+
+        intents, exchanges, balances = self.get_state()
+        assert_equals(intents, [('alice', 'pending'), ('bob', 'succeeded')])
+        assert_equals(exchanges, [('bob', Decimal('9.41'), Decimal('0.59'))])
+
+    @mock.patch.object(Reconciler, 'look_up')
+    def test_reconciler_leaves_recent_intents_alone(self, look_up):
+        self.make_intent('bob', 'charge', Decimal('9.41'), Decimal('0.59'),
+                         age='1 second')
+        assert_equals(self.reconciler.reconcile_batch(), 0)
+        assert_equals(look_up.call_count, 0)
+
+    @mock.patch('balanced.Debit')
+    def test_look_up_on_balanced_filters_by_meta(self, Debit):
+        Debit.query.filter.return_value.all.return_value = [object()]
+        intent = { 'id': 42
+                 , 'kind': 'charge'
+                 , 'processor': 'balanced'
+                  }
+        assert self.reconciler.look_up(intent)
+        Debit.query.filter.assert_called_with(**{'meta.exchange_intent': '42'})
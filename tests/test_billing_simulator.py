@@ -0,0 +1,110 @@
+from __future__ import print_function, unicode_literals
+from datetime import timedelta
+from decimal import Decimal
+
+from aspen.utils import utcnow
+from nose.tools import assert_equals
+
+from gittip.billing.simulator import SimulatedPayday, format_report
+from gittip.models.participant import Participant
+from gittip.testing import Harness
+
+
+class TestSimulatedPayday(Harness):
+
+    def setUp(self):
+        super(TestSimulatedPayday, self).setUp()
+        day_ago = utcnow() - timedelta(days=1)
+        self.make_participant('bob', claimed_time=day_ago,
+                              last_bill_result='', is_suspicious=False)
+        carl = self.make_participant('carl', claimed_time=day_ago,
+                                     balanced_account_uri='/v1/blah/carl',
+                                     last_bill_result='',
+                                     is_suspicious=False)
+        carl.set_tip_to('bob', '6.00')
+
+    def test_simulate_projects_charges_and_transfers(self):
+        report = SimulatedPayday(self.db).simulate()
+        actual = [report[k] for k in ('ncharges', 'charge_volume',
+                                      'ntransfers', 'transfer_volume',
+                                      'nactive')]
+        assert_equals(actual, [1, Decimal('10.00'), 1, Decimal('6.00'), 2])
+
+    def test_simulate_doesnt_write_to_the_db(self):
+        SimulatedPayday(self.db).simulate()
+        assert_equals(self.db.one("SELECT count(*) FROM paydays"), 0)
+        assert_equals(self.db.one("SELECT count(*) FROM transfers"), 0)
+        assert_equals(self.db.one("SELECT count(*) FROM exchanges"), 0)
+        assert_equals(Participant.from_username('carl').balance, Decimal('0.00'))
+
+    def test_simulate_predicts_failing_cards_fail(self):
+        self.db.run("UPDATE participants SET last_bill_result='Declined' "
+                    "WHERE username='carl'")
+        report = SimulatedPayday(self.db).simulate()
+        assert_equals((report['ncharges'], report['ncc_failing']), (0, 1))
+        assert_equals(report['ntransfers'], 0)
+
+    def test_simulate_times_each_phase(self):
+        report = SimulatedPayday(self.db).simulate()
+        actual = [name for name, seconds in report['phases']]
+        assert_equals(actual, [ 'zero_out_pending'
+                              , 'payin'
+                              , 'move_pending_to_balance_for_teams'
+                              , 'pachinko'
+                              , 'clear_pending_to_balance'
+                              , 'payout'
+                              , 'set_nactive'
+                               ])
+        assert format_report(report)[0].startswith("Projected payday")
+
+    def test_format_report_lists_the_projected_ledger(self):
+        lines = format_report(SimulatedPayday(self.db).simulate())
+        transfers = lines.index("Projected transfers:")
+        charges = lines.index("Projected charges:")
+        credits = lines.index("Projected credits:")
+        assert_equals(lines[transfers+1:charges], ["  carl -> bob 6.00"])
+        assert_equals(len(lines[charges+1:credits]), 1)
+        assert lines[charges+1].startswith("  carl "), lines[charges+1]
+
+    def test_simulate_doesnt_estimate_without_a_finished_payday(self):
+        report = SimulatedPayday(self.db).simulate()
+        assert_equals(report['estimates'], [])
+
+    def test_simulate_estimates_duration_from_the_last_payday(self):
+        payday = self.db.one("""\
+
+            INSERT INTO paydays (ts_start, ts_end, ncharges, ncc_failing)
+                 VALUES ( now() - interval '7 days'
+                        , now() - interval '7 days' + interval '1 hour'
+                        , 1, 1
+                         )
+              RETURNING id
+
+        """)
+        for phase, nitems, db_seconds, processor_seconds in (
+                ('payin', 0, 0.5, 0.0),
+                ('payin.0', 2, 1.0, 4.0),
+                ('payin.1', 2, 1.0, 2.0),
+                ('payout', 4, 3.0, 0.0),
+                ('set_nactive', 0, 0.25, 0.0)):
+            self.db.run("""\
+
+                INSERT INTO payday_progress
+                            ( payday, phase, nitems, db_seconds
+                            , processor_seconds
+                             )
+                     VALUES (%s, %s, %s, %s, %s)
+
+            """, (payday, phase, nitems, db_seconds, processor_seconds))
+
+        report = SimulatedPayday(self.db).simulate()
+        phases = dict(report['phases'])
+        extra = dict((name, seconds - phases[name])
+                     for name, seconds in report['estimates'])
+
+        # We project 2 participants and 1 charge: half as many as last time.
+        assert_equals(round(extra['payin'], 6), round(1.25 + 3.0, 6))
+        assert_equals(round(extra['payout'], 6), 1.5)
+        assert_equals(round(extra['set_nactive'], 6), 0.25)
+        assert_equals(extra['pachinko'], 0)
+        assert "Estimated duration" in " ".join(format_report(report))
@@ -0,0 +1,122 @@
+from __future__ import print_function, unicode_literals
+from decimal import Decimal
+
+from nose.tools import assert_equals
+
+from gittip.billing.verifier import LedgerVerifier
+from gittip.testing import Harness
+
+
+class TestLedgerVerifier(Harness):
+
+    def setUp(self):
+        super(TestLedgerVerifier, self).setUp()
+        self.make_participant('alice', balance=0)
+        self.make_participant('bob', balance=0)
+        self.verifier = LedgerVerifier(self.db)
+
+    def charge(self, username, amount, fee):
+        self.db.run("INSERT INTO exchanges (amount, fee, participant) "
+                    "VALUES (%s, %s, %s)", (amount, fee, username))
+        self.db.run("UPDATE participants SET balance = balance + %s "
+                    "WHERE username=%s", (amount, username))
+
+    def transfer(self, tipper, tippee, amount):
+        self.db.run("INSERT INTO transfers (tipper, tippee, amount) "
+                    "VALUES (%s, %s, %s)", (tipper, tippee, amount))
+        self.db.run("UPDATE participants SET balance = balance - %s "
+                    "WHERE username=%s", (amount, tipper))
+        self.db.run("UPDATE participants SET balance = balance + %s "
+                    "WHERE username=%s", (amount, tippee))
+
+    def get_totals(self):
+        return self.db.all("SELECT participant, total FROM ledger_totals "
+                           "ORDER BY participant", back_as=tuple)
+
+    def test_consistent_balances_dont_drift(self):
+        self.charge('alice', Decimal('10.00'), Decimal('0.59'))
+        self.transfer('alice', 'bob', Decimal('3.00'))
+        assert_equals(self.verifier.run(), [])
+        assert_equals(self.get_totals(), [ ('alice', Decimal('7.00'))
+                                         , ('bob', Decimal('3.00'))
+                                          ])
+
+    def test_credits_count_their_fee(self):
+        self.charge('bob', Decimal('20.00'), Decimal('0.88'))
+        self.db.run("INSERT INTO exchanges (amount, fee, participant) "
+                    "VALUES (-10.00, 0.25, 'bob')")
+        self.db.run("UPDATE participants SET balance=9.75 "
+                    "WHERE username='bob'")
+        assert_equals(self.verifier.run(), [])
+
+    def test_drift_is_reported(self):
+        self.charge('alice', Decimal('10.00'), Decimal('0.59'))
+        self.db.run("UPDATE participants SET balance=12.00 "
+                    "WHERE username='alice'")
+        actual = [(r['username'], r['balance'], r['expected'])
+                  for r in self.verifier.run()]
+        assert_equals(actual, [('alice', Decimal('12.00'), Decimal('10.00'))])
+
+    def test_later_runs_only_fold_new_rows(self):
+        self.charge('alice', Decimal('10.00'), Decimal('0.59'))
+        self.verifier.run()
+        self.transfer('alice', 'bob', Decimal('3.00'))
+        self.verifier.run()
+        actual = self.db.all("SELECT nfolded FROM ledger_checks ORDER BY id")
+        assert_equals(actual, [1, 2])
+        assert_equals(self.get_totals(), [ ('alice', Decimal('7.00'))
+                                         , ('bob', Decimal('3.00'))
+                                          ])
+
+    def test_reset_recomputes_and_isnt_double_counted(self):
+        self.charge('alice', Decimal('10.00'), Decimal('0.59'))
+        self.verifier.run()
+        self.transfer('alice', 'bob', Decimal('3.00'))
+        self.verifier.reset('alice')
+        assert_equals(self.verifier.run(), [])
+        assert_equals(self.get_totals(), [ ('alice', Decimal('7.00'))
+                                         , ('bob', Decimal('3.00'))
+                                          ])
+
+    def test_pending_counts_during_payday(self):
+        self.charge('alice', Decimal('10.00'), Decimal('0.59'))
+        self.db.run("INSERT INTO transfers (tipper, tippee, amount) "
+                    "VALUES ('alice', 'bob', 1.00)")
+        self.db.run("UPDATE participants SET balance=9.00 "
+                    "WHERE username='alice'")
+        self.db.run("UPDATE participants SET pending=1.00 "
+                    "WHERE username='bob'")
+        assert_equals(self.verifier.run(), [])
+
+    def get_pending(self):
+        return self.db.one("SELECT exchanges_pending FROM ledger_checks "
+                           "ORDER BY id DESC LIMIT 1")
+
+    def test_rows_committed_below_the_ceiling_are_folded_later(self):
+        with self.db.get_cursor() as cursor:
+            cursor.run("INSERT INTO exchanges (amount, fee, participant) "
+                       "VALUES (10.00, 0.59, 'alice')")
+            cursor.run("UPDATE participants SET balance=10.00 "
+                       "WHERE username='alice'")
+            self.charge('bob', Decimal('20.00'), Decimal('0.88'))
+            assert_equals(self.verifier.run(), [])
+            assert_equals(len(self.get_pending()), 1)
+        assert_equals(self.verifier.run(), [])
+        assert_equals(self.get_pending(), [])
+        assert_equals(self.get_totals(), [ ('alice', Decimal('10.00'))
+                                         , ('bob', Decimal('20.00'))
+                                          ])
+
+    def test_rolled_back_rows_are_forgotten(self):
+        try:
+            with self.db.get_cursor() as cursor:
+                cursor.run("INSERT INTO exchanges (amount, fee, participant) "
+                           "VALUES (10.00, 0.59, 'alice')")
+                raise ZeroDivisionError
+        except ZeroDivisionError:
+            pass
+        self.charge('bob', Decimal('20.00'), Decimal('0.88'))
+        self.verifier.run()
+        assert_equals(len(self.get_pending()), 1)
+        self.verifier.run()
+        assert_equals(self.get_pending(), [])
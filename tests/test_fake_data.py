@@ -1,5 +1,7 @@
 from __future__ import print_function, unicode_literals
 
+import mock
+
 from gittip.utils import fake_data
 from gittip.testing import Harness
 
@@ -21,3 +23,22 @@ class TestFakeData(Harness):
         participants = self.db.all("SELECT * FROM participants")
         assert len(tips) == num_tips
         assert len(participants) == num_participants + num_teams
+
+    def test_fake_data_with_tippee_exponent(self):
+        fake_data.populate_db(self.db, 20, 40, 2, tippee_exponent=1.5)
+        tips = self.db.all("SELECT * FROM tips")
+        assert len(tips) == 40
+        assert all(tip.tipper != tip.tippee for tip in tips)
+
+    def test_fake_int_ids_are_distinct(self):
+        ids = list(fake_data.fake_int_ids(1000, nmax=1000))
+        assert sorted(ids) == range(1, 1001)
+
+    @mock.patch('gittip.utils.fake_data.fake_text_id')
+    def test_fake_participants_are_unique_even_with_few_names(self, text_id):
+        text_id.return_value = 'abc'
+        with mock.patch.object(fake_data.faker, 'firstName') as first_name:
+            first_name.return_value = 'Alice'
+            fake_data.populate_db(self.db, 10, 10, 1)
+        usernames = self.db.all("SELECT username FROM participants")
+        assert len(set(usernames)) == 11
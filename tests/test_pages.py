@@ -117,3 +117,39 @@ class TestPages(Harness):
         expected = "Page Not Found"
         actual = self.get('/credit-card.json')
         assert expected in actual, actual
+
+    def make_paydays(self, n):
+        start = datetime.datetime(2013, 1, 1, tzinfo=pytz.utc)
+        for i in range(n):
+            ts_start = start + datetime.timedelta(days=i)
+            ts_end = ts_start + datetime.timedelta(hours=1)
+            self.db.run( "INSERT INTO paydays (ts_start, ts_end) "
+                         "VALUES (%s, %s)"
+                       , (ts_start, ts_end)
+                        )
+        return start
+
+    def test_history_is_paginated(self):
+        start = self.make_paydays(21)
+        self.make_participant('alice', balance=10)
+        self.make_participant('bob')
+        self.db.run( "INSERT INTO transfers (timestamp, tipper, tippee, amount) "
+                     "VALUES (%s, 'alice', 'bob', 1)"
+                   , (start + datetime.timedelta(minutes=1),)
+                    )
+
+        first = self.client.get('/alice/history/', 'alice').body
+        assert "Older paydays" in first, first
+        assert "Newer paydays" not in first, first
+        assert "/bob/" not in first, first
+
+        second = self.client.get('/alice/history/?page=1', 'alice').body
+        assert "Newer paydays" in second, second
+        assert "Older paydays" not in second, second
+        assert "/bob/" in second, second
+        assert "11.00" in second, second
+
+    def test_history_rejects_bad_page(self):
+        self.make_participant('alice')
+        actual = self.client.get('/alice/history/?page=-1', 'alice').code
+        assert actual == 400, actual
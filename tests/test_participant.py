@@ -483,6 +483,42 @@ class Tests(Harness):
         assert actual == 0, actual
 
 
+    # get_tips_and_totals - gtats
+
+    def test_gtats_matches_get_tips_and_total(self):
+        alice = self.make_participant('alice', claimed_time='now')
+        bob = self.make_participant('bob', claimed_time='now')
+        self.make_participant('carl', claimed_time='now')
+        self.make_participant('dana', claimed_time=None)
+        alice.set_tip_to('bob', '1.00')
+        alice.set_tip_to('carl', '3.00')
+        alice.set_tip_to('dana', '2.00')
+        alice.set_tip_to('bob', '4.00')
+        bob.set_tip_to('carl', '2.00')
+        ts_start = utcnow()
+
+        participants = [alice, bob]
+        for for_payday in (ts_start, False):
+            expected = [(p,) + p.get_tips_and_total(for_payday=for_payday)
+                        for p in participants]
+            actual = Participant.get_tips_and_totals(participants, for_payday)
+            assert_equals(actual, expected)
+
+    def test_gtats_skips_tips_already_transferred_this_payday(self):
+        alice = self.make_participant('alice', claimed_time='now')
+        self.make_participant('bob', claimed_time='now')
+        self.make_participant('carl', claimed_time='now')
+        alice.set_tip_to('bob', '1.00')
+        alice.set_tip_to('carl', '3.00')
+        ts_start = utcnow()
+        self.db.run("INSERT INTO transfers (tipper, tippee, amount) "
+                    "VALUES ('alice', 'bob', 1.00)")
+
+        [(_, tips, total)] = Participant.get_tips_and_totals([alice], ts_start)
+        assert_equals([t['tippee'] for t in tips], ['carl'])
+        assert_equals(total, Decimal('3.00'))
+
+
     # get_age_in_seconds - gais
 
     def test_gais_gets_age_in_seconds(self):
@@ -0,0 +1,28 @@
+from __future__ import print_function, unicode_literals
+
+import json
+
+from nose.tools import assert_equal
+
+from gittip.testing import GittipPaydayTest
+from gittip.testing.client import TestClient
+
+
+class Tests(GittipPaydayTest):
+
+    def test_payday_progress_json_gives_phases_of_latest_payday(self):
+        self.payday.start()
+        self.payday.progress.start('payin')
+        self.payday.progress.expect(4)
+        self.payday.progress.tick(2)
+        self.payday.progress.finish()
+
+        data = json.loads(TestClient().get('/about/payday-progress.json').body)
+
+        assert_equal(len(data), 1)
+        assert_equal(data[0]['phase'], 'payin')
+        assert_equal((data[0]['nitems'], data[0]['ntotal']), (2, 4))
+
+    def test_payday_progress_json_is_empty_without_paydays(self):
+        data = json.loads(TestClient().get('/about/payday-progress.json').body)
+        assert_equal(data, [])
@@ -0,0 +1,126 @@
+from __future__ import print_function, unicode_literals
+
+import json
+from decimal import Decimal
+
+import mock
+from nose.tools import assert_equal
+
+from gittip.billing import projection
+from gittip.testing import Harness
+from gittip.testing.client import TestClient
+
+
+class Tests(Harness):
+
+    def get(self):
+        response = TestClient().get('/about/projected-payday.json')
+        return json.loads(response.body)
+
+    def make_tipper(self, username, **kw):
+        return self.make_participant( username
+                                    , claimed_time='now'
+                                    , is_suspicious=False
+                                    , last_bill_result=''
+                                    , balanced_account_uri='/v1/accounts/a'
+                                    , **kw
+                                     )
+
+    def test_projected_payday_json_is_503_until_seeded(self):
+        response = TestClient().get('/about/projected-payday.json')
+        assert_equal(response.code, 503)
+
+    def test_seed_projects_payday_when_missing(self):
+        alice = self.make_tipper('alice', balance=Decimal('10.00'))
+        self.make_participant('bob', claimed_time='now')
+        alice.set_tip_to('bob', '3.00')
+        projection.seed(self.db)
+
+        data = self.get()
+
+        assert_equal(data['nparticipants'], 2)
+        assert_equal(data['ntippers'], 1)
+        assert_equal(Decimal(data['transfer_volume']), Decimal('3.00'))
+        assert_equal(data['ncharges'], 0)
+
+    def test_set_tip_to_updates_projection(self):
+        alice = self.make_tipper('alice', balance=Decimal('0.00'))
+        self.make_participant('bob', claimed_time='now')
+        projection.refresh(self.db)
+
+        alice.set_tip_to('bob', '3.00')
+        actual = projection.get(self.db)
+
+        assert_equal(actual['ntippers'], 1)
+        assert_equal(actual['ncharges'], 1)
+        assert_equal(actual['charge_volume'], Decimal('10.00'))
+        assert_equal(actual['transfer_volume'], Decimal('3.00'))
+
+    def test_changing_a_tip_applies_the_difference(self):
+        alice = self.make_tipper('alice', balance=Decimal('20.00'))
+        self.make_participant('bob', claimed_time='now')
+        projection.refresh(self.db)
+
+        alice.set_tip_to('bob', '3.00')
+        alice.set_tip_to('bob', '1.00')
+        actual = projection.get(self.db)
+
+        assert_equal(actual['transfer_volume'], Decimal('1.00'))
+        assert_equal(actual['ntippers'], 1)
+
+    def test_tips_to_suspicious_participants_are_not_projected(self):
+        alice = self.make_tipper('alice', balance=Decimal('20.00'))
+        self.make_participant('bob', claimed_time='now')
+        alice.set_tip_to('bob', '3.00')
+        projection.refresh(self.db)
+
+        self.db.run("UPDATE participants SET is_suspicious=true "
+                    "WHERE username='bob'")
+        projection.update_tippers_of(self.db, 'bob')
+        actual = projection.get(self.db)
+
+        assert_equal(actual['nparticipants'], 1)
+        assert_equal(actual['transfer_volume'], Decimal('0.00'))
+
+    def test_update_matches_refresh(self):
+        alice = self.make_tipper('alice', balance=Decimal('0.00'))
+        self.make_participant('bob', claimed_time='now')
+        projection.refresh(self.db)
+        alice.set_tip_to('bob', '12.00')
+        updated = projection.get(self.db)
+
+        projection.refresh(self.db)
+        refreshed = projection.get(self.db)
+
+        for field in projection.FIELDS:
+            assert_equal(updated[field], refreshed[field])
+
+    def test_updater_queues_participants_until_flushed(self):
+        self.make_tipper('alice', balance=Decimal('10.00'))
+        self.make_participant('bob', claimed_time='now')
+        projection.refresh(self.db)
+        self.db.run("INSERT INTO tips (ctime, tipper, tippee, amount) "
+                    "VALUES (now(), 'alice', 'bob', 3.00)")
+
+        updater = projection.ProjectionUpdater(self.db, 60)
+        updater.add(['alice'])
+        assert_equal(projection.get(self.db)['ntippers'], 0)
+        updater.flush()
+        assert_equal(projection.get(self.db)['ntippers'], 1)
+
+    @mock.patch('gittip.billing.projection.update')
+    def test_updater_doesnt_raise(self, update):
+        update.side_effect = ZeroDivisionError
+        projection.ProjectionUpdater(self.db, 0).add(['alice'])
+        assert_equal(update.call_count, 1)
+
+    @mock.patch('gittip.billing.projection.update')
+    def test_updater_retries_failed_participants(self, update):
+        update.side_effect = ZeroDivisionError
+        updater = projection.ProjectionUpdater(self.db, 0)
+        updater.add(['alice'])
+        assert_equal(updater.pending, set(['alice']))
+        update.side_effect = None
+        updater.add(['bob'])
+        assert_equal(update.call_args[0][1], ['alice', 'bob'])
+        assert_equal(updater.pending, set())
@@ -0,0 +1,146 @@
+from __future__ import print_function, unicode_literals
+
+import time
+
+from mock import patch
+from nose.tools import assert_equal
+
+from gittip.models.participant import Participant
+from gittip.security import sessions
+from gittip.security.sessions import SessionCache, SessionRefresher
+from gittip.security.user import User
+from gittip.testing import Harness
+
+
+WEEK = 60 * 60 * 24 * 7
+DAY = 60 * 60 * 24
+
+
+class TestSessionRefresher(Harness):
+
+    def setUp(self):
+        super(TestSessionRefresher, self).setUp()
+        self.refresher = SessionRefresher(self.db, 6 * DAY, 5)
+        self.alice = self.make_participant('alice')
+
+    def fetch_expires(self):
+        return self.db.one("SELECT session_expires FROM participants "
+                           "WHERE username='alice'")
+
+    def test_refresh_buffers_until_flushed(self):
+        before = self.fetch_expires()
+        self.refresher.refresh(self.alice, time.time() + WEEK)
+        assert_equal(self.fetch_expires(), before)
+
+        self.refresher.flush()
+        assert_equal(self.fetch_expires(), self.alice.session_expires)
+
+    def test_refresh_skips_sessions_with_plenty_of_time_left(self):
+        self.refresher.refresh(self.alice, time.time() + WEEK)
+        self.refresher.flush()
+        alice = Participant.from_username('alice')
+
+        expires = self.refresher.refresh(alice, time.time() + WEEK + DAY)
+        assert_equal(self.refresher.pending, {})
+        assert expires < time.time() + WEEK, expires
+
+    def test_refresh_extends_sessions_that_are_running_out(self):
+        self.refresher.refresh(self.alice, time.time() + DAY)
+        self.refresher.flush()
+        alice = Participant.from_username('alice')
+
+        expires = time.time() + WEEK
+        assert_equal(self.refresher.refresh(alice, expires), expires)
+        assert_equal(list(self.refresher.pending), [alice.id])
+
+    def test_flush_writes_many_sessions_at_once(self):
+        bob = self.make_participant('bob')
+        self.refresher.refresh(self.alice, time.time() + WEEK)
+        self.refresher.refresh(bob, time.time() + WEEK)
+        self.refresher.flush()
+        actual = self.db.one("SELECT count(*) FROM participants WHERE "
+                             "session_expires > now() + interval '6 days'")
+        assert_equal(actual, 2)
+
+    def test_write_through_when_flush_every_is_zero(self):
+        refresher = SessionRefresher(self.db, 6 * DAY, 0)
+        refresher.refresh(self.alice, time.time() + WEEK)
+        assert_equal(self.fetch_expires(), self.alice.session_expires)
+
+
+class TestSessionCache(Harness):
+
+    def setUp(self):
+        super(TestSessionCache, self).setUp()
+        self.cache = SessionCache(60, 2)
+        self.alice = self.make_participant('alice')
+        self.alice.start_new_session()
+        self.nfetches = 0
+
+    def fetch(self, token):
+        self.nfetches += 1
+        return Participant.from_session_token(token)
+
+    def test_get_fetches_once(self):
+        token = self.alice.session_token
+        self.cache.get(token, self.fetch)
+        actual = self.cache.get(token, self.fetch)
+        assert_equal(actual.username, 'alice')
+        assert_equal(self.nfetches, 1)
+
+    def test_get_loads_the_current_row(self):
+        token = self.alice.session_token
+        self.cache.get(token, self.fetch)
+        self.db.run("UPDATE participants SET balanced_account_uri='/new', "
+                    "is_suspicious=true WHERE username='alice'")
+        actual = self.cache.get(token, self.fetch)
+        assert_equal(actual.balanced_account_uri, '/new')
+        assert_equal(actual.is_suspicious, True)
+        assert_equal(self.nfetches, 1)
+
+    def test_get_doesnt_cache_unknown_tokens(self):
+        assert self.cache.get('deadbeef', self.fetch) is None
+        assert self.cache.get('deadbeef', self.fetch) is None
+        assert_equal(self.nfetches, 2)
+
+    def test_get_drops_expired_entries(self):
+        token = self.alice.session_token
+        self.cache.get(token, self.fetch)
+        self.cache.entries[token] = (0, self.cache.entries[token][1])
+        self.cache.get(token, self.fetch)
+        assert_equal(self.nfetches, 2)
+
+    def test_get_drops_least_recently_used_entry_when_full(self):
+        tokens = []
+        for username in ('bob', 'carl'):
+            participant = self.make_participant(username)
+            participant.start_new_session()
+            tokens.append(participant.session_token)
+        self.cache.get(self.alice.session_token, self.fetch)
+        self.cache.get(tokens[0], self.fetch)
+        self.cache.get(self.alice.session_token, self.fetch)
+        self.cache.get(tokens[1], self.fetch)
+        assert_equal( list(self.cache.entries)
+                    , [self.alice.session_token, tokens[1]]
+                     )
+
+    def test_forget_drops_a_participants_entries(self):
+        token = self.alice.session_token
+        self.cache.get(token, self.fetch)
+        self.cache.forget(self.alice.id)
+        self.cache.get(token, self.fetch)
+        assert_equal(self.nfetches, 2)
+
+    def test_ending_a_session_revokes_it_in_the_cache(self):
+        with patch.object(sessions, 'cache', self.cache):
+            token = self.alice.session_token
+            User.from_session_token(token)
+            self.alice.end_session()
+            assert User.from_session_token(token).ANON
+
+    def test_recreating_an_api_key_revokes_it_in_the_cache(self):
+        with patch.object(sessions, 'api_key_cache', self.cache):
+            api_key = self.alice.recreate_api_key()
+            User.from_api_key(api_key)
+            self.alice.recreate_api_key()
+            assert User.from_api_key(api_key).ANON
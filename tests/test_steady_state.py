@@ -0,0 +1,69 @@
+from __future__ import print_function, unicode_literals
+
+from decimal import Decimal
+
+from gittip.testing import Harness
+
+try:
+    import numpy
+    from gittip.billing.steady_state import SteadyState, random_payouts
+except ImportError:     # scipy is optional
+    SteadyState = None
+
+
+class Tests(Harness):
+
+    def setUp(self):
+        if SteadyState is None:
+            self.skipTest("scipy isn't installed")
+
+    def assert_close(self, actual, expected):
+        actual, expected = actual.toarray(), expected.toarray()
+        assert numpy.allclose(actual, expected), (actual, expected)
+
+    def test_solve_matches_converge(self):
+        for seed in range(5):
+            payouts, initial = random_payouts(30, 5, seed=seed)
+            expected = SteadyState.converge(payouts, max_rounds=1000)
+            self.assert_close(SteadyState.solve(payouts), expected)
+
+    def test_solve_iteratively_matches_converge(self):
+        payouts, initial = random_payouts(30, 5, seed=0)
+        expected = SteadyState.converge(payouts, max_rounds=1000)
+        actual = SteadyState.solve(payouts, method="iterative")
+        self.assert_close(actual, expected)
+
+    def test_solve_with_initial_matches_converge(self):
+        for seed in range(5):
+            payouts, initial = random_payouts(30, 5, seed=seed)
+            expected = initial * SteadyState.converge(payouts, max_rounds=1000)
+            for method in ("lu", "iterative"):
+                actual = SteadyState.solve(payouts, initial, method=method)
+                self.assert_close(actual, expected)
+
+    def test_solve_refuses_full_steady_state_of_big_graphs(self):
+        payouts, initial = random_payouts(20, 2, seed=0)
+        max_dense_nodes = SteadyState.max_dense_nodes
+        SteadyState.max_dense_nodes = 10
+        try:
+            self.assertRaises(ValueError, SteadyState.solve, payouts)
+            SteadyState.solve(payouts, initial)
+        finally:
+            SteadyState.max_dense_nodes = max_dense_nodes
+
+    def test_from_db_builds_payouts_from_tips_and_takes(self):
+        team = self.make_participant('team', claimed_time='now',
+                                     number='plural')
+        alice = self.make_participant('alice', claimed_time='now')
+        bob = self.make_participant('bob', claimed_time='now')
+        team._MixinTeam__set_take_for(alice, Decimal('2.00'), team)
+        bob.set_tip_to('team', '4.00')
+        bob.set_tip_to('alice', '1.00')
+
+        usernames, payouts, initial = SteadyState.from_db(self.db)
+
+        assert usernames == ['alice', 'team'], usernames
+        assert payouts.toarray().tolist() == [ [1.0, 0.0]
+                                             , [0.5, 0.5]
+                                              ], payouts.toarray()
+        assert initial.toarray().tolist() == [[1.0, 4.0]], initial.toarray()
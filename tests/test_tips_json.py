@@ -19,9 +19,9 @@ class TestTipsJson(Harness):
         now = datetime.datetime.now(pytz.utc)
         self.make_participant("test_tippee1", claimed_time=now)
         self.make_participant("test_tippee2", claimed_time=now)
-        self.make_participant("test_tipper", claimed_time=now)
+        tipper = self.make_participant("test_tipper", claimed_time=now)
 
-        api_key = json.loads(client.get('/test_tipper/api-key.json', 'test_tipper').body)['api_key']
+        api_key = tipper.recreate_api_key()
 
         data = [
             {'username': 'test_tippee1', 'platform': 'gittip', 'amount': '1.00'},
@@ -95,9 +95,9 @@ class TestTipsJson(Harness):
 
         now = datetime.datetime.now(pytz.utc)
         self.make_participant("test_tippee1", claimed_time=now)
-        self.make_participant("test_tipper", claimed_time=now)
+        tipper = self.make_participant("test_tipper", claimed_time=now)
 
-        api_key = json.loads(client.get('/test_tipper/api-key.json', 'test_tipper').body)['api_key']
+        api_key = tipper.recreate_api_key()
 
         response = client.post( '/test_tipper/tips.json'
                               , json.dumps([{ 'username': 'test_tippee1'
@@ -127,3 +127,24 @@ class TestTipsJson(Harness):
 
     def test_also_prune_as_0(self):
         self.also_prune_variant('0', 2)
+
+    def test_api_requests_dont_get_a_csrf_cookie(self):
+        client = TestClient()
+
+        now = datetime.datetime.now(pytz.utc)
+        self.make_participant("test_tippee1", claimed_time=now)
+        tipper = self.make_participant("test_tipper", claimed_time=now)
+
+        api_key = tipper.recreate_api_key()
+
+        response = client.post( '/test_tipper/tips.json'
+                              , json.dumps([{ 'username': 'test_tippee1'
+                                            , 'platform': 'gittip'
+                                            , 'amount': '1.00'
+                                             }])
+                              , content_type='application/json'
+                              , HTTP_AUTHORIZATION='Basic ' + base64.b64encode(api_key + ':')
+                               )
+
+        assert_equal(response.code, 200)
+        assert_true('csrf_token' not in response.headers.cookie)
@@ -1,7 +1,12 @@
 from __future__ import print_function, unicode_literals
 
+import hashlib
+import json
+
+from gittip.models.participant import backfill_api_key_hashes
 from gittip.security.user import User
 from gittip.testing import Harness
+from gittip.testing.client import TestClient
 
 
 class TestUser(Harness):
@@ -92,6 +97,56 @@ class TestUser(Harness):
         actual = User.from_api_key(api_key).participant.username
         assert actual == 'alice', actual
 
+    def test_api_key_is_stored_hashed(self):
+        alice = self.make_participant('alice')
+        api_key = alice.recreate_api_key()
+        actual = self.db.one("SELECT api_key_hash FROM participants")
+        assert actual == hashlib.sha256(api_key).hexdigest(), actual
+
+    def test_recreating_api_key_revokes_the_old_one(self):
+        alice = self.make_participant('alice')
+        api_key = alice.recreate_api_key()
+        alice.recreate_api_key()
+        user = User.from_api_key(api_key)
+        assert user.ANON
+
+    def test_recreating_api_key_drops_the_plaintext_key(self):
+        alice = self.make_participant('alice')
+        self.db.run("UPDATE participants SET api_key='old-key'")
+        alice.recreate_api_key()
+        actual = self.db.one("SELECT api_key FROM participants")
+        assert actual is None, actual
+
+    def test_plaintext_api_keys_can_be_backfilled(self):
+        self.make_participant('alice')
+        self.db.run("UPDATE participants SET api_key='old-key'")
+        assert User.from_api_key('old-key').ANON
+        assert backfill_api_key_hashes(self.db) == 1
+        actual = User.from_api_key('old-key').participant.username
+        assert actual == 'alice', actual
+        actual = self.db.one("SELECT api_key_hash FROM api_keys")
+        assert actual == hashlib.sha256('old-key').hexdigest(), actual
+
+    def test_backfilling_api_keys_twice_is_harmless(self):
+        self.make_participant('alice')
+        self.db.run("UPDATE participants SET api_key='old-key'")
+        backfill_api_key_hashes(self.db)
+        assert backfill_api_key_hashes(self.db) == 0
+        assert self.db.one("SELECT count(*) FROM api_keys") == 1
+
+    def test_api_key_json_only_shows_a_new_key(self):
+        self.make_participant('alice')
+        client = TestClient()
+        csrf_token = client.get('/').request.context['csrf_token']
+        assert client.get('/alice/api-key.json', 'alice').code == 405
+        response = client.post( '/alice/api-key.json'
+                              , {'csrf_token': csrf_token}
+                              , 'alice'
+                               )
+        api_key = json.loads(response.body)['api_key']
+        actual = User.from_api_key(api_key).participant.username
+        assert actual == 'alice', actual
+
 
     def test_user_from_bad_id_is_anonymous(self):
         user = User.from_username('deadbeef')
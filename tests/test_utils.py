@@ -4,6 +4,8 @@ from aspen import Response
 from gittip import utils
 from gittip.testing import Harness, load_request
 from gittip.elsewhere.twitter import TwitterAccount
+from gittip.utils.query_cache import QueryCache
+from gittip.utils.site_globals import SiteGlobals
 
 
 class Tests(Harness):
@@ -33,3 +35,45 @@ class Tests(Harness):
         expected = ""
         actual = utils.dict_to_querystring({})
         assert actual == expected, actual
+
+    def test_site_globals_default_to_zero(self):
+        actual = SiteGlobals(self.db).refresh()
+        assert actual == ('0', '0'), actual
+
+    def test_site_globals_are_rounded_and_formatted(self):
+        self.db.run("INSERT INTO paydays (ts_end, nactive, transfer_volume) "
+                    "VALUES (now(), 1234, 5678.90)")
+        site_globals = SiteGlobals(self.db)
+        site_globals.refresh()
+        request = load_request('/')
+        site_globals.inbound(request)
+        actual = ( request.context['gnactive']
+                 , request.context['gtransfer_volume']
+                  )
+        assert actual == ('1,200', '5,700'), actual
+
+    def test_query_cache_evicts_least_recently_used_entries(self):
+        query_cache = QueryCache(self.db, threshold=60, max_entries=2)
+        query_cache.one("SELECT %s", (1,))
+        query_cache.one("SELECT %s", (2,))
+        query_cache.one("SELECT %s", (1,))
+        query_cache.one("SELECT %s", (3,))
+        actual = sorted(params for query, params in query_cache.cache)
+        assert actual == [(1,), (3,)], actual
+        assert query_cache.nevictions == 1, query_cache.nevictions
+
+    def test_query_cache_evicts_in_one_batch(self):
+        query_cache = QueryCache(self.db, threshold=60, max_entries=10)
+        for i in range(11):
+            query_cache.one("SELECT %s", (i,))
+        assert len(query_cache.cache) == 9, len(query_cache.cache)
+        assert query_cache.nevictions == 2, query_cache.nevictions
+        query_cache.one("SELECT %s", (11,))
+        assert query_cache.nevictions == 2, query_cache.nevictions
+
+    def test_query_cache_stays_under_max_bytes(self):
+        query_cache = QueryCache(self.db, threshold=60, max_bytes=10000)
+        for i in range(100):
+            query_cache.all("SELECT generate_series(1, %s)", (i,))
+        assert 0 < query_cache.nbytes <= 10000, query_cache.nbytes
+        assert query_cache.nevictions > 0, query_cache.nevictions